@@ -1,16 +1,133 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import atexit
+import cProfile
+import csv
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import mimetypes
+import os
+import pstats
+import queue
+import random
+import re
 import sqlite3
-
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava de arquivo, as migrações já se protegem
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # opcional: sem ele, gerar-estaticos produz só .gz
+    brotli = None
+
+import click
+from collections import OrderedDict
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
 from flask import (
-    Flask, render_template, request, redirect,
-    url_for, session, flash, jsonify, g
+    Flask, Response, render_template, request, redirect,
+    url_for, session, flash, get_flashed_messages, jsonify, g,
+    has_request_context, send_from_directory, abort, stream_with_context
 )
+from werkzeug.security import safe_join
+
+# início do corpo do módulo (depois dos imports), para medir a partida
+_INICIO_MODULO = time.perf_counter()
 
 app = Flask(__name__)
 app.secret_key = "chave_super_secreta_123"
 
 DATABASE = "database.db"
 
+# Ajustes do SQLite. Podem ser sobrescritos por variáveis de ambiente com
+# prefixo FLASK_ (ex.: FLASK_SQLITE_BUSY_TIMEOUT_MS=10000).
+app.config.update(
+    DATABASE=DATABASE,
+    SQLITE_JOURNAL_MODE="WAL",
+    SQLITE_SYNCHRONOUS="NORMAL",
+    SQLITE_BUSY_TIMEOUT_MS=5000,
+    SQLITE_CACHE_SIZE_KB=16 * 1024,
+    SQLITE_MMAP_SIZE=128 * 1024 * 1024,
+    SQLITE_HEALTHCHECK_SEGUNDOS=30,
+    # agenda: duração de cada horário e expediente de quem não tem um
+    # próprio (faixas "HH:MM-HH:MM" separadas por vírgula); o padrão tem
+    # o intervalo de almoço das 12:00 às 14:00
+    DURACAO_SLOT_MINUTOS=30,
+    EXPEDIENTE_PADRAO="08:00-12:00,14:00-18:00",
+    DIAS_BUSCA_MAXIMO=62,
+    # escolha do médico quando o paciente só informa o cargo:
+    # "menos_ocupado" (menor carga na janela) ou "rodizio"
+    ESTRATEGIA_ATRIBUICAO="menos_ocupado",
+    JANELA_CARGA_DIAS=14,
+    # notificações em tempo real (SSE): intervalo com que cada worker
+    # confere notificações criadas por outros workers, heartbeat e tempo
+    # máximo de cada conexão (o navegador reconecta sozinho)
+    SSE_INTERVALO_POLL=1.0,
+    SSE_HEARTBEAT=15.0,
+    SSE_DURACAO_MAXIMA=300.0,
+    # cada stream SSE prende uma thread do worker (gthread) até acabar;
+    # acima disso responde 503 e a página volta para o polling. O
+    # gunicorn.conf.py ajusta para metade das threads do worker.
+    SSE_CONEXOES_MAXIMAS=8,
+    # notificações lidas mais antigas que isso saem da tabela principal
+    # (flask limpar-notificacoes)
+    RETENCAO_NOTIFICACOES_DIAS=180,
+    # write-behind de notificações: em vez de gravar na transação de quem
+    # notifica, junta as notificações de várias requisições (depois do
+    # commit de cada uma) e grava num único commit a cada intervalo (ou ao
+    # atingir o tamanho do lote)
+    NOTIFICACOES_WRITE_BEHIND=False,
+    NOTIFICACOES_FLUSH_INTERVALO=0.5,
+    NOTIFICACOES_FLUSH_TAMANHO=200,
+    NOTIFICACOES_FILA_MAXIMA=10000,
+    # rastreamento de SQL por requisição: cabeçalho Server-Timing e log
+    # (JSON, uma linha por comando) dos comandos mais lentos que o limite
+    SQL_TRACE=False,
+    SQL_TRACE_MAIS_LENTOS=3,
+    SQL_LENTO_MS=100.0,
+    SQL_LENTO_LOG=None,
+    # perfil (cProfile) de uma fração das requisições, gravado em
+    # PERFIL_PASTA; um admin força o perfil de uma requisição mandando o
+    # cabeçalho PERFIL_CABECALHO. Relatório: flask relatorio-perfis
+    PERFIL_ATIVO=False,
+    PERFIL_AMOSTRA=0.01,
+    PERFIL_ROTAS=None,  # lista de endpoints; None = todos
+    PERFIL_PASTA="perfis",
+    PERFIL_CABECALHO="X-Perfil",
+    # templates: bytecode compilado em disco (compartilhado entre workers e
+    # reinícios; ligado por create_app, vazio desliga) e cache LRU de
+    # fragmentos ({% cache %} nos templates)
+    JINJA_CACHE_PASTA=os.path.join(tempfile.gettempdir(), "clinica-jinja"),
+    FRAGMENTOS_ATIVO=True,
+    FRAGMENTOS_MAXIMO=20000,
+    # saída de flask gerar-estaticos (nomes com hash + .gz/.br)
+    ESTATICOS_PASTA=os.path.join(app.root_path, "static", "dist"),
+    # gzip das respostas dinâmicas (middleware CompressaoGzip)
+    COMPRESSAO_ATIVA=True,
+    COMPRESSAO_MINIMO=1024,
+    COMPRESSAO_NIVEL=6,
+    COMPRESSAO_TIPOS=(
+        "text/html",
+        "application/json",
+        "text/csv",
+        "text/calendar",
+        "text/plain",
+        "text/css",
+        "application/javascript",
+    ),
+)
+app.config.from_prefixed_env()
+
 # ---------------------------------------------------------------------
 # Constantes simples para evitar "strings mágicas" espalhadas
 # ---------------------------------------------------------------------
@@ -29,20 +146,128 @@ STATUS_CANCELADA = "cancelada"
 # Funções auxiliares
 # ---------------------------------------------------------------------
 
+class GerenciadorConexoes:
+    """
+    Mantém uma conexão SQLite de longa duração por thread, em vez de abrir
+    e fechar uma a cada requisição.
+
+    - Cada conexão é configurada uma vez (WAL, busy_timeout, synchronous,
+      cache de páginas e mmap) conforme app.config.
+    - Depois de um fork (gunicorn --preload) o processo filho não reusa a
+      conexão herdada do pai: o pid é conferido e uma nova é aberta.
+    - De tempos em tempos (SQLITE_HEALTHCHECK_SEGUNDOS) a conexão é
+      testada com SELECT 1 e reaberta se tiver falhado.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def obter(self, config):
+        local = self._local
+        conn = getattr(local, "conn", None)
+        caminho = config["DATABASE"]
+
+        if conn is not None and (
+            local.pid != os.getpid() or local.caminho != caminho
+        ):
+            # conexão de outro processo (fork) ou de outro banco: descarta
+            # sem fechar, o pai ainda pode estar usando o mesmo handle
+            if local.pid == os.getpid():
+                conn.close()
+            conn = None
+
+        agora = time.monotonic()
+        if conn is not None and agora - local.verificada_em > config[
+            "SQLITE_HEALTHCHECK_SEGUNDOS"
+        ]:
+            if self.saudavel(conn):
+                local.verificada_em = agora
+            else:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+                conn = None
+
+        if conn is None:
+            conn = self.conectar(config)
+            local.conn = conn
+            local.pid = os.getpid()
+            local.caminho = caminho
+            local.verificada_em = agora
+
+        return conn
+
+    @staticmethod
+    def conectar(config):
+        """Abre e configura uma conexão nova."""
+        conn = sqlite3.connect(
+            config["DATABASE"],
+            timeout=config["SQLITE_BUSY_TIMEOUT_MS"] / 1000,
+            factory=ConexaoRastreada,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        conn.execute(f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}")
+        conn.execute(f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}")
+        # valor negativo = tamanho em KiB, independente do page_size
+        conn.execute(f"PRAGMA cache_size = -{int(config['SQLITE_CACHE_SIZE_KB'])}")
+        conn.execute(f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}")
+        return conn
+
+    @staticmethod
+    def saudavel(conn) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def fechar(self):
+        """Fecha a conexão da thread atual (usado em testes e scripts)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+
+conexoes = GerenciadorConexoes()
+
+
 def get_db():
-    """Abre conexão com o SQLite para a requisição atual."""
+    """
+    Retorna a conexão SQLite da thread atual para a requisição. Com
+    SQL_TRACE ligado, os comandos da requisição passam a ser medidos
+    (ver RastroSQL).
+    """
     if "db" not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
+        g.db = conexoes.obter(app.config)
+        if app.config["SQL_TRACE"] and has_request_context():
+            g.rastro_sql = g.db.rastro = RastroSQL()
     return g.db
 
 
 @app.teardown_appcontext
 def close_db(exception):
-    """Fecha a conexão ao final do ciclo da requisição."""
-    db = g.pop("db", None)
+    """
+    Devolve a conexão ao final do ciclo da requisição. Ela continua aberta
+    para a próxima; só garantimos que nenhuma transação fique pendurada.
+
+    Em respostas em streaming o Flask chama isto quando a view retorna,
+    antes de o corpo ser gerado: a devolução fica para o fechamento da
+    resposta (ver resposta_em_streaming).
+    """
+    if g.get("em_streaming"):
+        return
+    devolver_db(g.pop("db", None))
+
+
+def devolver_db(db):
     if db is not None:
-        db.close()
+        db.rastro = None
+        db.notificacoes_pendentes = None
+        if db.in_transaction:
+            db.rollback()
 
 
 def normalizar_cpf(cpf: str) -> str:
@@ -58,6 +283,27 @@ def formatar_cpf(cpf: str) -> str:
     return cpf or ""
 
 
+POR_PAGINA_PADRAO = 50
+POR_PAGINA_MAXIMO = 500
+
+
+def ler_por_pagina(valor) -> int:
+    """Converte o parâmetro por_pagina, limitado a POR_PAGINA_MAXIMO."""
+    try:
+        por_pagina = int(valor)
+    except (TypeError, ValueError):
+        return POR_PAGINA_PADRAO
+    return max(1, min(por_pagina, POR_PAGINA_MAXIMO))
+
+
+def ler_pagina(valor) -> int:
+    """Converte o parâmetro pagina (1, 2, ...) com mínimo 1."""
+    try:
+        return max(1, int(valor))
+    except (TypeError, ValueError):
+        return 1
+
+
 def init_db():
     """Cria as tabelas, se ainda não existirem."""
     db = get_db()
@@ -107,75 +353,2553 @@ def init_db():
 
     db.commit()
 
+    aplicar_migracoes(db)
+
+
+# ---------------------------------------------------------------------
+# Rastreamento de SQL (Server-Timing e log de comandos lentos)
+# ---------------------------------------------------------------------
+
+log_sql_lento = logging.getLogger("clinica.sql_lento")
+
+
+class RastroSQL:
+    """Comandos executados numa requisição: [sql, ms] de cada um."""
+
+    def __init__(self):
+        self.comandos = []
+
+    def registrar(self, sql: str, ms: float) -> list:
+        registro = [sql, ms]
+        self.comandos.append(registro)
+        return registro
+
+    @property
+    def total_ms(self) -> float:
+        return sum(ms for _, ms in self.comandos)
+
+    def mais_lentos(self, n: int) -> list:
+        return sorted(self.comandos, key=lambda r: r[1], reverse=True)[:n]
+
+
+class CursorRastreado(sqlite3.Cursor):
+    """
+    Cursor que mede execute() e a leitura das linhas; o tempo das leituras
+    é somado ao comando que as produziu.
+    """
+
+    _registro = None
+
+    def execute(self, sql, parametros=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            self._medir(sql, inicio)
+
+    def executemany(self, sql, sequencia):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, sequencia)
+        finally:
+            self._medir(sql, inicio)
+
+    def _medir(self, sql, inicio):
+        ms = (time.perf_counter() - inicio) * 1000
+        rastro = self.connection.rastro
+        if rastro is not None:
+            self._registro = rastro.registrar(" ".join(sql.split()), ms)
+
+    def _ler(self, leitura, *args):
+        inicio = time.perf_counter()
+        try:
+            return leitura(*args)
+        finally:
+            if self._registro is not None:
+                self._registro[1] += (time.perf_counter() - inicio) * 1000
+
+    def fetchone(self):
+        return self._ler(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._ler(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._ler(super().fetchall)
+
+    def __next__(self):
+        return self._ler(super().__next__)
+
+
+class ConexaoRastreada(sqlite3.Connection):
+    """
+    Conexão usada por GerenciadorConexoes. Sem um rastro instalado (o
+    normal) cada execute() é só um teste de atributo a mais antes do
+    caminho original; com rastro, usa CursorRastreado.
+
+    Também guarda as notificações de write-behind da transação atual
+    (ver notificar): vão para a fila só depois de um commit bem-sucedido
+    e são descartadas no rollback.
+    """
+
+    rastro = None
+    notificacoes_pendentes = None
+
+    def commit(self):
+        super().commit()
+        pendentes, self.notificacoes_pendentes = self.notificacoes_pendentes, None
+        if pendentes:
+            enfileirar_notificacoes(self, pendentes)
+
+    def rollback(self):
+        self.notificacoes_pendentes = None
+        super().rollback()
+
+    def cursor(self, factory=None):
+        if factory is None and self.rastro is not None:
+            factory = CursorRastreado
+        return super().cursor(factory) if factory else super().cursor()
+
+    def execute(self, sql, parametros=()):
+        if self.rastro is None:
+            return super().execute(sql, parametros)
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, sequencia):
+        if self.rastro is None:
+            return super().executemany(sql, sequencia)
+        return self.cursor().executemany(sql, sequencia)
+
+
+def _descricao_server_timing(texto: str) -> str:
+    texto = texto.replace("\\", "").replace('"', "'")
+    return texto[:80] + ("..." if len(texto) > 80 else "")
+
+
+def _configurar_log_sql_lento():
+    caminho = app.config["SQL_LENTO_LOG"]
+    if caminho and not any(
+        getattr(h, "baseFilename", None) == os.path.abspath(caminho)
+        for h in log_sql_lento.handlers
+    ):
+        handler = logging.FileHandler(caminho, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log_sql_lento.addHandler(handler)
+        log_sql_lento.setLevel(logging.INFO)
+        log_sql_lento.propagate = False
+
+
+@app.after_request
+def registrar_rastro_sql(resposta):
+    """
+    Server-Timing com os tempos de SQL e log dos comandos lentos.
+
+    Resposta em streaming (agendas, exportações): os cabeçalhos saem antes
+    do corpo, então não há Server-Timing - o SQL de verdade acontece
+    durante a geração. O log de lentos é feito quando o servidor fecha a
+    resposta, cobrindo o corpo inteiro.
+    """
+    rastro = g.get("rastro_sql")
+    if rastro is None:
+        return resposta
+
+    contexto = {
+        "rota": request.endpoint,
+        "metodo": request.method,
+        "caminho": request.full_path.rstrip("?"),
+    }
+    if resposta.is_streamed:
+        resposta.call_on_close(lambda: _logar_sql_lento(rastro, contexto))
+        return resposta
+
+    partes = [
+        f'db;dur={rastro.total_ms:.2f};desc="{len(rastro.comandos)} comandos SQL"'
+    ]
+    for i, (sql, ms) in enumerate(
+        rastro.mais_lentos(app.config["SQL_TRACE_MAIS_LENTOS"]), 1
+    ):
+        partes.append(f'sql{i};dur={ms:.2f};desc="{_descricao_server_timing(sql)}"')
+    resposta.headers.add("Server-Timing", ", ".join(partes))
+    _logar_sql_lento(rastro, contexto)
+    return resposta
+
+
+def _logar_sql_lento(rastro: RastroSQL, contexto: dict):
+    limite = app.config["SQL_LENTO_MS"]
+    lentos = [(sql, ms) for sql, ms in rastro.comandos if ms >= limite]
+    if not lentos:
+        return
+    _configurar_log_sql_lento()
+    for sql, ms in lentos:
+        log_sql_lento.warning(
+            json.dumps(
+                {
+                    "quando": datetime.now().isoformat(timespec="milliseconds"),
+                    **contexto,
+                    "ms": round(ms, 2),
+                    "sql": sql,
+                    "comandos_na_requisicao": len(rastro.comandos),
+                },
+                ensure_ascii=False,
+            )
+        )
+
+
+# ---------------------------------------------------------------------
+# Perfil de rotas por amostragem (cProfile)
+# ---------------------------------------------------------------------
+
+def deve_perfilar() -> bool:
+    """
+    Decide se a requisição atual será perfilada: sempre que um admin
+    manda o cabeçalho PERFIL_CABECALHO; com PERFIL_ATIVO, uma fração
+    PERFIL_AMOSTRA das requisições às rotas de PERFIL_ROTAS.
+    """
+    if request.headers.get(app.config["PERFIL_CABECALHO"]) and (
+        session.get("tipo") == TIPO_ADMIN
+    ):
+        return True
+    if not app.config["PERFIL_ATIVO"] or request.endpoint is None:
+        return False
+    rotas = app.config["PERFIL_ROTAS"]
+    if rotas is not None and request.endpoint not in rotas:
+        return False
+    return random.random() < app.config["PERFIL_AMOSTRA"]
+
+
+@app.before_request
+def iniciar_perfil():
+    if deve_perfilar():
+        g.perfil = cProfile.Profile()
+        g.perfil.enable()
+
+
+@app.after_request
+def gravar_perfil(resposta):
+    """
+    Grava o perfil em PERFIL_PASTA/<rota>__<data-hora>-<pid>.prof.
+
+    Em streaming o perfil continua ligado durante a geração do corpo (o
+    servidor itera na mesma thread) e só é gravado quando a resposta é
+    fechada; X-Perfil-Arquivo já traz o nome que o arquivo vai ter.
+    """
+    perfil = g.pop("perfil", None)
+    if perfil is None:
+        return resposta
+
+    pasta = app.config["PERFIL_PASTA"]
+    nome = "{}__{}-{}-{}.prof".format(
+        request.endpoint or "sem_rota",
+        datetime.now().strftime("%Y%m%d-%H%M%S-%f"),
+        os.getpid(),
+        threading.get_ident() % 10000,
+    )
+
+    def gravar():
+        perfil.disable()
+        os.makedirs(pasta, exist_ok=True)
+        perfil.dump_stats(os.path.join(pasta, nome))
+
+    if resposta.is_streamed:
+        resposta.call_on_close(gravar)
+    else:
+        gravar()
+    resposta.headers["X-Perfil-Arquivo"] = nome
+    return resposta
+
+
+@app.teardown_request
+def descartar_perfil(exception):
+    # requisição que terminou em exceção não passa pelo after_request
+    perfil = g.pop("perfil", None)
+    if perfil is not None:
+        perfil.disable()
+
+
+def categoria_da_funcao(arquivo: str, funcao: str) -> str:
+    """Classifica uma entrada do pstats em SQLite, Jinja ou Python."""
+    if "sqlite3" in funcao or "/sqlite3/" in arquivo or "Rastread" in funcao:
+        return "SQLite"
+    if "/jinja2/" in arquivo or arquivo.endswith(".html"):
+        return "Jinja"
+    return "Python"
+
+
+@app.cli.command("relatorio-perfis")
+@click.option("--pasta", default=None, help="Padrão: PERFIL_PASTA.")
+@click.option("--rota", default=None, help="Só esta rota (endpoint).")
+@click.option("--top", default=15, show_default=True)
+@click.option(
+    "--ordem",
+    type=click.Choice(["tottime", "cumtime"]),
+    default="tottime",
+    show_default=True,
+    help="tottime = tempo na própria função; cumtime = incluindo chamadas.",
+)
+def relatorio_perfis_command(pasta, rota, top, ordem):
+    """
+    Junta os .prof de cada rota e mostra onde o tempo vai: divisão entre
+    SQLite, Jinja e Python e as `top` funções mais caras (média por
+    requisição).
+    """
+    pasta = pasta or app.config["PERFIL_PASTA"]
+    por_rota = {}
+    for nome in sorted(os.listdir(pasta)) if os.path.isdir(pasta) else []:
+        if nome.endswith(".prof") and "__" in nome:
+            por_rota.setdefault(nome.split("__", 1)[0], []).append(
+                os.path.join(pasta, nome)
+            )
+    if rota:
+        por_rota = {rota: por_rota.get(rota, [])}
+    if not any(por_rota.values()):
+        raise SystemExit(f"Nenhum perfil encontrado em {pasta!r}.")
+
+    for nome_rota, arquivos in sorted(por_rota.items()):
+        estatisticas = pstats.Stats(*arquivos)
+        n = len(arquivos)
+        linhas = []
+        categorias = {"SQLite": 0.0, "Jinja": 0.0, "Python": 0.0}
+        for (arquivo, linha, funcao), (_, chamadas, tt, ct, _) in estatisticas.stats.items():
+            categorias[categoria_da_funcao(arquivo, funcao)] += tt
+            linhas.append((tt if ordem == "tottime" else ct, chamadas, tt, ct, arquivo, linha, funcao))
+
+        total = estatisticas.total_tt
+        print(f"== {nome_rota}: {n} requisição(ões), {total / n * 1000:.1f} ms em média")
+        print(
+            "   "
+            + ", ".join(
+                f"{cat} {tempo / total * 100 if total else 0:.0f}%"
+                for cat, tempo in categorias.items()
+            )
+        )
+        print(f"   {'tottime/req':>12} {'cumtime/req':>12} {'chamadas/req':>13}  função")
+        for _, chamadas, tt, ct, arquivo, linha, funcao in sorted(linhas, reverse=True)[:top]:
+            local = funcao if arquivo == "~" else f"{os.path.basename(arquivo)}:{linha}({funcao})"
+            print(
+                f"   {tt / n * 1000:10.2f}ms {ct / n * 1000:10.2f}ms {chamadas / n:13.1f}  {local}"
+            )
+        print()
+
+
+# ---------------------------------------------------------------------
+# Migrações de esquema versionadas
+# ---------------------------------------------------------------------
+#
+# Cada migração é (versão, descrição, passos). Um passo é um comando SQL
+# ou uma função que recebe a conexão. As migrações rodam uma única vez,
+# em ordem, e a versão aplicada fica registrada em schema_version.
+# Nunca altere uma migração já publicada: crie uma nova no fim da lista.
+
+MIGRACOES = [
+    (
+        1,
+        "índices de consultas por médico/data e por paciente",
+        (
+            # conflito de horário (agendaadmin) e horarios_disponiveis:
+            # medico_cpf + data com hora/status cobertos pelo índice
+            """
+            CREATE INDEX IF NOT EXISTS idx_consultas_medico_data
+                ON consultas (medico_cpf, data, hora, status)
+            """,
+            # agendapaciente (ORDER BY data, hora) e histórico do paciente
+            """
+            CREATE INDEX IF NOT EXISTS idx_consultas_paciente_data
+                ON consultas (paciente_cpf, data, hora)
+            """,
+        ),
+    ),
+    (
+        2,
+        "índice de notificações por usuário e leitura",
+        (
+            """
+            CREATE INDEX IF NOT EXISTS idx_notificacoes_cpf_lida
+                ON notificacoes (cpf, lida)
+            """,
+        ),
+    ),
+    (
+        3,
+        "índices para a listagem paginada do agendaadmin",
+        (
+            # keyset (data, hora, id) - o id vem de graça como rowid
+            """
+            CREATE INDEX IF NOT EXISTS idx_consultas_data_hora
+                ON consultas (data, hora)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_consultas_status_data_hora
+                ON consultas (status, data, hora)
+            """,
+            # sem ele o histórico do paciente (paciente_cpf + status) passa
+            # a preferir o índice por status, que varre todas as concluídas
+            """
+            CREATE INDEX IF NOT EXISTS idx_consultas_paciente_status
+                ON consultas (paciente_cpf, status, data, hora)
+            """,
+        ),
+    ),
+    (
+        4,
+        "busca textual (FTS5) de usuários e notas de consultas",
+        (
+            # remove_diacritics: "joao" encontra "João"; prefix: índices
+            # auxiliares para buscas por prefixo curtas ("jo*", "000*")
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS busca_usuarios USING fts5(
+                nome, cpf,
+                content='usuarios', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS usuarios_busca_ai
+            AFTER INSERT ON usuarios BEGIN
+                INSERT INTO busca_usuarios (rowid, nome, cpf)
+                VALUES (new.id, new.nome, new.CPF);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS usuarios_busca_ad
+            AFTER DELETE ON usuarios BEGIN
+                INSERT INTO busca_usuarios (busca_usuarios, rowid, nome, cpf)
+                VALUES ('delete', old.id, old.nome, old.CPF);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS usuarios_busca_au
+            AFTER UPDATE OF nome, CPF ON usuarios BEGIN
+                INSERT INTO busca_usuarios (busca_usuarios, rowid, nome, cpf)
+                VALUES ('delete', old.id, old.nome, old.CPF);
+                INSERT INTO busca_usuarios (rowid, nome, cpf)
+                VALUES (new.id, new.nome, new.CPF);
+            END
+            """,
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS busca_consultas USING fts5(
+                resumo, conclusao, observacoes,
+                content='consultas', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS consultas_busca_ai
+            AFTER INSERT ON consultas BEGIN
+                INSERT INTO busca_consultas (rowid, resumo, conclusao, observacoes)
+                VALUES (new.id, new.resumo, new.conclusao, new.observacoes);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS consultas_busca_ad
+            AFTER DELETE ON consultas BEGIN
+                INSERT INTO busca_consultas
+                    (busca_consultas, rowid, resumo, conclusao, observacoes)
+                VALUES ('delete', old.id, old.resumo, old.conclusao, old.observacoes);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS consultas_busca_au
+            AFTER UPDATE OF resumo, conclusao, observacoes ON consultas BEGIN
+                INSERT INTO busca_consultas
+                    (busca_consultas, rowid, resumo, conclusao, observacoes)
+                VALUES ('delete', old.id, old.resumo, old.conclusao, old.observacoes);
+                INSERT INTO busca_consultas (rowid, resumo, conclusao, observacoes)
+                VALUES (new.id, new.resumo, new.conclusao, new.observacoes);
+            END
+            """,
+            # indexa o que já existia antes da migração
+            "INSERT INTO busca_usuarios (busca_usuarios) VALUES ('rebuild')",
+            "INSERT INTO busca_consultas (busca_consultas) VALUES ('rebuild')",
+        ),
+    ),
+    (
+        5,
+        "contador de versão dos dados de referência (usuarios)",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS versoes_dados (
+                chave  TEXT PRIMARY KEY,
+                versao INTEGER NOT NULL DEFAULT 0
+            )
+            """,
+            "INSERT OR IGNORE INTO versoes_dados (chave, versao) VALUES ('usuarios', 0)",
+            # qualquer escrita em usuarios (rotas, CLI, sqlite3 na mão)
+            # invalida os caches de todos os workers
+            """
+            CREATE TRIGGER IF NOT EXISTS usuarios_versao_ai
+            AFTER INSERT ON usuarios BEGIN
+                UPDATE versoes_dados SET versao = versao + 1
+                 WHERE chave = 'usuarios';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS usuarios_versao_ad
+            AFTER DELETE ON usuarios BEGIN
+                UPDATE versoes_dados SET versao = versao + 1
+                 WHERE chave = 'usuarios';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS usuarios_versao_au
+            AFTER UPDATE ON usuarios BEGIN
+                UPDATE versoes_dados SET versao = versao + 1
+                 WHERE chave = 'usuarios';
+            END
+            """,
+        ),
+    ),
+    (
+        6,
+        "expediente configurável por médico",
+        (
+            # NULL = usa EXPEDIENTE_PADRAO
+            "ALTER TABLE usuarios ADD COLUMN expediente TEXT",
+        ),
+    ),
+    (
+        7,
+        "um único agendamento ativo por médico/data/hora",
+        (
+            # agendamentos duplicados antigos (feitos antes desta trava)
+            # impediriam o índice único: mantém o primeiro, dando
+            # preferência ao já aprovado, e cancela os demais
+            f"""
+            UPDATE consultas
+               SET status = '{STATUS_CANCELADA}'
+             WHERE status IN ('{STATUS_SOLICITADA}', '{STATUS_AGENDADA}')
+               AND id NOT IN (
+                   SELECT id FROM (
+                       SELECT id,
+                              ROW_NUMBER() OVER (
+                                  PARTITION BY medico_cpf, data, hora
+                                  ORDER BY status = '{STATUS_AGENDADA}' DESC, id
+                              ) AS ordem
+                         FROM consultas
+                        WHERE status IN ('{STATUS_SOLICITADA}', '{STATUS_AGENDADA}')
+                   )
+                    WHERE ordem = 1
+               )
+            """,
+            f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_consultas_horario_ativo
+                ON consultas (medico_cpf, data, hora)
+             WHERE status IN ('{STATUS_SOLICITADA}', '{STATUS_AGENDADA}')
+            """,
+        ),
+    ),
+    (
+        8,
+        "estado do rodízio de médicos por cargo",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS rodizio_cargos (
+                cargo         TEXT PRIMARY KEY,
+                ultimo_medico TEXT NOT NULL
+            )
+            """,
+        ),
+    ),
+    (
+        9,
+        "contador de notificações não lidas por usuário",
+        (
+            # qtd = não lidas; ultimo_id = notificação mais recente;
+            # versao muda a cada alteração (base dos ETags)
+            """
+            CREATE TABLE IF NOT EXISTS notificacoes_estado (
+                cpf       TEXT PRIMARY KEY,
+                qtd       INTEGER NOT NULL DEFAULT 0,
+                ultimo_id INTEGER NOT NULL DEFAULT 0,
+                versao    INTEGER NOT NULL DEFAULT 0
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS notificacoes_estado_ai
+            AFTER INSERT ON notificacoes BEGIN
+                INSERT INTO notificacoes_estado (cpf, qtd, ultimo_id, versao)
+                VALUES (new.cpf, new.lida = 0, new.id, 1)
+                ON CONFLICT (cpf) DO UPDATE
+                   SET qtd       = qtd + (new.lida = 0),
+                       ultimo_id = MAX(ultimo_id, new.id),
+                       versao    = versao + 1;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS notificacoes_estado_au
+            AFTER UPDATE OF lida ON notificacoes
+            WHEN old.lida IS NOT new.lida BEGIN
+                UPDATE notificacoes_estado
+                   SET qtd    = qtd - (old.lida = 0) + (new.lida = 0),
+                       versao = versao + 1
+                 WHERE cpf = new.cpf;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS notificacoes_estado_ad
+            AFTER DELETE ON notificacoes BEGIN
+                UPDATE notificacoes_estado
+                   SET qtd    = qtd - (old.lida = 0),
+                       versao = versao + 1
+                 WHERE cpf = old.cpf;
+            END
+            """,
+            """
+            INSERT OR REPLACE INTO notificacoes_estado (cpf, qtd, ultimo_id, versao)
+            SELECT cpf, SUM(lida = 0), MAX(id), 1
+              FROM notificacoes
+             GROUP BY cpf
+            """,
+        ),
+    ),
+    (
+        10,
+        "feed paginado por id e arquivo de notificações antigas",
+        (
+            """
+            CREATE INDEX IF NOT EXISTS idx_notificacoes_cpf_id
+                ON notificacoes (cpf, id)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS notificacoes_arquivo (
+                id          INTEGER PRIMARY KEY,
+                cpf         TEXT NOT NULL,
+                texto       TEXT NOT NULL,
+                lida        INTEGER NOT NULL,
+                data        TEXT NOT NULL,
+                arquivada_em TEXT NOT NULL
+            )
+            """,
+        ),
+    ),
+    (
+        11,
+        "versões com data de alteração (usuarios e consultas)",
+        (
+            "ALTER TABLE versoes_dados ADD COLUMN alterada_em TEXT",
+            "UPDATE versoes_dados SET alterada_em = strftime('%Y-%m-%d %H:%M:%S', 'now')",
+            """
+            INSERT OR IGNORE INTO versoes_dados (chave, versao, alterada_em)
+            VALUES ('consultas', 0, strftime('%Y-%m-%d %H:%M:%S', 'now'))
+            """,
+            # os gatilhos de usuarios passam a registrar também a data
+            "DROP TRIGGER IF EXISTS usuarios_versao_ai",
+            "DROP TRIGGER IF EXISTS usuarios_versao_ad",
+            "DROP TRIGGER IF EXISTS usuarios_versao_au",
+            *(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS {tabela}_versao_{sufixo}
+                AFTER {evento} ON {tabela} BEGIN
+                    UPDATE versoes_dados
+                       SET versao = versao + 1,
+                           alterada_em = strftime('%Y-%m-%d %H:%M:%S', 'now')
+                     WHERE chave = '{tabela}';
+                END
+                """
+                for tabela in ("usuarios", "consultas")
+                for sufixo, evento in (("ai", "INSERT"), ("ad", "DELETE"), ("au", "UPDATE"))
+            ),
+        ),
+    ),
+]
+
+
+def versao_esquema(db) -> int:
+    """Retorna a última versão de migração aplicada (0 se nenhuma)."""
+    row = db.execute("SELECT MAX(versao) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def aplicar_migracoes(db):
+    """
+    Aplica, em ordem, as migrações ainda não registradas.
+
+    Cada migração roda em uma transação própria (BEGIN IMMEDIATE), então
+    dois processos subindo ao mesmo tempo não aplicam a mesma versão duas
+    vezes: o segundo espera o lock e relê a versão antes de prosseguir.
+    """
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            versao      INTEGER PRIMARY KEY,
+            descricao   TEXT NOT NULL,
+            aplicada_em TEXT NOT NULL
+        );
+        """
+    )
+    db.commit()
+
+    for versao, descricao, passos in MIGRACOES:
+        if versao <= versao_esquema(db):
+            continue
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if versao <= versao_esquema(db):
+                db.rollback()
+                continue
+
+            for passo in passos:
+                if callable(passo):
+                    passo(db)
+                else:
+                    db.execute(passo)
+
+            db.execute(
+                "INSERT INTO schema_version (versao, descricao, aplicada_em) "
+                "VALUES (?, ?, ?)",
+                (versao, descricao, datetime.now().strftime("%Y-%m-%d %H:%M")),
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+
+# Consultas "quentes" verificadas por `flask verificar-indices`. Os
+# parâmetros são só exemplos: o plano não depende dos valores.
+CONSULTAS_INDEXADAS = [
+    (
+        "agendaadmin: conflito de horário",
+        """
+        SELECT 1 FROM consultas
+         WHERE medico_cpf = ? AND data = ? AND hora = ? AND status != ?
+        """,
+        ("00000000002", "2025-01-01", "08:00", STATUS_CANCELADA),
+    ),
+    (
+        "horarios_disponiveis",
+        """
+        SELECT hora FROM consultas
+         WHERE medico_cpf = ? AND data = ? AND status != ?
+        """,
+        ("00000000002", "2025-01-01", STATUS_CANCELADA),
+    ),
+    (
+        "agendapaciente",
+        """
+        SELECT * FROM consultas
+         WHERE paciente_cpf = ?
+         ORDER BY data, hora
+        """,
+        ("11111111111",),
+    ),
+    (
+        "agendamedico: histórico do paciente",
+        """
+        SELECT * FROM consultas
+         WHERE paciente_cpf = ? AND status = ?
+         ORDER BY data DESC, hora DESC
+        """,
+        ("11111111111", STATUS_CONCLUIDA),
+    ),
+    (
+        "agendaadmin: página seguinte (keyset)",
+        """
+        SELECT c.id FROM consultas c
+         WHERE (c.data, c.hora, c.id) > (?, ?, ?)
+         ORDER BY c.data, c.hora, c.id
+         LIMIT 51
+        """,
+        ("2025-01-01", "08:00", 1),
+    ),
+    (
+        "agendaadmin: filtro por status (keyset)",
+        """
+        SELECT c.id FROM consultas c
+         WHERE c.status = ? AND (c.data, c.hora, c.id) > (?, ?, ?)
+         ORDER BY c.data, c.hora, c.id
+         LIMIT 51
+        """,
+        (STATUS_SOLICITADA, "2025-01-01", "08:00", 1),
+    ),
+    (
+        "atribuição: carga dos médicos na janela",
+        """
+        SELECT medico_cpf, COUNT(*) FROM consultas
+         WHERE medico_cpf IN (?, ?) AND data BETWEEN ? AND ? AND status IN (?, ?)
+         GROUP BY medico_cpf
+        """,
+        ("00000000002", "00000000003", "2025-01-01", "2025-01-29",
+         STATUS_SOLICITADA, STATUS_AGENDADA),
+    ),
+    (
+        "notificacoes_count",
+        "SELECT COUNT(*) FROM notificacoes WHERE cpf = ? AND lida = 0",
+        ("11111111111",),
+    ),
+]
+
+
+@app.cli.command("verificar-indices")
+def verificar_indices_command():
+    """Mostra o EXPLAIN QUERY PLAN das consultas quentes."""
+    init_db()
+    db = get_db()
+    sem_indice = 0
+
+    for nome, sql, params in CONSULTAS_INDEXADAS:
+        plano = db.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        print(f"== {nome}")
+        for linha in plano:
+            detalhe = linha["detail"]
+            print(f"   {detalhe}")
+            if detalhe.startswith("SCAN") and "INDEX" not in detalhe:
+                sem_indice += 1
+
+    if sem_indice:
+        raise SystemExit(f"{sem_indice} consulta(s) fazendo varredura completa.")
+    print(f"OK: versão do esquema {versao_esquema(db)}, todas usam índice.")
+
+
+def inicializar_usuarios_fixos():
+    """
+    Cria alguns usuários padrão (admin, médicos e um paciente),
+    só se ainda não existirem.
+    """
+    db = get_db()
+
+    usuarios_fixos = [
+        {
+            "nome": "Administrador",
+            "CPF": "00000000001",
+            "senha": "admin",
+            "tipo": TIPO_ADMIN,
+            "cargo": "Administrador",
+        },
+        {
+            "nome": "Dr. Carlos Silva",
+            "CPF": "00000000002",
+            "senha": "medico123",
+            "tipo": TIPO_MEDICO,
+            "cargo": "Clínico Geral",
+        },
+        {
+            "nome": "Dr. Evandro",
+            "CPF": "00000000003",
+            "senha": "medico123",
+            "tipo": TIPO_MEDICO,
+            "cargo": "Nutricionista",
+        },
+        {
+            "nome": "Dra. Sonia",
+            "CPF": "00000000004",
+            "senha": "medico123",
+            "tipo": TIPO_MEDICO,
+            "cargo": "Pediatra",
+        },
+        {
+            "nome": "Cristiano",
+            "CPF": "11111111111",
+            "senha": "1234",
+            "tipo": TIPO_PACIENTE,
+            "cargo": None,
+        },
+    ]
+
+    # CPF é UNIQUE: os que já existem são ignorados, sem SELECT antes
+    db.executemany(
+        """
+        INSERT OR IGNORE INTO usuarios (CPF, nome, senha, tipo, cargo)
+        VALUES (:CPF, :nome, :senha, :tipo, :cargo)
+        """,
+        usuarios_fixos,
+    )
+    db.commit()
+
+
+def notificar(db, cpf: str, texto: str):
+    """
+    Registra uma notificação dentro da transação aberta por quem chama:
+    ela é gravada no mesmo commit da mudança que a originou (um fsync só,
+    e nunca uma mudança sem a notificação correspondente). Depois do
+    commit, chame canal_notificacoes.acordar() para o SSE entregar na hora.
+
+    Com NOTIFICACOES_WRITE_BEHIND ligado, fica pendente na conexão e só vai
+    para a fila de gravação em lote quando quem chama fizer o commit; num
+    rollback é descartada junto com a mudança.
+    """
+    agora = datetime.now().strftime("%Y-%m-%d %H:%M")
+    if app.config["NOTIFICACOES_WRITE_BEHIND"]:
+        adiar_notificacoes(db, [(cpf, texto, agora)])
+        return
+    db.execute(
+        "INSERT INTO notificacoes (cpf, texto, lida, data) VALUES (?, ?, 0, ?)",
+        (cpf, texto, agora),
+    )
+
+
+def notificar_varios(db, notificacoes):
+    """
+    Como notificar(), para vários (cpf, texto) de uma vez: um único
+    executemany dentro da transação de quem chama.
+    """
+    agora = datetime.now().strftime("%Y-%m-%d %H:%M")
+    itens = [(cpf, texto, agora) for cpf, texto in notificacoes]
+    if app.config["NOTIFICACOES_WRITE_BEHIND"]:
+        adiar_notificacoes(db, itens)
+        return
+    db.executemany(
+        "INSERT INTO notificacoes (cpf, texto, lida, data) VALUES (?, ?, 0, ?)",
+        itens,
+    )
+
+
+def adiar_notificacoes(db, itens):
+    """Guarda (cpf, texto, data) na conexão até o próximo commit."""
+    if db.notificacoes_pendentes is None:
+        db.notificacoes_pendentes = []
+    db.notificacoes_pendentes.extend(itens)
+
+
+def enfileirar_notificacoes(db, itens):
+    """
+    Chamado por ConexaoRastreada.commit() com as notificações adiadas. As
+    que a fila recusar (cheia) são gravadas na hora, num commit próprio: a
+    mudança que as originou já está gravada e não pode mais falhar por isso.
+    """
+    recusadas = [item for item in itens if not fila_notificacoes.enfileirar(*item)]
+    if not recusadas:
+        return
+    try:
+        db.executemany(
+            "INSERT INTO notificacoes (cpf, texto, lida, data) VALUES (?, ?, 0, ?)",
+            recusadas,
+        )
+        db.commit()
+    except sqlite3.Error:
+        if db.in_transaction:
+            db.rollback()
+        app.logger.exception("Falha ao gravar notificações recusadas pela fila")
+
+
+def adicionar_notificacao(cpf: str, texto: str):
+    """Insere uma notificação simples para um usuário (com commit próprio)."""
+    db = get_db()
+    notificar(db, cpf, texto)
+    db.commit()
+    canal_notificacoes.acordar()
+
+
+class FilaNotificacoes:
+    """
+    Fila de gravação em lote (write-behind) das notificações, por worker.
+
+    notificar() só enfileira, e só depois do commit da mudança que a
+    originou; uma thread grava a fila com executemany num único commit a
+    cada NOTIFICACOES_FLUSH_INTERVALO segundos, ou antes disso se juntar
+    NOTIFICACOES_FLUSH_TAMANHO itens. Com a fila cheia
+    (NOTIFICACOES_FILA_MAXIMA) enfileirar() recusa e a notificação é
+    gravada na hora. O que sobrar na fila é gravado ao sair do processo.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._itens = []
+        self._thread = None
+        self._pid = None
+        self._metricas = {
+            "lotes": 0,
+            "itens": 0,
+            "maior_lote": 0,
+            "ultimo_lote": 0,
+            "recusadas": 0,
+        }
+
+    def enfileirar(self, cpf: str, texto: str, data: str) -> bool:
+        with self._cond:
+            if len(self._itens) >= app.config["NOTIFICACOES_FILA_MAXIMA"]:
+                self._metricas["recusadas"] += 1
+                return False
+            self._garantir_thread()
+            self._itens.append((cpf, texto, data))
+            if len(self._itens) >= app.config["NOTIFICACOES_FLUSH_TAMANHO"]:
+                self._cond.notify()
+        return True
+
+    def metricas(self) -> dict:
+        with self._cond:
+            m = dict(self._metricas, pendentes=len(self._itens))
+        m["media_lote"] = round(m["itens"] / m["lotes"], 1) if m["lotes"] else 0
+        return m
+
+    def gravar(self):
+        """Grava agora tudo o que está na fila (um commit)."""
+        with self._cond:
+            lote, self._itens = self._itens, []
+        if not lote:
+            return
+
+        db = conexoes.obter(app.config)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(
+                "INSERT INTO notificacoes (cpf, texto, lida, data) VALUES (?, ?, 0, ?)",
+                lote,
+            )
+            db.commit()
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            # devolve para a próxima tentativa, sem passar do limite
+            with self._cond:
+                espaco = app.config["NOTIFICACOES_FILA_MAXIMA"] - len(self._itens)
+                self._itens[:0] = lote[:max(espaco, 0)]
+            raise
+
+        with self._cond:
+            self._metricas["lotes"] += 1
+            self._metricas["itens"] += len(lote)
+            self._metricas["ultimo_lote"] = len(lote)
+            self._metricas["maior_lote"] = max(self._metricas["maior_lote"], len(lote))
+        canal_notificacoes.acordar()
+
+    def _garantir_thread(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        if self._pid is not None and self._pid != os.getpid():
+            # fila herdada do pai num fork: pertence ao pai
+            self._itens = []
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._gravar_periodicamente, name="fila-notificacoes", daemon=True
+        )
+        self._thread.start()
+
+    def _gravar_periodicamente(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: len(self._itens) >= app.config["NOTIFICACOES_FLUSH_TAMANHO"],
+                    timeout=app.config["NOTIFICACOES_FLUSH_INTERVALO"],
+                )
+            try:
+                self.gravar()
+            except sqlite3.Error:
+                app.logger.exception("Falha ao gravar lote de notificações")
+
+
+fila_notificacoes = FilaNotificacoes()
+
+
+@atexit.register
+def _gravar_fila_notificacoes():
+    if fila_notificacoes._pid == os.getpid():
+        try:
+            fila_notificacoes.gravar()
+        except sqlite3.Error:
+            app.logger.exception("Notificações pendentes perdidas ao encerrar")
+
+
+# Limite de parâmetros por IN (...) - fica bem abaixo do limite do SQLite
+# (999 em versões antigas), então funciona em qualquer build.
+TAMANHO_LOTE_IN = 500
+
+
+def buscar_historicos(db, pacientes_cpf, mapa_nomes) -> dict:
+    """
+    Busca o histórico de consultas concluídas de vários pacientes de uma
+    vez, agrupado por CPF (mais recente primeiro).
+
+    Substitui uma consulta por linha da agenda por uma consulta por lote
+    de até TAMANHO_LOTE_IN pacientes distintos.
+    """
+    historicos = {cpf: [] for cpf in pacientes_cpf}
+    cpfs = sorted(historicos)
+
+    for inicio in range(0, len(cpfs), TAMANHO_LOTE_IN):
+        lote = cpfs[inicio:inicio + TAMANHO_LOTE_IN]
+        marcadores = ", ".join("?" * len(lote))
+        cur = db.execute(
+            f"""
+            SELECT paciente_cpf, medico_cpf, data, hora, tipo, status,
+                   resumo, conclusao
+              FROM consultas
+             WHERE paciente_cpf IN ({marcadores})
+               AND status = ?
+             ORDER BY paciente_cpf, data DESC, hora DESC
+            """,
+            (*lote, STATUS_CONCLUIDA),
+        )
+        for h in cur:
+            historicos[h["paciente_cpf"]].append(
+                {
+                    "data": h["data"],
+                    "hora": h["hora"],
+                    "tipo": h["tipo"],
+                    "status": h["status"],
+                    "medico_nome": mapa_nomes.get(
+                        h["medico_cpf"], h["medico_cpf"]
+                    ),
+                    "resumo": h["resumo"],
+                    "conclusao": h["conclusao"],
+                }
+            )
+
+    return historicos
+
+
+# ---------------------------------------------------------------------
+# Cache de dados de referência (nomes, médicos, cargos)
+# ---------------------------------------------------------------------
+
+def versao_dados(db, chave: str) -> int:
+    """Lê o contador de versão de um conjunto de dados (busca por PK)."""
+    row = db.execute(
+        "SELECT versao FROM versoes_dados WHERE chave = ?", (chave,)
+    ).fetchone()
+    return row[0] if row else 0
+
+
+class CacheReferencia:
+    """
+    Cache, por processo, dos dados de usuarios que quase nunca mudam:
+    nomes por CPF, médicos (por cargo), lista de cargos e pacientes.
+
+    A validade é conferida a cada uso comparando a versão guardada com
+    versoes_dados['usuarios'] (incrementada por triggers em qualquer
+    escrita na tabela). Assim cada worker do gunicorn percebe sozinho que
+    outro worker alterou um usuário e só recarrega quando necessário.
+
+    Os dados devolvidos são compartilhados entre requisições: não altere.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dados = None
+
+    def obter(self, db) -> dict:
+        versao = versao_dados(db, "usuarios")
+        # uma leitura só de self._dados: a versão conferida é a dos dados
+        # devolvidos, mesmo que outra thread troque o cache no meio
+        dados = self._dados
+        if dados is not None and dados["versao"] == versao:
+            return dados
+
+        with self._lock:
+            if self._dados is None or self._dados["versao"] != versao:
+                self._dados = dict(self._carregar(db), versao=versao)
+            return self._dados
+
+    def invalidar(self):
+        with self._lock:
+            self._dados = None
+
+    @staticmethod
+    def _carregar(db) -> dict:
+        mapa_nomes = {}
+        medicos = []
+        pacientes = []
+
+        cur = db.execute(
+            "SELECT CPF, nome, tipo, cargo, expediente FROM usuarios ORDER BY id"
+        )
+        for r in cur:
+            mapa_nomes[r["CPF"]] = r["nome"]
+            if r["tipo"] == TIPO_MEDICO:
+                medicos.append(dict(r))
+            elif r["tipo"] == TIPO_PACIENTE:
+                pacientes.append(dict(r))
+
+        medicos_por_cargo = {}
+        for m in medicos:
+            m["mascara"] = mascara_expediente(m["expediente"])
+            if m["cargo"]:
+                medicos_por_cargo.setdefault(m["cargo"], []).append(m)
+
+        return {
+            "mapa_nomes": mapa_nomes,
+            "medicos": medicos,
+            "medicos_por_cpf": {m["CPF"]: m for m in medicos},
+            "medicos_por_cargo": medicos_por_cargo,
+            "cargos": sorted(medicos_por_cargo),
+            "pacientes": pacientes,
+        }
+
+
+cache_referencia = CacheReferencia()
+
+
+def dados_referencia() -> dict:
+    """Dados de referência atuais; confere a versão uma vez por requisição."""
+    if "referencia" not in g:
+        g.referencia = cache_referencia.obter(get_db())
+        # já conferida: os fragmentos {% cache %} usam a mesma versão
+        g.setdefault("versoes_dados", {})["usuarios"] = g.referencia["versao"]
+    return g.referencia
+
+
+# ---------------------------------------------------------------------
+# Templates: cache de bytecode e de fragmentos
+# ---------------------------------------------------------------------
+#
+# Fragmentos: {% cache "nome", chave1, chave2 %}...{% endcache %} guarda o
+# HTML do bloco, indexado pelo nome e pelas chaves. As chaves precisam
+# mudar sempre que o conteúdo mudaria: a versão dos dados de que o bloco
+# depende (versao_dados("usuarios"), lida antes dos dados) ou os próprios
+# valores da linha.
+
+class CacheFragmentos:
+    """LRU de HTML renderizado, compartilhado pelas threads do worker."""
+
+    def __init__(self):
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+        self._metricas = {"acertos": 0, "faltas": 0, "descartes": 0}
+
+    def obter(self, chave, gerar):
+        if not app.config["FRAGMENTOS_ATIVO"]:
+            return gerar()
+
+        with self._lock:
+            html = self._itens.get(chave)
+            if html is not None:
+                self._itens.move_to_end(chave)
+                self._metricas["acertos"] += 1
+                return html
+            self._metricas["faltas"] += 1
+
+        html = gerar()
+        with self._lock:
+            self._itens[chave] = html
+            self._itens.move_to_end(chave)
+            while len(self._itens) > app.config["FRAGMENTOS_MAXIMO"]:
+                self._itens.popitem(last=False)
+                self._metricas["descartes"] += 1
+        return html
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return dict(self._metricas, itens=len(self._itens))
+
+
+cache_fragmentos = CacheFragmentos()
+
+
+class ExtensaoFragmentos(Extension):
+    """Tag {% cache nome, chaves... %} ... {% endcache %}."""
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        chaves = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            chaves.append(parser.parse_expression())
+        corpo = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_renderizar", [nodes.Tuple(chaves, "load")]),
+            [],
+            [],
+            corpo,
+        ).set_lineno(lineno)
+
+    def _renderizar(self, chave, caller):
+        # as versões são por banco: o caminho entra na chave
+        return cache_fragmentos.obter((app.config["DATABASE"],) + chave, caller)
+
+
+@app.template_global("versao_dados")
+def versao_dados_requisicao(chave: str) -> int:
+    """versao_dados() para os templates, lida uma vez por requisição."""
+    versoes = g.setdefault("versoes_dados", {})
+    if chave not in versoes:
+        versoes[chave] = versao_dados(get_db(), chave)
+    return versoes[chave]
+
+
+def configurar_cache_bytecode():
+    """
+    Liga o cache de bytecode dos templates em JINJA_CACHE_PASTA (vazio
+    desliga). Chamada por create_app, com a configuração já final: só
+    importar o módulo não cria nada em disco.
+    """
+    pasta = app.config["JINJA_CACHE_PASTA"]
+    atual = app.jinja_env.bytecode_cache
+    if not pasta:
+        app.jinja_env.bytecode_cache = None
+    elif atual is None or atual.directory != pasta:
+        os.makedirs(pasta, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(pasta)
+
+
+app.jinja_env.add_extension(ExtensaoFragmentos)
+
+
+# ---------------------------------------------------------------------
+# Arquivos estáticos versionados (flask gerar-estaticos)
+# ---------------------------------------------------------------------
+#
+# O build copia cada arquivo de static/ para ESTATICOS_PASTA com o hash do
+# conteúdo no nome (style.3fa9c1d2e4.css), mais as versões .gz/.br, e
+# grava manifest.json com o mapa nome original -> nome versionado. Como o
+# nome muda junto com o conteúdo, o navegador pode guardá-los por um ano
+# sem revalidar. Sem manifesto (build não rodou), url_estatico cai no
+# url_for("static") de sempre.
+
+EXTENSOES_COMPRIMIVEIS = {".css", ".js", ".svg", ".html", ".json", ".txt", ".map"}
+CACHE_IMUTAVEL = "public, max-age=31536000, immutable"
+
+_manifesto_estaticos = None
+
+
+def manifesto_estaticos() -> dict:
+    """Mapa nome original -> nome versionado, lido uma vez por processo."""
+    global _manifesto_estaticos
+    if _manifesto_estaticos is None:
+        caminho = os.path.join(app.config["ESTATICOS_PASTA"], "manifest.json")
+        try:
+            with open(caminho, encoding="utf-8") as f:
+                _manifesto_estaticos = json.load(f)
+        except FileNotFoundError:
+            _manifesto_estaticos = {}
+    return _manifesto_estaticos
+
+
+@app.template_global()
+def url_estatico(filename: str) -> str:
+    """url_for("static", filename=...) com o nome versionado, se houver."""
+    versionado = manifesto_estaticos().get(filename)
+    if versionado is None:
+        return url_for("static", filename=filename)
+    return url_for("estatico_versionado", nome=versionado)
+
+
+@app.route("/estaticos/<path:nome>")
+def estatico_versionado(nome):
+    """
+    Serve um arquivo versionado, já comprimido (br ou gzip) se o cliente
+    aceitar e houver a variante, com cache imutável de um ano.
+    """
+    pasta = app.config["ESTATICOS_PASTA"]
+    caminho = safe_join(pasta, nome)
+    if caminho is None or not os.path.isfile(caminho):
+        abort(404)
+
+    tipo = mimetypes.guess_type(nome)[0] or "application/octet-stream"
+    codificacao = None
+    arquivo = nome
+    for cod, extensao in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[cod] and os.path.isfile(caminho + extensao):
+            codificacao, arquivo = cod, nome + extensao
+            break
+
+    resposta = send_from_directory(pasta, arquivo, mimetype=tipo, max_age=31536000)
+    if codificacao:
+        resposta.headers["Content-Encoding"] = codificacao
+    resposta.vary.add("Accept-Encoding")
+    resposta.headers["Cache-Control"] = CACHE_IMUTAVEL
+    return resposta
+
+
+def _gravar_se_menor(destino: str, original: bytes, comprimido: bytes) -> bool:
+    # só vale a pena se ganhar pelo menos 5% (PNG/JPG já vêm comprimidos)
+    if len(comprimido) > len(original) * 0.95:
+        return False
+    with open(destino, "wb") as f:
+        f.write(comprimido)
+    return True
+
+
+@app.cli.command("gerar-estaticos")
+@click.option(
+    "--limpar",
+    is_flag=True,
+    help="Apaga os arquivos de builds anteriores (por padrão ficam, para "
+    "páginas antigas ainda em cache durante o deploy).",
+)
+def gerar_estaticos_command(limpar):
+    """
+    Gera em ESTATICOS_PASTA as cópias versionadas (hash do conteúdo no
+    nome) dos arquivos de static/, as variantes .gz e .br (com o pacote
+    brotli instalado) e o manifest.json usado por url_estatico().
+    """
+    import shutil
+
+    origem = app.static_folder
+    destino = app.config["ESTATICOS_PASTA"]
+    if limpar and os.path.isdir(destino):
+        shutil.rmtree(destino)
+    os.makedirs(destino, exist_ok=True)
+
+    manifesto = {}
+    total = comprimido = 0
+    for raiz, pastas, arquivos in os.walk(origem):
+        # não reprocessa a própria saída
+        pastas[:] = [p for p in pastas if os.path.join(raiz, p) != destino]
+        for nome in sorted(arquivos):
+            caminho = os.path.join(raiz, nome)
+            relativo = os.path.relpath(caminho, origem).replace(os.sep, "/")
+            with open(caminho, "rb") as f:
+                conteudo = f.read()
+
+            base, extensao = os.path.splitext(relativo)
+            impressao = hashlib.sha256(conteudo).hexdigest()[:10]
+            versionado = f"{base}.{impressao}{extensao}"
+            alvo = os.path.join(destino, versionado)
+            os.makedirs(os.path.dirname(alvo), exist_ok=True)
+            with open(alvo, "wb") as f:
+                f.write(conteudo)
+            manifesto[relativo] = versionado
+            total += len(conteudo)
+
+            variantes = []
+            if extensao.lower() in EXTENSOES_COMPRIMIVEIS:
+                if _gravar_se_menor(
+                    alvo + ".gz", conteudo, gzip.compress(conteudo, 9, mtime=0)
+                ):
+                    variantes.append("gz")
+                if brotli is not None and _gravar_se_menor(
+                    alvo + ".br", conteudo, brotli.compress(conteudo, quality=11)
+                ):
+                    variantes.append("br")
+            if variantes:
+                comprimido += 1
+            print(f"  {relativo} -> {versionado} {' '.join(variantes)}".rstrip())
+
+    with open(os.path.join(destino, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifesto, f, indent=2, sort_keys=True)
+
+    global _manifesto_estaticos
+    _manifesto_estaticos = None
+    print(
+        f"{len(manifesto)} arquivo(s), {total / 1024:.0f} KiB, {comprimido} "
+        f"com variante comprimida{'' if brotli else ' (sem brotli: só .gz)'}."
+    )
+
+
+# ---------------------------------------------------------------------
+# GET condicional das páginas de listagem (ETag / Last-Modified)
+# ---------------------------------------------------------------------
+#
+# As páginas dependem só das tabelas listadas em cada rota, cujas versões
+# (versoes_dados) os gatilhos mantêm. Se nenhuma mudou desde a última
+# visita do mesmo usuário, com os mesmos filtros, responde 304 sem rodar
+# as consultas nem renderizar o template.
+
+def _versao_codigo() -> str:
+    """Muda a cada deploy (app.py ou templates alterados)."""
+    arquivos = [os.path.join(app.root_path, "app.py")]
+    pasta = os.path.join(app.root_path, app.template_folder)
+    arquivos += [os.path.join(pasta, nome) for nome in sorted(os.listdir(pasta))]
+    return str(max(int(os.path.getmtime(a)) for a in arquivos))
+
+
+VERSAO_CODIGO = _versao_codigo()
+
+
+def validadores_pagina(*chaves) -> tuple:
+    """
+    (etag, alterada_em) da página atual: a ETag combina as versões das
+    `chaves` com o usuário da sessão, a querystring e VERSAO_CODIGO;
+    alterada_em é a alteração mais recente entre as chaves (UTC).
+    """
+    marcadores = ", ".join("?" * len(chaves))
+    linhas = get_db().execute(
+        f"SELECT chave, versao, alterada_em FROM versoes_dados "
+        f"WHERE chave IN ({marcadores}) ORDER BY chave",
+        chaves,
+    ).fetchall()
+
+    partes = [
+        VERSAO_CODIGO,
+        session.get("cpf") or "",
+        session.get("tipo") or "",
+        request.full_path,
+    ]
+    partes += [f"{r['chave']}={r['versao']}" for r in linhas]
+    etag = hashlib.sha1("|".join(partes).encode()).hexdigest()[:24]
+
+    datas = [r["alterada_em"] for r in linhas if r["alterada_em"]]
+    alterada_em = (
+        datetime.strptime(max(datas), "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+        if datas
+        else None
+    )
+    return etag, alterada_em
+
+
+def pagina_nao_modificada(etag: str, alterada_em):
+    """
+    Resposta 304 se o navegador já tem esta versão da página, senão None.
+    If-None-Match tem precedência; If-Modified-Since só vale sem ele.
+    """
+    if "_flashes" in session:
+        # há mensagem para mostrar: a página precisa ser gerada (e a view a
+        # tira da sessão ao passá-la ao template, então só esta resposta
+        # deixa de ser condicional)
+        return None
+
+    if request.if_none_match:
+        atual = request.if_none_match.contains_weak(etag)
+    else:
+        # Last-Modified tem resolução de segundos: outra mudança no mesmo
+        # segundo de alterada_em não mudaria a data, então só responde 304
+        # se a data guardada pelo navegador for posterior a ela
+        atual = bool(
+            alterada_em
+            and request.if_modified_since
+            and alterada_em < request.if_modified_since
+        )
+    if not atual:
+        return None
+    return com_validadores(app.response_class(status=304), etag, alterada_em)
+
+
+def com_validadores(resposta, etag: str, alterada_em):
+    """ETag + Last-Modified; a página varia com a sessão (Cookie)."""
+    com_etag(resposta, etag)
+    if alterada_em:
+        resposta.last_modified = alterada_em
+    resposta.vary.add("Cookie")
+    return resposta
+
+
+# ---------------------------------------------------------------------
+# Páginas em streaming
+# ---------------------------------------------------------------------
+#
+# As agendas podem ter dezenas de milhares de linhas. Em vez de
+# fetchall() + render_template(), as rotas passam ao template um gerador
+# que lê o cursor em lotes (fetchmany) e completa cada lote só quando o
+# template chega nele, e o HTML sai aos pedaços (Template.generate). A
+# memória fica limitada a um lote e o início da página sai antes de a
+# primeira linha ser lida.
+#
+# Consequências: erros no meio da tabela não viram mais página 500 (o
+# status já foi enviado), e essas respostas não têm Server-Timing (os
+# cabeçalhos saem antes do SQL). O log de SQL lento e o perfil cProfile
+# são finalizados no fechamento da resposta e cobrem a geração inteira.
+#
+# O ritmo da geração é o do cliente. Por isso nenhuma leitura fica aberta
+# entre um lote e outro: uma transação (ou um SELECT pela metade) mantida
+# durante o download de um cliente lento impediria o checkpoint do WAL
+# enquanto durasse. Cada lote é um SELECT próprio (consultas_em_lotes) e
+# a ETag é lida antes, em separado; se alguém gravar no meio, a página
+# pode sair mais nova que a ETag, nunca mais velha - a próxima requisição
+# condicional só recebe 200 em vez de 304.
+
+LOTE_STREAMING = 200         # linhas por SELECT
+BLOCO_STREAMING = 16 * 1024  # caracteres de HTML por pedaço enviado
+
+
+def consultas_em_lotes(db, colunas: str, condicoes: list, params,
+                       tamanho: int = LOTE_STREAMING):
+    """
+    Consultas que atendem `condicoes` (SQL sobre a tabela consultas), em
+    lotes de até `tamanho` dicts na ordem (data, hora, id). Cada lote é um
+    SELECT que continua depois da última linha do anterior (keyset, como a
+    paginação do agendaadmin); `colunas` precisa incluir data, hora e id.
+    """
+    posicao = ()
+    while True:
+        todas = list(condicoes)
+        if posicao:
+            todas.append("(data, hora, id) > (?, ?, ?)")
+        onde = "WHERE " + " AND ".join(todas) if todas else ""
+        lote = [
+            dict(r)
+            for r in db.execute(
+                f"""
+                SELECT {colunas} FROM consultas
+                 {onde}
+                 ORDER BY data, hora, id
+                 LIMIT ?
+                """,
+                (*params, *posicao, tamanho),
+            ).fetchall()
+        ]
+        if lote:
+            yield lote
+        if len(lote) < tamanho:
+            return
+        posicao = (lote[-1]["data"], lote[-1]["hora"], lote[-1]["id"])
+
+
+def agrupar_pedacos(pedacos, tamanho: int = BLOCO_STREAMING):
+    """
+    O Jinja gera um pedaço por trecho do template (às vezes poucos bytes);
+    juntamos em blocos de ~`tamanho` para não mandar um chunk HTTP (e um
+    flush do gzip) por célula da tabela.
+    """
+    buffer = []
+    total = 0
+    for pedaco in pedacos:
+        buffer.append(pedaco)
+        total += len(pedaco)
+        if total >= tamanho:
+            yield "".join(buffer)
+            buffer = []
+            total = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def resposta_em_streaming(gerador, **kwargs):
+    """
+    Response cujo corpo é `gerador`, consumido no contexto da requisição
+    (stream_with_context). A conexão de g.db - com o rastro de SQL - só é
+    devolvida quando o corpo termina ou o servidor fecha a resposta, e não
+    quando a view retorna.
+    """
+    g.em_streaming = True
+    estado = g._get_current_object()
+
+    def gerar():
+        try:
+            yield from gerador
+        finally:
+            devolver_db(estado.pop("db", None))
+
+    resposta = app.response_class(stream_with_context(gerar()), **kwargs)
+    # corpo que nunca começou a ser lido (HEAD, cliente que desconectou)
+    resposta.call_on_close(lambda: devolver_db(estado.pop("db", None)))
+    return resposta
+
+
+def pagina_em_streaming(template: str, **contexto):
+    """
+    Como render_template, mas devolve uma Response enviada aos pedaços.
+
+    O cookie de sessão é gravado quando a view retorna, antes de o template
+    ser gerado: o que o template mudar na sessão se perde. Por isso
+    get_flashed_messages() não funciona dentro dele - a view lê as
+    mensagens antes e as passa no contexto (`mensagens`).
+    """
+    app.update_template_context(contexto)
+    modelo = app.jinja_env.get_or_select_template(template)
+    return resposta_em_streaming(
+        agrupar_pedacos(modelo.generate(contexto)), mimetype="text/html"
+    )
+
+
+# ---------------------------------------------------------------------
+# Disponibilidade de horários
+# ---------------------------------------------------------------------
+#
+# O dia de cada médico é um bitmap (int): o bit i representa o horário que
+# começa em i * DURACAO_SLOT_MINUTOS minutos depois da meia-noite. Horários
+# livres = expediente & ~ocupados, calculado para vários médicos e datas a
+# partir de uma única leitura no banco.
+
+def minutos_do_dia(hora: str) -> int:
+    """'HH:MM' -> minutos desde a meia-noite (ValueError se inválido)."""
+    h, m = hora.strip().split(":")
+    total = int(h) * 60 + int(m)
+    if not 0 <= total <= 24 * 60:
+        raise ValueError(hora)
+    return total
+
+
+def normalizar_horario(data: str, hora: str) -> tuple:
+    """
+    Valida data ("YYYY-MM-DD") e hora ("HH:MM") de uma reserva e devolve as
+    duas no formato canônico. A hora precisa cair no início de um horário
+    da grade (múltiplo de DURACAO_SLOT_MINUTOS). ValueError se inválido.
+    """
+    data = datetime.strptime(data.strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+    minutos = minutos_do_dia(hora)
+    if minutos >= 24 * 60 or minutos % app.config["DURACAO_SLOT_MINUTOS"]:
+        raise ValueError(hora)
+    return data, f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+
+def mascara_expediente(expediente: str = None) -> int:
+    """
+    Bitmap dos horários de trabalho a partir de faixas como
+    "08:00-12:00,14:00-18:00". Vazio ou inválido usa EXPEDIENTE_PADRAO.
+    """
+    duracao = app.config["DURACAO_SLOT_MINUTOS"]
+    mascara = 0
+    try:
+        for faixa in (expediente or app.config["EXPEDIENTE_PADRAO"]).split(","):
+            inicio, fim = faixa.split("-")
+            for i in range(
+                -(-minutos_do_dia(inicio) // duracao),
+                minutos_do_dia(fim) // duracao,
+            ):
+                mascara |= 1 << i
+    except ValueError:
+        if expediente:
+            return mascara_expediente(None)
+        raise
+    return mascara
+
+
+def normalizar_expediente(texto: str):
+    """
+    Valida um expediente digitado ("8:00-12:00, 14:00-18:00") e devolve
+    no formato canônico, ou None se vazio. ValueError se inválido.
+    """
+    faixas = []
+    for faixa in (texto or "").split(","):
+        if not faixa.strip():
+            continue
+        inicio, fim = (minutos_do_dia(p) for p in faixa.split("-"))
+        if inicio >= fim:
+            raise ValueError(faixa)
+        faixas.append(
+            f"{inicio // 60:02d}:{inicio % 60:02d}-{fim // 60:02d}:{fim % 60:02d}"
+        )
+    return ",".join(faixas) or None
+
+
+def horas_da_mascara(mascara: int) -> list:
+    """Lista 'HH:MM' dos bits ligados, em ordem."""
+    duracao = app.config["DURACAO_SLOT_MINUTOS"]
+    horas = []
+    i = 0
+    while mascara:
+        if mascara & 1:
+            minutos = i * duracao
+            horas.append(f"{minutos // 60:02d}:{minutos % 60:02d}")
+        mascara >>= 1
+        i += 1
+    return horas
+
+
+def bit_do_horario(hora: str) -> int:
+    """Bit do horário que contém `hora` (0 se a hora for inválida)."""
+    try:
+        return 1 << (minutos_do_dia(hora) // app.config["DURACAO_SLOT_MINUTOS"])
+    except ValueError:
+        return 0
+
+
+def mapa_ocupacao(db, medicos_cpf, data_inicio: str, data_fim: str) -> dict:
+    """
+    Horários ocupados de vários médicos num intervalo de datas, numa
+    leitura só (por lote de TAMANHO_LOTE_IN médicos).
+
+    Retorna {(medico_cpf, data): bitmap}.
+    """
+    ocupados = {}
+    cpfs = sorted(set(medicos_cpf))
+
+    for inicio in range(0, len(cpfs), TAMANHO_LOTE_IN):
+        lote = cpfs[inicio:inicio + TAMANHO_LOTE_IN]
+        marcadores = ", ".join("?" * len(lote))
+        cur = db.execute(
+            f"""
+            SELECT medico_cpf, data, hora
+              FROM consultas
+             WHERE medico_cpf IN ({marcadores})
+               AND data BETWEEN ? AND ?
+               AND status != ?
+            """,
+            (*lote, data_inicio, data_fim, STATUS_CANCELADA),
+        )
+        for medico_cpf, data, hora in cur:
+            chave = (medico_cpf, data)
+            ocupados[chave] = ocupados.get(chave, 0) | bit_do_horario(hora)
+
+    return ocupados
+
+
+def horarios_livres(db, medicos, data_inicio: str, data_fim: str = None) -> dict:
+    """
+    Horários livres de cada médico em cada dia do intervalo.
+
+    `medicos` são dicts do cache de referência (com "CPF" e "mascara").
+    Retorna {data: {medico_cpf: bitmap_livre}}, só com bitmaps não vazios.
+    """
+    data_fim = data_fim or data_inicio
+    ocupados = mapa_ocupacao(db, [m["CPF"] for m in medicos], data_inicio, data_fim)
+
+    livres = {}
+    dia = datetime.strptime(data_inicio, "%Y-%m-%d").date()
+    ultimo = datetime.strptime(data_fim, "%Y-%m-%d").date()
+    while dia <= ultimo:
+        data = dia.isoformat()
+        do_dia = {}
+        for m in medicos:
+            mascara = m["mascara"] & ~ocupados.get((m["CPF"], data), 0)
+            if mascara:
+                do_dia[m["CPF"]] = mascara
+        livres[data] = do_dia
+        dia += timedelta(days=1)
+
+    return livres
+
+
+def mascara_a_partir_de(hora: str) -> int:
+    """Bitmap com todos os horários que começam em `hora` ou depois."""
+    duracao = app.config["DURACAO_SLOT_MINUTOS"]
+    primeiro = -(-minutos_do_dia(hora) // duracao)
+    total = 24 * 60 // duracao
+    return ((1 << total) - 1) & ~((1 << primeiro) - 1)
+
+
+def medicos_para_busca(cargo: str, medico_cpf: str) -> list:
+    """Médicos considerados numa busca: o escolhido ou todos do cargo."""
+    referencia = dados_referencia()
+    if medico_cpf:
+        medico = referencia["medicos_por_cpf"].get(medico_cpf)
+        if medico and (not cargo or medico["cargo"] == cargo):
+            return [medico]
+        return []
+    return referencia["medicos_por_cargo"].get(cargo, [])
+
+
+def proximos_livres(db, medicos, a_partir_de: datetime, dias: int, limite: int) -> list:
+    """
+    Até `limite` horários livres (de qualquer um dos médicos) começando em
+    `a_partir_de` ou depois, olhando `dias` dias. Cada item:
+    {data, hora, medicos}.
+    """
+    inicio = a_partir_de.date()
+    fim = inicio + timedelta(days=dias - 1)
+    livres = horarios_livres(db, medicos, inicio.isoformat(), fim.isoformat())
+    corte = mascara_a_partir_de(a_partir_de.strftime("%H:%M"))
+
+    resultado = []
+    for data in sorted(livres):
+        por_hora = {}
+        for cpf, mascara in livres[data].items():
+            if data == inicio.isoformat():
+                mascara &= corte
+            for hora in horas_da_mascara(mascara):
+                por_hora.setdefault(hora, []).append(cpf)
+        for hora in sorted(por_hora):
+            resultado.append({"data": data, "hora": hora, "medicos": por_hora[hora]})
+            if len(resultado) >= limite:
+                return resultado
+    return resultado
+
+
+# ---------------------------------------------------------------------
+# Reserva de horários (segura entre workers)
+# ---------------------------------------------------------------------
+
+class HorarioOcupado(Exception):
+    """Nenhum dos médicos candidatos está livre no horário pedido."""
+
+
+# tentativas extras quando o lock de escrita não sai dentro do busy_timeout
+TENTATIVAS_RESERVA = 3
+
+
+def iniciar_escrita(db):
+    """
+    BEGIN IMMEDIATE: pega o lock de escrita antes de ler, com algumas
+    tentativas extras se ele não sair dentro do busy_timeout.
+    """
+    for tentativa in range(TENTATIVAS_RESERVA + 1):
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError:
+            if tentativa == TENTATIVAS_RESERVA:
+                raise
+            time.sleep(0.05 * (tentativa + 1))
+
+
+def reservar_consulta(
+    db, paciente_cpf, medicos_cpf, data, hora, tipo, status, obs, cargo,
+    ao_reservar=None,
+):
+    """
+    Cria a consulta com o primeiro médico de `medicos_cpf` que estiver
+    livre em data/hora e devolve (medico_cpf, id da consulta).
+
+    `ao_reservar(db, medico_cpf, consulta_id)`, se informado, roda dentro
+    da mesma transação, antes do commit.
+
+    A verificação e o INSERT acontecem dentro de uma transação BEGIN
+    IMMEDIATE, que pega o lock de escrita antes de ler: dois workers
+    disputando o mesmo horário são serializados e só um encontra o
+    horário livre. O índice único parcial idx_consultas_horario_ativo é
+    a segunda trava, caso algum caminho escreva sem passar por aqui.
+
+    Levanta HorarioOcupado se todos estiverem ocupados.
+    """
+    iniciar_escrita(db)
+    try:
+        for medico_cpf in medicos_cpf:
+            ocupado = db.execute(
+                """
+                SELECT 1
+                  FROM consultas
+                 WHERE medico_cpf = ?
+                   AND data       = ?
+                   AND hora       = ?
+                   AND status    != ?
+                """,
+                (medico_cpf, data, hora, STATUS_CANCELADA),
+            ).fetchone()
+            if ocupado:
+                continue
+
+            try:
+                cur = db.execute(
+                    """
+                    INSERT INTO consultas
+                        (paciente_cpf, medico_cpf, data, hora, tipo, status,
+                         observacoes, cargo)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (paciente_cpf, medico_cpf, data, hora, tipo, status, obs, cargo),
+                )
+            except sqlite3.IntegrityError:
+                continue
+
+            if ao_reservar is not None:
+                ao_reservar(db, medico_cpf, cur.lastrowid)
+            db.commit()
+            return medico_cpf, cur.lastrowid
+    except Exception:
+        db.rollback()
+        raise
+
+    db.rollback()
+    raise HorarioOcupado(data, hora)
+
+
+# ---------------------------------------------------------------------
+# Atribuição de médico (quando o paciente escolhe só o cargo)
+# ---------------------------------------------------------------------
+
+ESTRATEGIA_MENOS_OCUPADO = "menos_ocupado"
+ESTRATEGIA_RODIZIO = "rodizio"
+
+
+def carga_medicos(db, medicos_cpf, data: str) -> dict:
+    """
+    Consultas ativas (solicitadas ou agendadas) de cada médico na janela
+    de JANELA_CARGA_DIAS dias antes e depois de `data`, numa única
+    consulta agregada. Médicos sem consultas ficam com 0.
+    """
+    janela = app.config["JANELA_CARGA_DIAS"]
+    dia = datetime.strptime(data, "%Y-%m-%d")
+    inicio = (dia - timedelta(days=janela)).strftime("%Y-%m-%d")
+    fim = (dia + timedelta(days=janela)).strftime("%Y-%m-%d")
+
+    carga = dict.fromkeys(medicos_cpf, 0)
+    cpfs = list(carga)
+    for pos in range(0, len(cpfs), TAMANHO_LOTE_IN):
+        lote = cpfs[pos:pos + TAMANHO_LOTE_IN]
+        marcadores = ", ".join("?" * len(lote))
+        cur = db.execute(
+            f"""
+            SELECT medico_cpf, COUNT(*)
+              FROM consultas
+             WHERE medico_cpf IN ({marcadores})
+               AND data BETWEEN ? AND ?
+               AND status IN (?, ?)
+             GROUP BY medico_cpf
+            """,
+            (*lote, inicio, fim, STATUS_SOLICITADA, STATUS_AGENDADA),
+        )
+        for medico_cpf, qtd in cur:
+            carga[medico_cpf] = qtd
+    return carga
+
+
+def ordenar_candidatos(db, medicos_cpf, cargo: str, data: str, estrategia: str = None):
+    """
+    Ordena os médicos do cargo pela preferência de atribuição.
+
+    - menos_ocupado: menor carga na janela primeiro (empate: ordem original).
+    - rodizio: começa pelo médico seguinte ao último atribuído no cargo.
+
+    A reserva depois percorre a lista e fica com o primeiro que estiver
+    de fato livre no horário.
+    """
+    estrategia = estrategia or app.config["ESTRATEGIA_ATRIBUICAO"]
+    medicos_cpf = list(medicos_cpf)
+
+    if estrategia == ESTRATEGIA_RODIZIO:
+        row = db.execute(
+            "SELECT ultimo_medico FROM rodizio_cargos WHERE cargo = ?", (cargo,)
+        ).fetchone()
+        if row and row[0] in medicos_cpf:
+            pos = medicos_cpf.index(row[0]) + 1
+            medicos_cpf = medicos_cpf[pos:] + medicos_cpf[:pos]
+        return medicos_cpf
+
+    try:
+        carga = carga_medicos(db, medicos_cpf, data)
+    except ValueError:
+        return medicos_cpf
+    ordem = {cpf: i for i, cpf in enumerate(medicos_cpf)}
+    return sorted(medicos_cpf, key=lambda cpf: (carga[cpf], ordem[cpf]))
+
+
+def registrar_rodizio(db, cargo: str, medico_cpf: str):
+    """Guarda o último médico atribuído no cargo (mesma transação)."""
+    db.execute(
+        """
+        INSERT INTO rodizio_cargos (cargo, ultimo_medico) VALUES (?, ?)
+        ON CONFLICT (cargo) DO UPDATE SET ultimo_medico = excluded.ultimo_medico
+        """,
+        (cargo, medico_cpf),
+    )
+
+
+def sugestao_horario(db, medicos, data: str, hora: str) -> str:
+    """Texto com o próximo horário livre depois de data/hora (ou vazio)."""
+    try:
+        depois = datetime.strptime(f"{data} {hora}", "%Y-%m-%d %H:%M")
+        depois += timedelta(minutes=1)
+    except ValueError:
+        return ""
+    proximos = proximos_livres(db, medicos, depois, dias=14, limite=1)
+    if not proximos:
+        return ""
+    p = proximos[0]
+    return f' Próximo horário livre: {p["data"]} às {p["hora"]}.'
+
+
+def _disputar_horarios(barreira, fila, paciente_cpf, medico_cpf, datas):
+    """
+    Processo do stress-reserva: tenta reservar todas as datas, às 08:00.
+    Erros do SQLite (ex.: "database is locked") são contados, não
+    derrubam o processo: o pai sempre recebe o resultado.
+    """
+    conexoes.fechar()
+    ganhas = perdidas = erros = 0
+    with app.app_context():
+        db = get_db()
+        barreira.wait()
+        inicio = time.perf_counter()
+        for data in datas:
+            try:
+                reservar_consulta(
+                    db, paciente_cpf, [medico_cpf], data, "08:00",
+                    "Consulta", STATUS_SOLICITADA, "", "Stress",
+                )
+                ganhas += 1
+            except HorarioOcupado:
+                perdidas += 1
+            except sqlite3.Error:
+                erros += 1
+        fila.put((ganhas, perdidas, time.perf_counter() - inicio, erros))
+
+
+# tempo máximo esperando cada processo do stress-reserva responder
+STRESS_ESPERA_MAXIMA_S = 300
+
+
+def _rodada_stress(processos: int, horarios: int, pasta: str, nome: str) -> dict:
+    """Roda uma disputa num banco novo e devolve as métricas."""
+    import multiprocessing
+
+    app.config["DATABASE"] = os.path.join(pasta, f"{nome}.db")
+    conexoes.fechar()
+    with app.app_context():
+        init_db()
+        db = get_db()
+        medico_cpf = "90000000000"
+        db.execute(
+            "INSERT INTO usuarios (CPF, nome, senha, tipo, cargo) VALUES (?, ?, ?, ?, ?)",
+            (medico_cpf, "Médico Stress", "-", TIPO_MEDICO, "Stress"),
+        )
+        pacientes = [f"{91000000000 + i}" for i in range(processos)]
+        db.executemany(
+            "INSERT INTO usuarios (CPF, nome, senha, tipo) VALUES (?, ?, ?, ?)",
+            [(cpf, f"Paciente {cpf}", "-", TIPO_PACIENTE) for cpf in pacientes],
+        )
+        db.commit()
+    conexoes.fechar()
+
+    primeiro_dia = datetime(2099, 1, 1)
+    datas = [
+        (primeiro_dia + timedelta(days=i)).strftime("%Y-%m-%d")
+        for i in range(horarios)
+    ]
+
+    ctx = multiprocessing.get_context("fork")
+    barreira = ctx.Barrier(processos)
+    fila = ctx.Queue()
+    filhos = [
+        ctx.Process(
+            target=_disputar_horarios,
+            args=(barreira, fila, pacientes[i], medico_cpf, datas),
+        )
+        for i in range(processos)
+    ]
+    for p in filhos:
+        p.start()
+    try:
+        # um filho que morreu sem responder não deixa o comando preso
+        resultados = [fila.get(timeout=STRESS_ESPERA_MAXIMA_S) for _ in filhos]
+    finally:
+        for p in filhos:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+
+    with app.app_context():
+        db = get_db()
+        total = db.execute("SELECT COUNT(*) FROM consultas").fetchone()[0]
+        duplicados = db.execute(
+            """
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM consultas
+                 WHERE status != ?
+                 GROUP BY medico_cpf, data, hora
+                HAVING COUNT(*) > 1
+            )
+            """,
+            (STATUS_CANCELADA,),
+        ).fetchone()[0]
+    conexoes.fechar()
+
+    duracao = max(r[2] for r in resultados)
+    tentativas = sum(r[0] + r[1] for r in resultados)
+    return {
+        "ganhas": sum(r[0] for r in resultados),
+        "erros": sum(r[3] for r in resultados),
+        "total": total,
+        "duplicados": duplicados,
+        "duracao": duracao,
+        "tentativas_s": tentativas / duracao if duracao else 0.0,
+        "reservas_s": total / duracao if duracao else 0.0,
+    }
+
+
+@app.cli.command("stress-reserva")
+@click.option("--processos", default=8, show_default=True)
+@click.option("--horarios", default=200, show_default=True)
+def stress_reserva_command(processos, horarios):
+    """
+    Vários processos disputam os mesmos horários de um médico num banco
+    temporário. Cada horário deve ter exatamente uma reserva vencedora.
+    """
+    import tempfile
+
+    banco_original = app.config["DATABASE"]
+    try:
+        with tempfile.TemporaryDirectory() as pasta:
+            base = _rodada_stress(1, horarios, pasta, "base")
+            disputa = _rodada_stress(processos, horarios, pasta, "disputa")
+    finally:
+        app.config["DATABASE"] = banco_original
+
+    for nome, r, n in (("1 processo", base, 1), (f"{processos} processos", disputa, processos)):
+        print(
+            f"{nome:>12}: {n * horarios} tentativas, {r['total']} reservas, "
+            f"{r['duplicados']} horários duplicados, {r['erros']} erros, {r['duracao']:.2f}s, "
+            f"{r['tentativas_s']:.0f} tentativas/s, {r['reservas_s']:.0f} reservas/s"
+        )
+
+    if (
+        disputa["total"] != horarios
+        or disputa["ganhas"] != horarios
+        or disputa["duplicados"]
+        or disputa["erros"]
+    ):
+        raise SystemExit(
+            "FALHOU: algum horário ficou com reserva duplicada ou sem reserva, "
+            "ou houve erro do SQLite."
+        )
+    print("OK: exatamente uma reserva por horário.")
+
+
+# ---------------------------------------------------------------------
+# Busca textual (FTS5)
+# ---------------------------------------------------------------------
+
+def expressao_fts(termo: str, coluna_nome: str = None):
+    """
+    Converte o texto digitado em uma expressão MATCH do FTS5: cada palavra
+    vira um prefixo ("jo silv" -> "jo"* AND "silv"*).
+
+    Aspas são escapadas, então operadores do FTS5 digitados pelo usuário
+    viram texto comum. Retorna None se não sobrar nada para buscar.
+    """
+    termo = (termo or "").strip()
+    if not termo:
+        return None
+
+    palavras = re.findall(r"\w+", termo)
+    if not palavras:
+        return None
+
+    expressao = " ".join(
+        '"{}"*'.format(p.replace('"', '""')) for p in palavras
+    )
+    if coluna_nome:
+        return f"{coluna_nome} : ({expressao})"
+    return expressao
+
+
+def buscar_usuarios(db, termo, tipos, limite, offset=0):
+    """
+    Busca usuários dos tipos informados por nome ou CPF.
+
+    - Só dígitos/pontuação (ex.: "123.456"): CPFs que começam pelos
+      dígitos, em ordem de CPF. É uma faixa no índice único de CPF (que
+      só tem dígitos, e ":" vem logo depois de "9"), então o custo não
+      depende do tamanho da tabela. Dígitos do meio do CPF não são
+      encontrados: isso exigiria varrer a tabela inteira.
+    - Texto: nome pelo FTS5, ordenado pela relevância (bm25).
+    """
+    marcadores = ", ".join("?" * len(tipos))
+    digitos = normalizar_cpf(termo or "")
+    if digitos and not any(ch.isalpha() for ch in termo):
+        cur = db.execute(
+            f"""
+            SELECT CPF, nome, senha, tipo, cargo, expediente
+              FROM usuarios
+             WHERE CPF >= ? AND CPF < ?
+               AND tipo IN ({marcadores})
+             ORDER BY CPF
+             LIMIT ? OFFSET ?
+            """,
+            (digitos, digitos + ":", *tipos, limite, offset),
+        )
+        return [dict(r) for r in cur.fetchall()]
+
+    expressao = expressao_fts(termo, coluna_nome="nome")
+    if expressao is None:
+        return []
+
+    cur = db.execute(
+        f"""
+        SELECT u.CPF, u.nome, u.senha, u.tipo, u.cargo, u.expediente
+          FROM busca_usuarios b
+          JOIN usuarios u ON u.id = b.rowid
+         WHERE busca_usuarios MATCH ?
+           AND u.tipo IN ({marcadores})
+         ORDER BY b.rank, u.nome
+         LIMIT ? OFFSET ?
+        """,
+        (expressao, *tipos, limite, offset),
+    )
+    return [dict(r) for r in cur.fetchall()]
+
+
+def buscar_notas_consultas(db, termo, limite, offset=0, medico_cpf=None):
+    """
+    Busca nas observações, resumos e conclusões das consultas, com um
+    trecho destacado de cada resultado. `medico_cpf` restringe às
+    consultas de um médico.
+    """
+    expressao = expressao_fts(termo)
+    if expressao is None:
+        return []
+
+    filtro_medico = "AND c.medico_cpf = ?" if medico_cpf else ""
+    params = (expressao, medico_cpf) if medico_cpf else (expressao,)
+
+    cur = db.execute(
+        f"""
+        SELECT c.id, c.data, c.hora, c.status, c.paciente_cpf, c.medico_cpf,
+               COALESCE(p.nome, c.paciente_cpf) AS paciente_nome,
+               COALESCE(m.nome, c.medico_cpf)   AS medico_nome,
+               snippet(busca_consultas, -1, '[', ']', '…', 12) AS trecho
+          FROM busca_consultas b
+          JOIN consultas c ON c.id = b.rowid
+          LEFT JOIN usuarios p ON p.CPF = c.paciente_cpf
+          LEFT JOIN usuarios m ON m.CPF = c.medico_cpf
+         WHERE busca_consultas MATCH ?
+           {filtro_medico}
+         ORDER BY b.rank
+         LIMIT ? OFFSET ?
+        """,
+        (*params, limite, offset),
+    )
+    return [dict(r) for r in cur.fetchall()]
+
+
+# ---------------------------------------------------------------------
+# Importação / exportação em massa (flask import-data / export-data)
+# ---------------------------------------------------------------------
+#
+# Os arquivos são lidos e escritos registro a registro: a memória usada
+# não depende do tamanho do arquivo (um lote de --lote linhas por vez).
+# Formatos: JSON (lista, como users.json / consultas.json), JSON Lines
+# (.jsonl, um objeto por linha) e CSV com cabeçalho.
+
+COLUNAS_IMPORTACAO = {
+    "usuarios": ("CPF", "nome", "senha", "tipo", "cargo", "expediente"),
+    "consultas": (
+        "id",
+        "paciente_cpf",
+        "medico_cpf",
+        "data",
+        "hora",
+        "tipo",
+        "status",
+        "observacoes",
+        "resumo",
+        "conclusao",
+        "cargo",
+    ),
+}
+
+COLUNAS_CPF = {"usuarios": ("CPF",), "consultas": ("paciente_cpf", "medico_cpf")}
+
+TAMANHO_LEITURA = 1 << 16
+
+
+def ler_registros_json(arquivo):
+    """
+    Gera os objetos de um arquivo JSON sem carregá-lo inteiro: aceita uma
+    lista de objetos ([{...}, {...}]) ou JSON Lines. Só o objeto corrente
+    (mais um bloco de leitura) fica em memória.
+    """
+    decodificador = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    fim_arquivo = False
+    dentro_da_lista = None
+
+    while True:
+        # pula espaços e separadores entre objetos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) or fim_arquivo:
+                break
+            buffer, pos = arquivo.read(TAMANHO_LEITURA), 0
+            fim_arquivo = not buffer
+
+        if pos >= len(buffer):
+            return
+        if dentro_da_lista is None:
+            dentro_da_lista = buffer[pos] == "["
+            if dentro_da_lista:
+                pos += 1
+                continue
+        if dentro_da_lista and buffer[pos] == "]":
+            return
+
+        try:
+            obj, fim = decodificador.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if fim_arquivo:
+                raise
+            # objeto cortado no fim do bloco: lê mais e tenta de novo
+            mais = arquivo.read(TAMANHO_LEITURA)
+            fim_arquivo = not mais
+            buffer, pos = buffer[pos:] + mais, 0
+            continue
+
+        yield obj
+        pos = fim
+        if pos > TAMANHO_LEITURA:
+            buffer, pos = buffer[pos:], 0
+
+
+def ler_registros(arquivo, formato: str):
+    if formato == "csv":
+        # células vazias do CSV viram NULL, como no JSON
+        for linha in csv.DictReader(arquivo):
+            yield {k: (v if v != "" else None) for k, v in linha.items()}
+    else:
+        yield from ler_registros_json(arquivo)
+
+
+def formato_do_arquivo(caminho: str, formato: str | None) -> str:
+    if formato:
+        return formato
+    extensao = os.path.splitext(caminho)[1].lower().lstrip(".")
+    if extensao in ("json", "jsonl", "csv"):
+        return extensao
+    raise click.UsageError(f"Não sei o formato de {caminho!r}; use --formato.")
+
+
+def tabela_do_arquivo(caminho: str, tabela: str | None) -> str:
+    if tabela:
+        return tabela
+    nome = os.path.basename(caminho).lower()
+    if nome.startswith(("user", "usuario")):
+        return "usuarios"
+    if nome.startswith("consulta"):
+        return "consultas"
+    raise click.UsageError(f"Não sei a tabela de {caminho!r}; use --tabela.")
+
+
+def linha_para_importar(tabela: str, registro: dict) -> tuple:
+    """Registro lido do arquivo -> tupla na ordem de COLUNAS_IMPORTACAO."""
+    for coluna in COLUNAS_CPF[tabela]:
+        registro[coluna] = normalizar_cpf(registro.get(coluna))
+    if tabela == "consultas" and registro.get("id") is not None:
+        registro["id"] = int(registro["id"])
+    return tuple(registro.get(c) for c in COLUNAS_IMPORTACAO[tabela])
+
+
+def adiar_indices(db, tabela: str) -> list:
+    """
+    Remove os índices secundários e os gatilhos do FTS da tabela, para a
+    carga não pagar a manutenção linha a linha. Devolve o SQL de cada um,
+    para recriar depois (restaurar_indices). Índices UNIQUE ficam: são
+    eles que garantem CPF único e um horário ativo por médico.
+    """
+    objetos = db.execute(
+        """
+        SELECT type, name, sql FROM sqlite_master
+         WHERE tbl_name = ? AND sql IS NOT NULL
+           AND ((type = 'index' AND sql NOT LIKE 'CREATE UNIQUE%')
+             OR (type = 'trigger' AND name LIKE ?))
+        """,
+        (tabela, f"{tabela}_busca_%"),
+    ).fetchall()
+    for tipo, nome, _ in objetos:
+        db.execute(f"DROP {tipo.upper()} {nome}")
+    db.commit()
+    return [tuple(o) for o in objetos]
+
+
+def restaurar_indices(db, tabela: str, objetos: list):
+    """Recria o que adiar_indices removeu e reconstrói o índice FTS."""
+    if db.in_transaction:
+        db.rollback()
+    db.execute("BEGIN IMMEDIATE")
+    for _, _, sql in objetos:
+        db.execute(sql)
+    if any(tipo == "trigger" for tipo, _, _ in objetos):
+        fts = "busca_usuarios" if tabela == "usuarios" else "busca_consultas"
+        db.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    db.commit()
+    db.execute(f"ANALYZE {tabela}")
+    db.commit()
+
 
-def inicializar_usuarios_fixos():
+@app.cli.command("import-data")
+@click.argument("arquivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--tabela", type=click.Choice(sorted(COLUNAS_IMPORTACAO)))
+@click.option("--formato", type=click.Choice(["json", "jsonl", "csv"]))
+@click.option(
+    "--lote",
+    default=20000,
+    show_default=True,
+    help="Linhas por executemany / commit.",
+)
+@click.option(
+    "--sem-adiar-indices",
+    is_flag=True,
+    help="Mantém os índices durante a carga (cargas pequenas num banco grande).",
+)
+def import_data_command(arquivo, tabela, formato, lote, sem_adiar_indices):
     """
-    Cria alguns usuários padrão (admin, médicos e um paciente),
-    só se ainda não existirem.
+    Importa usuários ou consultas de ARQUIVO (JSON, JSON Lines ou CSV),
+    por exemplo users.json e consultas.json.
+
+    CPFs passam por normalizar_cpf. Usuários cujo CPF já existe e
+    consultas com id já existente (ou em horário já ocupado) são
+    ignorados, então reimportar o mesmo arquivo não duplica nada.
+
+    Índices secundários e o FTS são recriados uma vez só no fim. Durante
+    a carga as consultas ao banco ficam mais lentas: rode fora do horário
+    de atendimento.
     """
+    init_db()
     db = get_db()
+    tabela = tabela_do_arquivo(arquivo, tabela)
+    formato = formato_do_arquivo(arquivo, formato)
 
-    usuarios_fixos = [
-        {
-            "nome": "Administrador",
-            "CPF": "00000000001",
-            "senha": "admin",
-            "tipo": TIPO_ADMIN,
-            "cargo": "Administrador",
-        },
-        {
-            "nome": "Dr. Carlos Silva",
-            "CPF": "00000000002",
-            "senha": "medico123",
-            "tipo": TIPO_MEDICO,
-            "cargo": "Clínico Geral",
-        },
-        {
-            "nome": "Dr. Evandro",
-            "CPF": "00000000003",
-            "senha": "medico123",
-            "tipo": TIPO_MEDICO,
-            "cargo": "Nutricionista",
-        },
-        {
-            "nome": "Dra. Sonia",
-            "CPF": "00000000004",
-            "senha": "medico123",
-            "tipo": TIPO_MEDICO,
-            "cargo": "Pediatra",
-        },
-        {
-            "nome": "Cristiano",
-            "CPF": "11111111111",
-            "senha": "1234",
-            "tipo": TIPO_PACIENTE,
-            "cargo": None,
-        },
-    ]
-
-    for u in usuarios_fixos:
-        cur = db.execute("SELECT 1 FROM usuarios WHERE CPF = ?", (u["CPF"],))
-        if cur.fetchone() is None:
-            db.execute(
-                """
-                INSERT INTO usuarios (CPF, nome, senha, tipo, cargo)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (u["CPF"], u["nome"], u["senha"], u["tipo"], u["cargo"]),
-            )
+    colunas = COLUNAS_IMPORTACAO[tabela]
+    sql = (
+        f"INSERT OR IGNORE INTO {tabela} ({', '.join(colunas)}) "
+        f"VALUES ({', '.join('?' * len(colunas))})"
+    )
 
-    db.commit()
+    objetos = [] if sem_adiar_indices else adiar_indices(db, tabela)
+    lidas = inseridas = 0
+    inicio = time.perf_counter()
+    try:
+        with open(arquivo, encoding="utf-8", newline="") as f:
+            registros = ler_registros(f, formato)
+            while True:
+                linhas = [
+                    linha_para_importar(tabela, r)
+                    for r in itertools.islice(registros, lote)
+                ]
+                if not linhas:
+                    break
+                db.execute("BEGIN IMMEDIATE")
+                # rowcount soma só as linhas inseridas (não as dos gatilhos)
+                inseridas += db.executemany(sql, linhas).rowcount
+                db.commit()
+                lidas += len(linhas)
+                duracao = time.perf_counter() - inicio
+                print(
+                    f"  {lidas} linhas, {lidas / duracao:,.0f} linhas/s",
+                    file=sys.stderr,
+                )
+    finally:
+        if objetos:
+            print("  recriando índices...", file=sys.stderr)
+            restaurar_indices(db, tabela, objetos)
+
+    duracao = time.perf_counter() - inicio
+    print(
+        f"{tabela}: {lidas} linhas lidas, {inseridas} inseridas, "
+        f"{lidas - inseridas} ignoradas em {duracao:.2f}s "
+        f"({lidas / duracao if duracao else 0:,.0f} linhas/s)."
+    )
 
 
-def adicionar_notificacao(cpf: str, texto: str):
-    """Insere uma notificação simples para um usuário."""
+@app.cli.command("export-data")
+@click.argument("tabela", type=click.Choice(sorted(COLUNAS_IMPORTACAO)))
+@click.option(
+    "--saida",
+    "-o",
+    default="-",
+    show_default=True,
+    help="Arquivo de saída ('-' para a saída padrão).",
+)
+@click.option("--formato", type=click.Choice(["json", "jsonl", "csv"]))
+@click.option("--lote", default=5000, show_default=True)
+def export_data_command(tabela, saida, formato, lote):
+    """
+    Exporta TABELA em JSON (mesmo formato de users.json / consultas.json),
+    JSON Lines ou CSV, lendo o banco em blocos de --lote linhas.
+    """
+    init_db()
     db = get_db()
-    agora = datetime.now().strftime("%Y-%m-%d %H:%M")
-    db.execute(
-        "INSERT INTO notificacoes (cpf, texto, lida, data) VALUES (?, ?, 0, ?)",
-        (cpf, texto, agora),
+    if formato is None:
+        formato = "json" if saida == "-" else formato_do_arquivo(saida, None)
+
+    colunas = COLUNAS_IMPORTACAO[tabela]
+    cur = db.execute(f"SELECT {', '.join(colunas)} FROM {tabela} ORDER BY id")
+
+    f = sys.stdout if saida == "-" else open(saida, "w", encoding="utf-8", newline="")
+    total = 0
+    inicio = time.perf_counter()
+    try:
+        escritor = csv.writer(f) if formato == "csv" else None
+        if escritor:
+            escritor.writerow(colunas)
+        elif formato == "json":
+            f.write("[")
+
+        while True:
+            linhas = cur.fetchmany(lote)
+            if not linhas:
+                break
+            for linha in linhas:
+                if escritor:
+                    escritor.writerow(linha)
+                    continue
+                texto = json.dumps(dict(zip(colunas, linha)), ensure_ascii=False)
+                if formato == "json":
+                    f.write(",\n  " if total else "\n  ")
+                f.write(texto)
+                if formato == "jsonl":
+                    f.write("\n")
+                total += 1
+            total += len(linhas) if escritor else 0
+
+        if formato == "json":
+            f.write("\n]\n" if total else "]\n")
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    duracao = time.perf_counter() - inicio
+    print(
+        f"{tabela}: {total} linhas exportadas em {duracao:.2f}s "
+        f"({total / duracao if duracao else 0:,.0f} linhas/s).",
+        file=sys.stderr,
     )
-    db.commit()
 
 
 # ---------------------------------------------------------------------
@@ -258,30 +2982,55 @@ def logout():
 @app.route("/clientesadmin")
 def clientesadmin():
     db = get_db()
-    busca = (request.args.get("busca") or "").strip().lower()
+    busca = (request.args.get("busca") or "").strip()
+    pagina = ler_pagina(request.args.get("pagina"))
 
-    cur = db.execute("SELECT CPF, nome, senha, tipo, cargo FROM usuarios")
-    usuarios = [dict(r) for r in cur.fetchall()]
+    etag, alterada_em = validadores_pagina("usuarios")
+    nao_modificada = pagina_nao_modificada(etag, alterada_em)
+    if nao_modificada is not None:
+        return nao_modificada
 
     # mantém somente admins e pacientes
-    usuarios = [
-        u for u in usuarios if u.get("tipo") in (TIPO_ADMIN, TIPO_PACIENTE)
-    ]
+    tipos = (TIPO_ADMIN, TIPO_PACIENTE)
 
     if busca:
-        usuarios = [
-            u
-            for u in usuarios
-            if busca in (u.get("nome") or "").lower()
-            or busca in (u.get("CPF") or "")
-        ]
+        usuarios = buscar_usuarios(
+            db,
+            busca,
+            tipos,
+            limite=POR_PAGINA_PADRAO + 1,
+            offset=(pagina - 1) * POR_PAGINA_PADRAO,
+        )
+    else:
+        cur = db.execute(
+            "SELECT CPF, nome, senha, tipo, cargo FROM usuarios "
+            "WHERE tipo IN (?, ?)",
+            tipos,
+        )
+        usuarios = [dict(r) for r in cur.fetchall()]
+
+    tem_proxima = busca and len(usuarios) > POR_PAGINA_PADRAO
+    if busca:
+        usuarios = usuarios[:POR_PAGINA_PADRAO]
 
     for u in usuarios:
         u["CPF"] = formatar_cpf(u.get("CPF", ""))
         u["nome"] = (u.get("nome") or "").title()
         u["tipo"] = (u.get("tipo") or "").title()
 
-    return render_template("clientesadmin.html", usuarios=usuarios)
+    return com_validadores(
+        app.make_response(
+            render_template(
+                "clientesadmin.html",
+                mensagens=get_flashed_messages(with_categories=True),
+                usuarios=usuarios,
+                pagina=pagina,
+                tem_proxima=tem_proxima,
+            )
+        ),
+        etag,
+        alterada_em,
+    )
 
 
 @app.route("/novo_cliente", methods=["POST"])
@@ -344,6 +3093,20 @@ def salvar_edicao_cliente():
         """,
         (nome, novo_cpf, tipo, cargo, cpf_original),
     )
+
+    # só o formulário de médicos envia o expediente
+    if "expediente" in request.form:
+        try:
+            expediente = normalizar_expediente(request.form.get("expediente"))
+        except ValueError:
+            db.rollback()
+            flash("Expediente inválido. Use faixas como 08:00-12:00,14:00-18:00.", "erro")
+            return redirect(url_for("medicosadmin"))
+        db.execute(
+            "UPDATE usuarios SET expediente = ? WHERE CPF = ?",
+            (expediente, novo_cpf),
+        )
+
     db.commit()
     flash("Registro atualizado com sucesso!", "ok")
 
@@ -359,27 +3122,51 @@ def salvar_edicao_cliente():
 @app.route("/medicosadmin")
 def medicosadmin():
     db = get_db()
-    busca = (request.args.get("busca") or "").strip().lower()
+    busca = (request.args.get("busca") or "").strip()
+    pagina = ler_pagina(request.args.get("pagina"))
 
-    cur = db.execute(
-        "SELECT CPF, nome, tipo, cargo FROM usuarios WHERE tipo = ?",
-        (TIPO_MEDICO,),
-    )
-    usuarios = [dict(r) for r in cur.fetchall()]
+    etag, alterada_em = validadores_pagina("usuarios")
+    nao_modificada = pagina_nao_modificada(etag, alterada_em)
+    if nao_modificada is not None:
+        return nao_modificada
 
     if busca:
-        usuarios = [
-            u
-            for u in usuarios
-            if busca in (u.get("nome") or "").lower()
-            or busca in (u.get("CPF") or "")
-        ]
+        usuarios = buscar_usuarios(
+            db,
+            busca,
+            (TIPO_MEDICO,),
+            limite=POR_PAGINA_PADRAO + 1,
+            offset=(pagina - 1) * POR_PAGINA_PADRAO,
+        )
+    else:
+        cur = db.execute(
+            "SELECT CPF, nome, tipo, cargo, expediente FROM usuarios "
+            "WHERE tipo = ?",
+            (TIPO_MEDICO,),
+        )
+        usuarios = [dict(r) for r in cur.fetchall()]
+
+    tem_proxima = busca and len(usuarios) > POR_PAGINA_PADRAO
+    if busca:
+        usuarios = usuarios[:POR_PAGINA_PADRAO]
 
     for u in usuarios:
         u["CPF"] = formatar_cpf(u.get("CPF", ""))
         u["nome"] = (u.get("nome") or "").title()
 
-    return render_template("medicosadmin.html", usuarios=usuarios)
+    return com_validadores(
+        app.make_response(
+            render_template(
+                "medicosadmin.html",
+                mensagens=get_flashed_messages(with_categories=True),
+                usuarios=usuarios,
+                pagina=pagina,
+                tem_proxima=tem_proxima,
+            )
+        ),
+        etag,
+        alterada_em,
+    )
 
 
 @app.route("/novo_medico", methods=["POST"])
@@ -393,6 +3180,12 @@ def novo_medico():
         flash("Informe o cargo/especialidade do médico.", "erro")
         return redirect(url_for("medicosadmin"))
 
+    try:
+        expediente = normalizar_expediente(request.form.get("expediente"))
+    except ValueError:
+        flash("Expediente inválido. Use faixas como 08:00-12:00,14:00-18:00.", "erro")
+        return redirect(url_for("medicosadmin"))
+
     db = get_db()
     cur = db.execute("SELECT 1 FROM usuarios WHERE CPF = ?", (cpf,))
     if cur.fetchone():
@@ -401,10 +3194,10 @@ def novo_medico():
 
     db.execute(
         """
-        INSERT INTO usuarios (CPF, nome, senha, tipo, cargo)
-        VALUES (?, ?, ?, ?, ?)
+        INSERT INTO usuarios (CPF, nome, senha, tipo, cargo, expediente)
+        VALUES (?, ?, ?, ?, ?, ?)
         """,
-        (cpf, nome, senha, TIPO_MEDICO, cargo),
+        (cpf, nome, senha, TIPO_MEDICO, cargo, expediente),
     )
     db.commit()
     flash("Médico cadastrado com sucesso!", "ok")
@@ -435,6 +3228,154 @@ def dashboardadmin():
     return render_template("dashboardadmin.html")
 
 
+def codificar_cursor(consulta) -> str:
+    """Cursor da paginação: posição (data, hora, id) de uma consulta."""
+    return f'{consulta["data"]}|{consulta["hora"]}|{consulta["id"]}'
+
+
+def decodificar_cursor(cursor):
+    """Inverso de codificar_cursor. Retorna None se o cursor for inválido."""
+    partes = (cursor or "").split("|")
+    if len(partes) != 3 or not partes[2].isdigit():
+        return None
+    return partes[0], partes[1], int(partes[2])
+
+
+def padrao_like(texto: str) -> str:
+    """Monta um padrão '%texto%' escapando os curingas do LIKE."""
+    escapado = (
+        texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    )
+    return f"%{escapado}%"
+
+
+class PaginaConsultas:
+    """
+    Uma página da listagem do agendaadmin, lida sob demanda: o SELECT só é
+    lido quando o template chega na tabela, e de uma vez (são no máximo
+    POR_PAGINA_MAXIMO + 1 linhas), para não ficar aberto durante o envio.
+    Os cursores de navegação dependem da primeira e da última linha, então
+    só ficam prontos depois da iteração; o template os usa depois da tabela.
+    """
+
+    def __init__(self, cur, por_pagina: int, tem_anterior: bool, tem_proximo=None):
+        self._cur = cur
+        self.por_pagina = por_pagina
+        self.tem_anterior = tem_anterior
+        # None: descobre pela linha extra (LIMIT por_pagina + 1)
+        self.tem_proximo = tem_proximo
+        self.cursor_anterior = None
+        self.cursor_proximo = None
+
+    def __iter__(self):
+        linhas = iter([dict(r) for r in self._cur.fetchall()])
+        ultima = None
+        for consulta in itertools.islice(linhas, self.por_pagina):
+            if ultima is None and self.tem_anterior:
+                self.cursor_anterior = codificar_cursor(consulta)
+            ultima = consulta
+            yield consulta
+
+        if self.tem_proximo is None:
+            self.tem_proximo = next(linhas, None) is not None
+        if ultima is not None and self.tem_proximo:
+            self.cursor_proximo = codificar_cursor(ultima)
+
+
+def listar_consultas_admin(db, filtros, por_pagina, apos=None, antes=None):
+    """
+    Lista uma página de consultas para o admin, ordenada por
+    (data, hora, id), com os filtros aplicados no próprio SQL.
+
+    A paginação é por cursor (keyset): `apos` traz a página seguinte a uma
+    posição e `antes` a página anterior. O custo de cada página não depende
+    de quantas consultas existem antes dela, ao contrário de OFFSET.
+
+    Retorna uma PaginaConsultas (as linhas são lidas durante a iteração).
+    """
+    condicoes = []
+    params = []
+
+    if filtros.get("busca_paciente"):
+        condicoes.append(
+            "(COALESCE(p.nome, c.paciente_cpf) LIKE ? ESCAPE '\\'"
+            " OR c.paciente_cpf LIKE ? ESCAPE '\\')"
+        )
+        padrao = padrao_like(filtros["busca_paciente"])
+        params += [padrao, padrao]
+
+    if filtros.get("busca_medico"):
+        condicoes.append("COALESCE(m.nome, c.medico_cpf) LIKE ? ESCAPE '\\'")
+        params.append(padrao_like(filtros["busca_medico"]))
+
+    if filtros.get("status"):
+        condicoes.append("c.status = ?")
+        params.append(filtros["status"])
+
+    if filtros.get("data"):
+        condicoes.append("c.data = ?")
+        params.append(filtros["data"])
+
+    juncoes = """
+          FROM consultas c
+          LEFT JOIN usuarios p ON p.CPF = c.paciente_cpf
+          LEFT JOIN usuarios m ON m.CPF = c.medico_cpf
+    """
+
+    def onde(extras):
+        todas = condicoes + extras
+        return "WHERE " + " AND ".join(todas) if todas else ""
+
+    tem_proximo = None
+    limite = por_pagina + 1
+    posicao = decodificar_cursor(antes)
+    if posicao:
+        # página anterior: acha onde ela começa lendo só as chaves (de trás
+        # para frente, pelo índice) e depois lê para frente como as outras
+        chaves = db.execute(
+            f"""
+            SELECT c.data, c.hora, c.id
+              {juncoes}
+              {onde(["(c.data, c.hora, c.id) < (?, ?, ?)"])}
+             ORDER BY c.data DESC, c.hora DESC, c.id DESC
+             LIMIT ?
+            """,
+            (*params, *posicao, por_pagina + 1),
+        ).fetchall()
+        tem_anterior = len(chaves) > por_pagina
+        tem_proximo = True
+        limite = por_pagina
+        inicio = tuple(chaves[:por_pagina][-1]) if chaves else posicao
+        extras = [
+            "(c.data, c.hora, c.id) >= (?, ?, ?)",
+            "(c.data, c.hora, c.id) < (?, ?, ?)",
+        ]
+        params += [*inicio, *posicao]
+    else:
+        posicao = decodificar_cursor(apos)
+        tem_anterior = posicao is not None
+        extras = []
+        if posicao:
+            extras.append("(c.data, c.hora, c.id) > (?, ?, ?)")
+            params += list(posicao)
+
+    cur = db.execute(
+        f"""
+        SELECT c.*,
+               COALESCE(p.nome, c.paciente_cpf) AS paciente_nome,
+               COALESCE(m.nome, c.medico_cpf)   AS medico_nome
+          {juncoes}
+          {onde(extras)}
+         ORDER BY c.data, c.hora, c.id
+         LIMIT ?
+        """,
+        (*params, limite),
+    )
+    # a linha extra (LIMIT por_pagina + 1) só serve para saber se existe
+    # mais uma página
+    return PaginaConsultas(cur, por_pagina, tem_anterior, tem_proximo)
+
+
 @app.route("/agendaadmin", methods=["GET", "POST"])
 def agendaadmin():
     db = get_db()
@@ -455,6 +3396,12 @@ def agendaadmin():
             )
             return redirect(url_for("agendaadmin"))
 
+        try:
+            data, hora = normalizar_horario(data, hora)
+        except ValueError:
+            flash("Data ou hora inválida.", "erro")
+            return redirect(url_for("agendaadmin"))
+
         # valida paciente
         cur = db.execute(
             "SELECT 1 FROM usuarios WHERE CPF = ? AND tipo = ?",
@@ -473,137 +3420,234 @@ def agendaadmin():
             flash("CPF de médico inválido.", "erro")
             return redirect(url_for("agendaadmin"))
 
-        # evita conflito de horário
-        cur = db.execute(
-            """
-            SELECT 1
-              FROM consultas
-             WHERE medico_cpf = ?
-               AND data       = ?
-               AND hora       = ?
-               AND status    != ?
-            """,
-            (medico_cpf, data, hora, STATUS_CANCELADA),
-        )
-        if cur.fetchone():
+        # conflito de horário é verificado atomicamente na reserva
+        try:
+            reservar_consulta(
+                db, paciente_cpf, [medico_cpf], data, hora, tipo,
+                STATUS_AGENDADA, obs, cargo,
+            )
+        except HorarioOcupado:
             flash("Já existe consulta para esse médico neste horário.", "erro")
             return redirect(url_for("agendaadmin"))
 
-        db.execute(
-            """
-            INSERT INTO consultas
-                (paciente_cpf, medico_cpf, data, hora, tipo, status, observacoes, cargo)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (paciente_cpf, medico_cpf, data, hora, tipo, STATUS_AGENDADA, obs, cargo),
-        )
-        db.commit()
         flash("Consulta criada com sucesso!", "ok")
         return redirect(url_for("agendaadmin"))
 
-    # GET: listagem com filtros
-    usuarios = [dict(r) for r in db.execute("SELECT * FROM usuarios").fetchall()]
-    consultas = [dict(r) for r in db.execute("SELECT * FROM consultas").fetchall()]
-
-    mapa_nomes = {u["CPF"]: u["nome"] for u in usuarios}
+    # GET: listagem com filtros e paginação por cursor, em streaming
+    etag, alterada_em = validadores_pagina("consultas", "usuarios")
+    nao_modificada = pagina_nao_modificada(etag, alterada_em)
+    if nao_modificada is not None:
+        return nao_modificada
+
+    filtros = {
+        "busca_paciente": (request.args.get("busca_paciente") or "").strip(),
+        "busca_medico": (request.args.get("busca_medico") or "").strip(),
+        "status": (request.args.get("status") or "").strip().lower(),
+        "data": (request.args.get("data") or "").strip(),
+    }
+    por_pagina = ler_por_pagina(request.args.get("por_pagina"))
+
+    pagina = listar_consultas_admin(
+        db,
+        filtros,
+        por_pagina,
+        apos=request.args.get("apos"),
+        antes=request.args.get("antes"),
+    )
 
-    for c in consultas:
-        c["paciente_nome"] = mapa_nomes.get(
-            c.get("paciente_cpf", ""), c.get("paciente_cpf", "")
-        )
-        c["medico_nome"] = mapa_nomes.get(
-            c.get("medico_cpf", ""), c.get("medico_cpf", "")
-        )
+    referencia = dados_referencia()
 
-    busca_paciente = (request.args.get("busca_paciente") or "").strip().lower()
-    busca_medico = (request.args.get("busca_medico") or "").strip().lower()
-    filtro_status = (request.args.get("status") or "").strip().lower()
-    filtro_data = (request.args.get("data") or "").strip()
+    # filtros não vazios, para montar os links de navegação
+    filtros_ativos = {k: v for k, v in filtros.items() if v}
+    if request.args.get("por_pagina"):
+        filtros_ativos["por_pagina"] = por_pagina
 
-    lista = consultas
+    resposta = pagina_em_streaming(
+        "agendaadmin.html",
+        mensagens=get_flashed_messages(with_categories=True),
+        consultas=pagina,
+        medicos=referencia["medicos"],
+        usuarios=referencia["pacientes"],
+        cargos=referencia["cargos"],
+        filtros=filtros_ativos,
+    )
+    return com_validadores(resposta, etag, alterada_em)
 
-    if busca_paciente:
-        lista = [
-            c
-            for c in lista
-            if busca_paciente in (c.get("paciente_nome", "")).lower()
-            or busca_paciente in (c.get("paciente_cpf", ""))
-        ]
 
-    if busca_medico:
-        lista = [
-            c
-            for c in lista
-            if busca_medico in (c.get("medico_nome", "")).lower()
-        ]
+# ação -> (status de origem aceitos, novo status, aviso ao paciente)
+ACOES_CONSULTA = {
+    "aprovar": ((STATUS_SOLICITADA,), STATUS_AGENDADA, "Sua consulta foi aprovada!"),
+    "cancelar": (
+        (STATUS_SOLICITADA, STATUS_AGENDADA),
+        STATUS_CANCELADA,
+        "Sua consulta foi cancelada.",
+    ),
+}
 
-    if filtro_status:
-        lista = [
-            c
-            for c in lista
-            if (c.get("status") or "").lower() == filtro_status
-        ]
+LOTE_CONSULTAS_MAXIMO = 500
+# ids são INTEGER PRIMARY KEY: fora disso o sqlite3 levanta OverflowError
+ID_CONSULTA_MAXIMO = 2**63 - 1
 
-    if filtro_data:
-        lista = [c for c in lista if c.get("data", "") == filtro_data]
 
+def _id_consulta(valor):
+    """
+    Id de consulta vindo do formulário ou do JSON; None se inválido (texto
+    não numérico, lista/objeto ou fora de 1..ID_CONSULTA_MAXIMO).
+    """
     try:
-        lista.sort(key=lambda x: (x.get("data", ""), x.get("hora", "")))
-    except Exception:
-        pass
+        numero = int(str(valor).strip())
+    except (TypeError, ValueError):
+        return None
+    if not 1 <= numero <= ID_CONSULTA_MAXIMO:
+        return None
+    return numero
 
-    medicos = [u for u in usuarios if u.get("tipo") == TIPO_MEDICO]
 
-    return render_template(
-        "agendaadmin.html",
-        consultas=lista,
-        medicos=medicos,
-        usuarios=usuarios,
-    )
+def alterar_consultas(db, acao: str, ids) -> list:
+    """
+    Aplica `acao` (chave de ACOES_CONSULTA) às consultas `ids` numa única
+    transação: um SELECT por lote de ids, um executemany para os status e
+    outro para as notificações, e um commit.
+
+    Retorna um item por id distinto, na ordem recebida:
+    {"id", "resultado", "status"}, com resultado "alterada", "ignorada"
+    (o status atual não permite a ação), "nao_encontrada" ou "invalida".
+    """
+    origens, novo_status, aviso = ACOES_CONSULTA[acao]
+    numeros = list(dict.fromkeys(n for n in map(_id_consulta, ids) if n is not None))
+
+    iniciar_escrita(db)
+    try:
+        atuais = {}
+        for inicio in range(0, len(numeros), TAMANHO_LOTE_IN):
+            lote = numeros[inicio:inicio + TAMANHO_LOTE_IN]
+            marcadores = ", ".join("?" * len(lote))
+            for c in db.execute(
+                f"SELECT id, paciente_cpf, status FROM consultas WHERE id IN ({marcadores})",
+                lote,
+            ):
+                atuais[c["id"]] = c
+
+        alterar = [
+            atuais[n] for n in numeros if n in atuais and atuais[n]["status"] in origens
+        ]
+        db.executemany(
+            "UPDATE consultas SET status = ? WHERE id = ?",
+            [(novo_status, c["id"]) for c in alterar],
+        )
+        notificar_varios(db, [(c["paciente_cpf"], aviso) for c in alterar])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if alterar:
+        canal_notificacoes.acordar()
+
+    alteradas = {c["id"] for c in alterar}
+    resultados = []
+    vistos = set()
+    for valor in ids:
+        numero = _id_consulta(valor)
+        if numero is None:
+            resultados.append({"id": valor, "resultado": "invalida", "status": None})
+            continue
+        if numero in vistos:
+            continue
+        vistos.add(numero)
+        if numero in alteradas:
+            resultado, status = "alterada", novo_status
+        elif numero in atuais:
+            resultado, status = "ignorada", atuais[numero]["status"]
+        else:
+            resultado, status = "nao_encontrada", None
+        resultados.append({"id": numero, "resultado": resultado, "status": status})
+    return resultados
 
 
 @app.route("/aprovar_consulta", methods=["POST"])
 def aprovar_consulta():
-    consulta_id = (request.form.get("id") or "").strip()
-    db = get_db()
+    [item] = alterar_consultas(get_db(), "aprovar", [request.form.get("id") or ""])
 
-    cur = db.execute(
-        "SELECT paciente_cpf FROM consultas WHERE id = ?", (consulta_id,)
-    )
-    consulta = cur.fetchone()
-    if not consulta:
+    if item["resultado"] == "alterada":
+        flash("Consulta aprovada com sucesso!", "ok")
+    elif item["resultado"] == "ignorada":
+        flash("Somente consultas solicitadas podem ser aprovadas.", "erro")
+    else:
         flash("Consulta não encontrada.", "erro")
-        return redirect(url_for("agendaadmin"))
-
-    db.execute(
-        "UPDATE consultas SET status = ? WHERE id = ?",
-        (STATUS_AGENDADA, consulta_id),
-    )
-    db.commit()
-    flash("Consulta aprovada com sucesso!", "ok")
-
-    adicionar_notificacao(consulta["paciente_cpf"], "Sua consulta foi aprovada!")
     return redirect(url_for("agendaadmin"))
 
 
 @app.route("/cancelar_consulta", methods=["POST"])
 def cancelar_consulta():
-    consulta_id = (request.form.get("id") or "").strip()
-    db = get_db()
+    [item] = alterar_consultas(get_db(), "cancelar", [request.form.get("id") or ""])
 
-    cur = db.execute(
-        "UPDATE consultas SET status = ? WHERE id = ?",
-        (STATUS_CANCELADA, consulta_id),
-    )
-    if cur.rowcount > 0:
-        db.commit()
+    if item["resultado"] == "alterada":
         flash("Consulta cancelada.", "ok")
+    elif item["resultado"] == "ignorada":
+        flash("Esta consulta já foi concluída ou cancelada.", "erro")
     else:
         flash("Consulta não encontrada.", "erro")
-
     return redirect(url_for("agendaadmin"))
 
 
+@app.route("/consultas_lote", methods=["POST"])
+def consultas_lote():
+    """
+    Aprova ou cancela várias consultas de uma vez, numa transação (JSON).
+
+    Corpo: {"acao": "aprovar" | "cancelar", "ids": [12, 13, ...]}.
+    Retorna {"acao", "resultados": [{id, resultado, status}], "totais"}.
+    """
+    if session.get("tipo") != TIPO_ADMIN:
+        return jsonify({"erro": "Acesso restrito."}), 403
+
+    dados = request.get_json(silent=True) or {}
+    acao = dados.get("acao")
+    ids = dados.get("ids")
+    if acao not in ACOES_CONSULTA or not isinstance(ids, list) or not ids:
+        return jsonify({"erro": "Informe acao (aprovar ou cancelar) e a lista ids."}), 400
+    if len(ids) > LOTE_CONSULTAS_MAXIMO:
+        return jsonify({"erro": f"No máximo {LOTE_CONSULTAS_MAXIMO} consultas por vez."}), 400
+
+    resultados = alterar_consultas(get_db(), acao, ids)
+
+    totais = {"alterada": 0, "ignorada": 0, "nao_encontrada": 0, "invalida": 0}
+    for item in resultados:
+        totais[item["resultado"]] += 1
+    return jsonify({"acao": acao, "resultados": resultados, "totais": totais})
+
+
+@app.route("/buscar_consultas")
+def buscar_consultas():
+    """
+    Busca textual nas notas das consultas (JSON). Admin vê todas; médico
+    só as próprias consultas.
+    """
+    tipo = session.get("tipo")
+    if tipo not in (TIPO_ADMIN, TIPO_MEDICO):
+        return jsonify({"erro": "Acesso restrito."}), 403
+
+    termo = (request.args.get("q") or "").strip()
+    pagina = ler_pagina(request.args.get("pagina"))
+    por_pagina = ler_por_pagina(request.args.get("por_pagina"))
+
+    resultados = buscar_notas_consultas(
+        get_db(),
+        termo,
+        limite=por_pagina + 1,
+        offset=(pagina - 1) * por_pagina,
+        medico_cpf=session.get("cpf") if tipo == TIPO_MEDICO else None,
+    )
+
+    return jsonify(
+        {
+            "resultados": resultados[:por_pagina],
+            "pagina": pagina,
+            "tem_proxima": len(resultados) > por_pagina,
+        }
+    )
+
+
 # ---------------------------------------------------------------------
 # Agenda médico
 # ---------------------------------------------------------------------
@@ -627,68 +3671,49 @@ def agendamedico():
     )
     medico = cur.fetchone()
     if not medico:
-        return "Médico não encontrado ou não autorizado.", 403
-
-    cur = db.execute(
-        """
-        SELECT * FROM consultas
-         WHERE medico_cpf = ?
-           AND status != ?
-        """,
-        (medico_cpf, STATUS_CANCELADA),
-    )
-    consultas_medico = [dict(r) for r in cur.fetchall()]
-
-    mapa_nomes = {
-        r["CPF"]: r["nome"]
-        for r in db.execute("SELECT CPF, nome FROM usuarios").fetchall()
-    }
-
-    for c in consultas_medico:
-        c["paciente_nome"] = mapa_nomes.get(
-            c.get("paciente_cpf", ""), c.get("paciente_cpf", "")
-        )
-
-        paciente_cpf = c.get("paciente_cpf")
-        cur_hist = db.execute(
-            """
-            SELECT *
-              FROM consultas
-             WHERE paciente_cpf = ?
-               AND status       = ?
-             ORDER BY data DESC, hora DESC
-            """,
-            (paciente_cpf, STATUS_CONCLUIDA),
-        )
-        historico_rows = cur_hist.fetchall()
-        historico = []
-        for h in historico_rows:
-            historico.append(
-                {
-                    "data": h["data"],
-                    "hora": h["hora"],
-                    "tipo": h["tipo"],
-                    "status": h["status"],
-                    "medico_nome": mapa_nomes.get(
-                        h["medico_cpf"], h["medico_cpf"]
-                    ),
-                    "resumo": h["resumo"],
-                    "conclusao": h["conclusao"],
-                }
-            )
-
-        c["historico"] = historico
+        return "Médico não encontrado ou não autorizado.", 403
 
-    try:
-        consultas_medico.sort(
-            key=lambda x: (x.get("data", ""), x.get("hora", ""))
-        )
-    except Exception:
-        pass
+    # o histórico dos pacientes inclui consultas com outros médicos: a
+    # página depende da tabela inteira, não só das consultas deste médico
+    etag, alterada_em = validadores_pagina("consultas", "usuarios")
+    nao_modificada = pagina_nao_modificada(etag, alterada_em)
+    if nao_modificada is not None:
+        return nao_modificada
 
-    return render_template(
-        "agendamedico.html", medico=medico, consultas=consultas_medico
+    consultas = consultas_medico_em_lotes(
+        db, medico_cpf, dados_referencia()["mapa_nomes"]
     )
+    return com_validadores(
+        pagina_em_streaming(
+            "agendamedico.html",
+            mensagens=get_flashed_messages(with_categories=True),
+            medico=medico,
+            consultas=consultas,
+        ),
+        etag,
+        alterada_em,
+    )
+
+
+def consultas_medico_em_lotes(db, medico_cpf: str, mapa_nomes: dict):
+    """
+    Consultas não canceladas do médico, por data e hora, com nome e
+    histórico do paciente. O histórico é buscado lote a lote, só para os
+    pacientes daquele lote, e descartado em seguida.
+    """
+    for lote in consultas_em_lotes(
+        db, "*", ["medico_cpf = ?", "status != ?"], (medico_cpf, STATUS_CANCELADA)
+    ):
+        historicos = buscar_historicos(
+            db, {c["paciente_cpf"] for c in lote}, mapa_nomes
+        )
+        for c in lote:
+            c["paciente_nome"] = mapa_nomes.get(
+                c.get("paciente_cpf", ""), c.get("paciente_cpf", "")
+            )
+            # a mesma lista é compartilhada entre as linhas do mesmo paciente
+            c["historico"] = historicos.get(c.get("paciente_cpf"), [])
+            yield c
 
 
 @app.route("/concluir_consulta", methods=["POST"])
@@ -719,13 +3744,15 @@ def concluir_consulta():
         """,
         (STATUS_CONCLUIDA, resumo, conclusao, consulta_id),
     )
-    db.commit()
-
-    flash("Consulta marcada como concluída e registrada no histórico.", "ok")
-    adicionar_notificacao(
+    notificar(
+        db,
         consulta["paciente_cpf"],
         "Sua consulta foi concluída! Veja o resumo no histórico.",
     )
+    db.commit()
+    canal_notificacoes.acordar()
+
+    flash("Consulta marcada como concluída e registrada no histórico.", "ok")
     return redirect(url_for("agendamedico"))
 
 
@@ -746,87 +3773,102 @@ def agendapaciente():
             400,
         )
 
-    cur = db.execute(
-        """
-        SELECT *
-          FROM consultas
-         WHERE paciente_cpf = ?
-         ORDER BY data, hora
-        """,
-        (paciente_cpf,),
-    )
-    consultas_paciente = [dict(r) for r in cur.fetchall()]
-
-    mapa_nomes = {
-        r["CPF"]: r["nome"]
-        for r in db.execute("SELECT CPF, nome FROM usuarios").fetchall()
-    }
-
-    for c in consultas_paciente:
-        c["medico_nome"] = mapa_nomes.get(
-            c.get("medico_cpf", ""), c.get("medico_cpf", "—")
-        )
+    referencia = dados_referencia()
 
-    medicos = [
-        dict(r)
-        for r in db.execute(
-            "SELECT * FROM usuarios WHERE tipo = ?", (TIPO_MEDICO,)
-        ).fetchall()
-    ]
-    cargos = sorted({m.get("cargo") for m in medicos if m.get("cargo")})
+    def consultas_paciente(mapa_nomes):
+        for lote in consultas_em_lotes(db, "*", ["paciente_cpf = ?"], (paciente_cpf,)):
+            for c in lote:
+                c["medico_nome"] = mapa_nomes.get(
+                    c.get("medico_cpf", ""), c.get("medico_cpf", "—")
+                )
+                yield c
 
-    return render_template(
+    return pagina_em_streaming(
         "agendapaciente.html",
-        consultas=consultas_paciente,
-        medicos=medicos,
-        cargos=cargos,
+        mensagens=get_flashed_messages(with_categories=True),
+        consultas=consultas_paciente(referencia["mapa_nomes"]),
+        medicos=referencia["medicos"],
+        cargos=referencia["cargos"],
         paciente_cpf=paciente_cpf,
     )
 
 
 @app.route("/horarios_disponiveis")
 def horarios_disponiveis():
+    """
+    Horários livres numa data. Com medico_cpf considera só aquele médico;
+    só com cargo considera todos os médicos do cargo.
+
+    Retorna {"horarios": [...], "medicos": {cpf: [...]}}, onde "horarios"
+    é a união dos horários em que algum dos médicos está livre.
+    """
     db = get_db()
 
     data = request.args.get("data") or ""
     medico_cpf = normalizar_cpf(request.args.get("medico_cpf") or "")
     cargo = (request.args.get("cargo") or "").strip()
 
-    if not data:
-        return jsonify({"horarios": []})
+    medicos = medicos_para_busca(cargo, medico_cpf)
+    if not data or not medicos:
+        return jsonify({"horarios": [], "medicos": {}})
 
-    # se veio cargo mas não veio médico, tenta achar um médico daquele cargo
-    if not medico_cpf and cargo:
-        cur = db.execute(
-            "SELECT CPF FROM usuarios WHERE tipo = ? AND cargo = ?",
-            (TIPO_MEDICO, cargo),
-        )
-        row = cur.fetchone()
-        if row:
-            medico_cpf = row["CPF"]
+    try:
+        livres = horarios_livres(db, medicos, data)[data]
+    except ValueError:
+        return jsonify({"erro": "Data inválida (use AAAA-MM-DD)."}), 400
 
-    if not medico_cpf:
-        return jsonify({"horarios": []})
+    uniao = 0
+    for mascara in livres.values():
+        uniao |= mascara
 
-    cur = db.execute(
-        """
-        SELECT hora
-          FROM consultas
-         WHERE medico_cpf = ?
-           AND data       = ?
-           AND status    != ?
-        """,
-        (medico_cpf, data, STATUS_CANCELADA),
+    return jsonify(
+        {
+            "horarios": horas_da_mascara(uniao),
+            "medicos": {cpf: horas_da_mascara(m) for cpf, m in livres.items()},
+        }
     )
-    ocupados = {r["hora"] for r in cur.fetchall()}
 
-    base_horarios = []
-    for h in range(8, 18):  # 08h até 17h
-        for m in (0, 30):
-            base_horarios.append(f"{h:02d}:{m:02d}")
 
-    livres = [h for h in base_horarios if h not in ocupados]
-    return jsonify({"horarios": livres})
+@app.route("/proximos_horarios")
+def proximos_horarios():
+    """
+    Próximos horários livres de um médico ou cargo nos próximos `dias`
+    (padrão 14), a partir de `data_inicio` (padrão hoje). Horários de
+    hoje que já passaram são ignorados.
+
+    Retorna {"proximo": {...} ou null, "horarios": [{data, hora, medicos}]}.
+    """
+    db = get_db()
+
+    medico_cpf = normalizar_cpf(request.args.get("medico_cpf") or "")
+    cargo = (request.args.get("cargo") or "").strip()
+    limite = ler_por_pagina(request.args.get("limite") or 10)
+    agora = datetime.now()
+
+    try:
+        inicio = datetime.strptime(
+            request.args.get("data_inicio") or agora.strftime("%Y-%m-%d"),
+            "%Y-%m-%d",
+        ).date()
+        dias = int(request.args.get("dias") or 14)
+    except ValueError:
+        return jsonify({"erro": "Parâmetros inválidos."}), 400
+
+    dias = max(1, min(dias, app.config["DIAS_BUSCA_MAXIMO"]))
+    medicos = medicos_para_busca(cargo, medico_cpf)
+    if not medicos:
+        return jsonify({"proximo": None, "horarios": []})
+
+    # nunca oferece horários que já passaram
+    a_partir_de = max(agora, datetime.combine(inicio, datetime.min.time()))
+    dias -= (a_partir_de.date() - inicio).days
+    resultado = []
+    if dias > 0:
+        resultado = proximos_livres(db, medicos, a_partir_de, dias, limite)
+
+    return jsonify(
+        {"proximo": resultado[0] if resultado else None, "horarios": resultado}
+    )
 
 
 @app.route("/solicitar_consulta", methods=["POST"])
@@ -850,6 +3892,12 @@ def solicitar_consulta():
         )
         return redirect(url_for("agendapaciente", paciente_cpf=paciente_cpf))
 
+    try:
+        data, hora = normalizar_horario(data, hora)
+    except ValueError:
+        flash("Data ou hora inválida.", "erro")
+        return redirect(url_for("agendapaciente", paciente_cpf=paciente_cpf))
+
     cur = db.execute(
         "SELECT 1 FROM usuarios WHERE CPF = ? AND tipo = ?",
         (paciente_cpf, TIPO_PACIENTE),
@@ -858,91 +3906,403 @@ def solicitar_consulta():
         flash("Paciente inválido.", "erro")
         return redirect(url_for("agendapaciente", paciente_cpf=paciente_cpf))
 
-    medicos_do_cargo = db.execute(
-        "SELECT * FROM usuarios WHERE tipo = ? AND cargo = ?",
-        (TIPO_MEDICO, cargo),
-    ).fetchall()
+    medicos_do_cargo = dados_referencia()["medicos_por_cargo"].get(cargo, [])
 
     if not medicos_do_cargo:
         flash("Não há médicos cadastrados para o cargo selecionado.", "erro")
         return redirect(url_for("agendapaciente", paciente_cpf=paciente_cpf))
 
-    medico_escolhido = None
-
     if medico_cpf:
-        medico_escolhido = next(
-            (m for m in medicos_do_cargo if m["CPF"] == medico_cpf), None
-        )
-        if not medico_escolhido:
+        if not any(m["CPF"] == medico_cpf for m in medicos_do_cargo):
             flash("Médico inválido para o cargo selecionado.", "erro")
             return redirect(url_for("agendapaciente", paciente_cpf=paciente_cpf))
+        candidatos = [medico_cpf]
+        escolheu_medico = True
     else:
-        medico_escolhido = medicos_do_cargo[0]
-        medico_cpf = medico_escolhido["CPF"]
+        # médico livre no horário, na ordem da estratégia de atribuição
+        candidatos = ordenar_candidatos(
+            db, [m["CPF"] for m in medicos_do_cargo], cargo, data
+        )
+        escolheu_medico = False
+
+    def ao_reservar(db, medico_cpf, consulta_id):
+        # mesma transação da reserva: um commit só
+        if not escolheu_medico:
+            registrar_rodizio(db, cargo, medico_cpf)
+        notificar(
+            db, paciente_cpf, "Sua consulta foi solicitada e aguarda aprovação."
+        )
 
-    db.execute(
-        """
-        INSERT INTO consultas
-            (paciente_cpf, medico_cpf, data, hora, tipo, status, observacoes, cargo)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (paciente_cpf, medico_cpf, data, hora, tipo, STATUS_SOLICITADA, obs, cargo),
-    )
-    db.commit()
+    try:
+        medico_cpf, _ = reservar_consulta(
+            db, paciente_cpf, candidatos, data, hora, tipo,
+            STATUS_SOLICITADA, obs, cargo, ao_reservar=ao_reservar,
+        )
+    except HorarioOcupado:
+        medicos = [m for m in medicos_do_cargo if m["CPF"] in candidatos]
+        flash(
+            "Esse horário acabou de ser ocupado."
+            + sugestao_horario(db, medicos, data, hora),
+            "erro",
+        )
+        return redirect(url_for("agendapaciente", paciente_cpf=paciente_cpf))
 
+    medico_escolhido = dados_referencia()["medicos_por_cpf"][medico_cpf]
+    canal_notificacoes.acordar()
     flash(
         f'Solicitação enviada! Médico atribuído: {medico_escolhido["nome"]}.',
         "ok",
     )
-    adicionar_notificacao(
-        paciente_cpf,
-        "Sua consulta foi solicitada e aguarda aprovação.",
-    )
     return redirect(url_for("agendapaciente", paciente_cpf=paciente_cpf))
 
 
+# ---------------------------------------------------------------------
+# Exportação da agenda (iCalendar e CSV)
+# ---------------------------------------------------------------------
+#
+# /agenda.ics (para assinar no app de calendário) e /agenda.csv (para
+# planilhas), no escopo de quem está logado: o médico recebe as próprias
+# consultas, o paciente as suas e o admin todas. Os dois aceitam
+# data_inicio e data_fim (YYYY-MM-DD, inclusivos).
+#
+# As linhas saem direto do cursor (índice por médico, paciente ou data,
+# já na ordem do ORDER BY), em lotes; a resposta é um gerador e nunca
+# existe a lista inteira em memória. ETag/Last-Modified vêm das versões
+# de consultas e usuarios, então um cliente de calendário que consulta a
+# cada poucos minutos recebe 304 enquanto nada mudar.
+
+COLUNAS_CSV_AGENDA = [
+    "id", "data", "hora", "tipo", "status", "cargo",
+    "paciente_cpf", "paciente_nome", "medico_cpf", "medico_nome",
+    "observacoes",
+]
+
+STATUS_ICAL = {
+    STATUS_SOLICITADA: "TENTATIVE",
+    STATUS_AGENDADA: "CONFIRMED",
+    STATUS_CONCLUIDA: "CONFIRMED",
+    STATUS_CANCELADA: "CANCELLED",
+}
+
+
+def escopo_agenda():
+    """
+    (condição SQL, parâmetros, título) da agenda do usuário logado, ou
+    None sem login.
+    """
+    cpf = session.get("cpf")
+    if not cpf:
+        return None
+    tipo = session.get("tipo")
+    if tipo == TIPO_ADMIN:
+        return "1 = 1", (), "Agenda da clínica"
+    nome = dados_referencia()["mapa_nomes"].get(cpf, cpf)
+    if tipo == TIPO_MEDICO:
+        return "medico_cpf = ?", (cpf,), f"Agenda - {nome}"
+    return "paciente_cpf = ?", (cpf,), f"Consultas - {nome}"
+
+
+def ler_periodo():
+    """(data_inicio, data_fim) da querystring; ValueError se inválido."""
+    datas = []
+    for nome in ("data_inicio", "data_fim"):
+        valor = (request.args.get(nome) or "").strip()
+        if valor:
+            valor = datetime.strptime(valor, "%Y-%m-%d").strftime("%Y-%m-%d")
+        datas.append(valor or None)
+    if datas[0] and datas[1] and datas[0] > datas[1]:
+        raise ValueError("data_inicio depois de data_fim")
+    return tuple(datas)
+
+
+def consultas_para_exportar(db, condicao: str, params: tuple, periodo: tuple):
+    """Lotes (consultas_em_lotes) das consultas do escopo e período."""
+    condicoes = [condicao]
+    params = list(params)
+    if periodo[0]:
+        condicoes.append("data >= ?")
+        params.append(periodo[0])
+    if periodo[1]:
+        condicoes.append("data <= ?")
+        params.append(periodo[1])
+    return consultas_em_lotes(
+        db,
+        "id, data, hora, tipo, status, cargo, paciente_cpf, medico_cpf, observacoes",
+        condicoes,
+        params,
+    )
+
+
+def texto_ical(valor) -> str:
+    """Escapa um valor TEXT do iCalendar (RFC 5545, 3.3.11)."""
+    return (
+        str(valor or "")
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def linha_ical(nome: str, valor: str) -> str:
+    """
+    Uma linha de conteúdo terminada em CRLF, dobrada em 75 bytes (RFC 5545,
+    3.1) sem partir caracteres UTF-8 ao meio.
+    """
+    dados = f"{nome}:{valor}".encode("utf-8")
+    partes = []
+    limite = 75
+    while len(dados) > limite:
+        corte = limite
+        while dados[corte] & 0xC0 == 0x80:  # byte de continuação
+            corte -= 1
+        partes.append(dados[:corte])
+        dados = dados[corte:]
+        limite = 74  # a linha seguinte começa com um espaço
+    partes.append(dados)
+    return "\r\n ".join(p.decode("utf-8") for p in partes) + "\r\n"
+
+
+def evento_ical(c: dict, tipo_usuario: str, dominio: str, carimbo: str) -> str:
+    """
+    VEVENT de uma consulta, com o resumo do ponto de vista do usuário.
+    ValueError se data/hora não estiverem nos formatos da reserva.
+    """
+    inicio = datetime.strptime(f"{c['data']} {c['hora']}", "%Y-%m-%d %H:%M")
+    fim = inicio + timedelta(minutes=app.config["DURACAO_SLOT_MINUTOS"])
+    if tipo_usuario == TIPO_MEDICO:
+        resumo = f"{c['tipo']}: {c['paciente_nome']}"
+    elif tipo_usuario == TIPO_ADMIN:
+        resumo = f"{c['tipo']}: {c['paciente_nome']} com {c['medico_nome']}"
+    else:
+        resumo = f"{c['tipo']} com {c['medico_nome']}"
+        if c["cargo"]:
+            resumo += f" ({c['cargo']})"
+
+    linhas = [
+        linha_ical("BEGIN", "VEVENT"),
+        linha_ical("UID", f"consulta-{c['id']}@{dominio}"),
+        linha_ical("DTSTAMP", carimbo),
+        # horário local da clínica, sem fuso ("floating time")
+        linha_ical("DTSTART", inicio.strftime("%Y%m%dT%H%M%S")),
+        linha_ical("DTEND", fim.strftime("%Y%m%dT%H%M%S")),
+        linha_ical("SUMMARY", texto_ical(resumo)),
+        linha_ical("STATUS", STATUS_ICAL.get(c["status"], "CONFIRMED")),
+    ]
+    if c["observacoes"]:
+        linhas.append(linha_ical("DESCRIPTION", texto_ical(c["observacoes"])))
+    linhas.append(linha_ical("END", "VEVENT"))
+    return "".join(linhas)
+
+
+class _Eco:
+    """Arquivo falso para csv.writer: writerow devolve a linha formatada."""
+
+    def write(self, texto):
+        return texto
+
+
+def exportar_agenda(formato: str):
+    """Corpo comum de /agenda.ics e /agenda.csv."""
+    db = get_db()
+    escopo = escopo_agenda()
+    if escopo is None:
+        return "Faça login para exportar a agenda.", 401
+    try:
+        periodo = ler_periodo()
+    except ValueError:
+        return "Parâmetros inválidos (use data_inicio e data_fim como YYYY-MM-DD).", 400
+
+    etag, alterada_em = validadores_pagina("consultas", "usuarios")
+    nao_modificada = pagina_nao_modificada(etag, alterada_em)
+    if nao_modificada is not None:
+        return nao_modificada
+
+    condicao, params, titulo = escopo
+    mapa_nomes = dados_referencia()["mapa_nomes"]
+    lotes = consultas_para_exportar(db, condicao, params, periodo)
+
+    def consultas():
+        for lote in lotes:
+            for c in lote:
+                c["paciente_nome"] = mapa_nomes.get(c["paciente_cpf"], c["paciente_cpf"])
+                c["medico_nome"] = mapa_nomes.get(c["medico_cpf"], c["medico_cpf"])
+            yield lote
+
+    if formato == "ics":
+        tipo_usuario = session.get("tipo")
+        dominio = request.host.split(":")[0]
+        carimbo = (alterada_em or datetime.now(timezone.utc)).strftime("%Y%m%dT%H%M%SZ")
+
+        def gerar():
+            yield (
+                linha_ical("BEGIN", "VCALENDAR")
+                + linha_ical("VERSION", "2.0")
+                + linha_ical("PRODID", "-//Clinica//Agenda//PT-BR")
+                + linha_ical("CALSCALE", "GREGORIAN")
+                + linha_ical("METHOD", "PUBLISH")
+                + linha_ical("X-WR-CALNAME", texto_ical(titulo))
+            )
+            for lote in consultas():
+                eventos = []
+                for c in lote:
+                    try:
+                        eventos.append(evento_ical(c, tipo_usuario, dominio, carimbo))
+                    except ValueError:
+                        # data/hora gravadas antes da validação da reserva
+                        app.logger.warning(
+                            "Consulta %s fora do calendário: data=%r hora=%r",
+                            c["id"], c["data"], c["hora"],
+                        )
+                yield "".join(eventos)
+            yield linha_ical("END", "VCALENDAR")
+
+        mimetype = "text/calendar"
+    else:
+        escritor = csv.writer(_Eco())
+
+        def gerar():
+            yield escritor.writerow(COLUNAS_CSV_AGENDA)
+            for lote in consultas():
+                yield "".join(
+                    escritor.writerow([c[k] for k in COLUNAS_CSV_AGENDA]) for c in lote
+                )
+
+        mimetype = "text/csv"
+
+    resposta = resposta_em_streaming(gerar(), mimetype=mimetype)
+    resposta.headers["Content-Disposition"] = f'inline; filename="agenda.{formato}"'
+    return com_validadores(resposta, etag, alterada_em)
+
+
+@app.route("/agenda.ics")
+def agenda_ics():
+    return exportar_agenda("ics")
+
+
+@app.route("/agenda.csv")
+def agenda_csv():
+    return exportar_agenda("csv")
+
+
 # ---------------------------------------------------------------------
 # Notificações (JSON para o front)
 # ---------------------------------------------------------------------
 
+def estado_notificacoes(db, cpf: str):
+    """
+    (não lidas, ETag) do usuário, lidos de notificacoes_estado - uma
+    busca por chave primária, mantida por triggers em notificacoes.
+    """
+    row = db.execute(
+        "SELECT qtd, ultimo_id, versao FROM notificacoes_estado WHERE cpf = ?",
+        (cpf,),
+    ).fetchone()
+    if row is None:
+        return 0, "0-0"
+    return row["qtd"], f'{row["ultimo_id"]}-{row["versao"]}'
+
+
+def resposta_nao_modificada(etag: str):
+    """
+    Resposta 304 se o cliente já tem a versão `etag`, senão None. A
+    comparação é fraca: com gzip a ETag volta como W/"..." (CompressaoGzip).
+    """
+    if request.if_none_match.contains_weak(etag):
+        resposta = app.response_class(status=304)
+        resposta.set_etag(etag)
+        resposta.headers["Cache-Control"] = "private, no-cache"
+        return resposta
+    return None
+
+
+def com_etag(resposta, etag: str):
+    """Marca a resposta com ETag e exige revalidação a cada uso."""
+    resposta.set_etag(etag)
+    resposta.headers["Cache-Control"] = "private, no-cache"
+    return resposta
+
+
 @app.route("/notificacoes_count")
 def notificacoes_count():
     cpf = session.get("cpf")
     if not cpf:
         return {"count": 0}
 
-    db = get_db()
-    cur = db.execute(
-        """
-        SELECT COUNT(*) AS qtd
-          FROM notificacoes
-         WHERE cpf = ?
-           AND lida = 0
-        """,
-        (cpf,),
-    )
-    row = cur.fetchone()
-    return {"count": row["qtd"] if row else 0}
+    qtd, etag = estado_notificacoes(get_db(), cpf)
+    nao_modificada = resposta_nao_modificada(etag)
+    if nao_modificada is not None:
+        return nao_modificada
+
+    return com_etag(jsonify({"count": qtd}), etag)
+
+
+NOTIFICACOES_POR_PAGINA = 50
+NOTIFICACOES_POR_PAGINA_MAXIMO = 200
 
 
 @app.route("/notificacoes_lista")
 def notificacoes_lista():
+    """
+    Notificações do usuário, mais recentes primeiro, em páginas de até
+    `limit` itens (padrão NOTIFICACOES_POR_PAGINA).
+
+    - before_id: página seguinte (mais antigas que esse id).
+    - since_id: só as mais novas que esse id (para atualizar a lista).
+
+    O corpo continua sendo uma lista; o link para a próxima página vai no
+    cabeçalho Link (rel="next").
+    """
     cpf = session.get("cpf")
     if not cpf:
         return jsonify([])
 
+    try:
+        since_id = int(request.args.get("since_id") or 0)
+        before_id = int(request.args.get("before_id") or 0)
+        limite = int(request.args.get("limit") or NOTIFICACOES_POR_PAGINA)
+    except ValueError:
+        return jsonify({"erro": "Parâmetros inválidos."}), 400
+    limite = max(1, min(limite, NOTIFICACOES_POR_PAGINA_MAXIMO))
+
     db = get_db()
+    _, etag = estado_notificacoes(db, cpf)
+    etag = f"{etag}.{since_id}.{before_id}.{limite}"
+    nao_modificada = resposta_nao_modificada(etag)
+    if nao_modificada is not None:
+        return nao_modificada
+
+    condicoes = ["cpf = ?"]
+    params = [cpf]
+    if since_id:
+        condicoes.append("id > ?")
+        params.append(since_id)
+    if before_id:
+        condicoes.append("id < ?")
+        params.append(before_id)
+
     cur = db.execute(
-        """
-        SELECT texto, lida, data
+        f"""
+        SELECT id, texto, lida, data
           FROM notificacoes
-         WHERE cpf = ?
-         ORDER BY data DESC
+         WHERE {" AND ".join(condicoes)}
+         ORDER BY id DESC
+         LIMIT ?
         """,
-        (cpf,),
+        (*params, limite + 1),
     )
     notificacoes = [dict(r) for r in cur.fetchall()]
-    return jsonify(notificacoes)
+
+    resposta = jsonify(notificacoes[:limite])
+    if len(notificacoes) > limite:
+        proxima = url_for(
+            "notificacoes_lista",
+            before_id=notificacoes[limite - 1]["id"],
+            limit=limite,
+        )
+        resposta.headers["Link"] = f'<{proxima}>; rel="next"'
+    return com_etag(resposta, etag)
 
 
 @app.route("/notificacoes_marcar_lidas", methods=["POST"])
@@ -952,17 +4312,696 @@ def notificacoes_marcar_lidas():
         return ("", 204)
 
     db = get_db()
-    db.execute("UPDATE notificacoes SET lida = 1 WHERE cpf = ?", (cpf,))
+    db.execute(
+        "UPDATE notificacoes SET lida = 1 WHERE cpf = ? AND lida = 0", (cpf,)
+    )
     db.commit()
     return ("", 204)
 
 
+@app.cli.command("limpar-notificacoes")
+@click.option(
+    "--dias",
+    type=int,
+    default=None,
+    help="Idade mínima (padrão: RETENCAO_NOTIFICACOES_DIAS).",
+)
+@click.option(
+    "--modo",
+    type=click.Choice(["arquivar", "apagar"]),
+    default="arquivar",
+    show_default=True,
+)
+@click.option("--lote", default=500, show_default=True)
+@click.option(
+    "--pausa",
+    default=0.05,
+    show_default=True,
+    help="Segundos entre lotes, para não monopolizar o lock de escrita.",
+)
+def limpar_notificacoes_command(dias, modo, lote, pausa):
+    """
+    Remove da tabela principal as notificações já lidas mais antigas que
+    `dias`, arquivando em notificacoes_arquivo (ou apagando).
+
+    Trabalha em lotes curtos, cada um na sua transação, percorrendo a
+    tabela pelo id: o lock de escrita nunca fica preso por muito tempo e
+    as requisições continuam sendo atendidas entre um lote e outro.
+    """
+    init_db()
+    db = get_db()
+
+    dias = app.config["RETENCAO_NOTIFICACOES_DIAS"] if dias is None else dias
+    corte = (datetime.now() - timedelta(days=dias)).strftime("%Y-%m-%d %H:%M")
+    agora = datetime.now().strftime("%Y-%m-%d %H:%M")
+
+    ultimo_id = 0
+    total = lotes = 0
+    inicio = time.perf_counter()
+
+    while True:
+        db.execute("BEGIN IMMEDIATE")
+        ids = [
+            r[0]
+            for r in db.execute(
+                """
+                SELECT id FROM notificacoes
+                 WHERE id > ? AND lida = 1 AND data < ?
+                 ORDER BY id
+                 LIMIT ?
+                """,
+                (ultimo_id, corte, lote),
+            )
+        ]
+        if not ids:
+            db.rollback()
+            break
+
+        marcadores = ", ".join("?" * len(ids))
+        if modo == "arquivar":
+            db.execute(
+                f"""
+                INSERT OR REPLACE INTO notificacoes_arquivo
+                    (id, cpf, texto, lida, data, arquivada_em)
+                SELECT id, cpf, texto, lida, data, ?
+                  FROM notificacoes
+                 WHERE id IN ({marcadores})
+                """,
+                (agora, *ids),
+            )
+        db.execute(f"DELETE FROM notificacoes WHERE id IN ({marcadores})", ids)
+        db.commit()
+
+        ultimo_id = ids[-1]
+        total += len(ids)
+        lotes += 1
+        time.sleep(pausa)
+
+    duracao = time.perf_counter() - inicio
+    acao = "arquivadas" if modo == "arquivar" else "apagadas"
+    print(
+        f"{total} notificações {acao} em {lotes} lote(s), "
+        f"{duracao:.2f}s (lidas antes de {corte})."
+    )
+
+
+# ---------------------------------------------------------------------
+# Notificações em tempo real (Server-Sent Events)
+# ---------------------------------------------------------------------
+
+class CanalNotificacoes:
+    """
+    Pub/sub de notificações dentro do processo, com distribuição entre
+    workers feita pelo próprio SQLite.
+
+    Cada conexão SSE aberta assina o CPF do usuário e recebe uma fila.
+    Uma thread por worker (iniciada só quando há assinantes) lê as
+    notificações novas (id > último visto) a cada SSE_INTERVALO_POLL
+    segundos e entrega às filas dos CPFs assinados, então notificações
+    criadas em qualquer worker chegam a todos. adicionar_notificacao()
+    acorda a thread na hora, sem esperar o intervalo.
+    """
+
+    TAMANHO_FILA = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._assinantes = {}
+        self._acordar = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._conexoes = 0
+        self._recusadas = 0
+
+    def ocupar_conexao(self, maximo: int) -> bool:
+        """Reserva uma vaga de stream neste worker; False se lotado."""
+        with self._lock:
+            if self._conexoes >= maximo:
+                self._recusadas += 1
+                return False
+            self._conexoes += 1
+            return True
+
+    def liberar_conexao(self):
+        with self._lock:
+            self._conexoes -= 1
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {
+                "conexoes": self._conexoes,
+                "recusadas": self._recusadas,
+                "cpfs_assinados": len(self._assinantes),
+            }
+
+    def assinar(self, cpf: str) -> "queue.Queue":
+        fila = queue.Queue(maxsize=self.TAMANHO_FILA)
+        with self._lock:
+            self._assinantes.setdefault(cpf, set()).add(fila)
+            self._garantir_thread()
+        return fila
+
+    def cancelar(self, cpf: str, fila):
+        with self._lock:
+            filas = self._assinantes.get(cpf)
+            if filas:
+                filas.discard(fila)
+                if not filas:
+                    del self._assinantes[cpf]
+
+    def acordar(self):
+        self._acordar.set()
+
+    def publicar(self, cpf: str, evento: dict):
+        with self._lock:
+            filas = list(self._assinantes.get(cpf, ()))
+        for fila in filas:
+            try:
+                fila.put_nowait(evento)
+            except queue.Full:
+                # cliente lento: perde o evento, mas o próximo contador
+                # (ou a reconexão com Last-Event-ID) corrige o estado
+                pass
+
+    def _garantir_thread(self):
+        # depois de um fork a thread do pai não existe no filho
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._vigiar, name="canal-notificacoes", daemon=True
+        )
+        self._thread.start()
+
+    def _vigiar(self):
+        ultimo_id = None
+        while True:
+            with self._lock:
+                cpfs = list(self._assinantes)
+            if not cpfs:
+                with self._lock:
+                    if not self._assinantes:
+                        self._thread = None
+                        return
+                continue
+
+            try:
+                db = conexoes.obter(app.config)
+                if ultimo_id is None:
+                    ultimo_id = db.execute(
+                        "SELECT COALESCE(MAX(id), 0) FROM notificacoes"
+                    ).fetchone()[0]
+                else:
+                    ultimo_id = self._entregar_novas(db, ultimo_id)
+            except sqlite3.Error:
+                app.logger.exception("Falha ao consultar notificações novas")
+
+            self._acordar.wait(app.config["SSE_INTERVALO_POLL"])
+            self._acordar.clear()
+
+    def _entregar_novas(self, db, ultimo_id: int) -> int:
+        cur = db.execute(
+            "SELECT id, cpf, texto, data FROM notificacoes WHERE id > ? ORDER BY id",
+            (ultimo_id,),
+        )
+        for row in cur.fetchall():
+            ultimo_id = row["id"]
+            if row["cpf"] in self._assinantes:
+                self.publicar(row["cpf"], dict(row))
+        return ultimo_id
+
+
+canal_notificacoes = CanalNotificacoes()
+
+
+def evento_sse(evento: str, dados, evento_id=None) -> str:
+    """Formata uma mensagem no protocolo text/event-stream."""
+    linhas = []
+    if evento_id is not None:
+        linhas.append(f"id: {evento_id}")
+    linhas.append(f"event: {evento}")
+    linhas.append("data: " + json.dumps(dados, ensure_ascii=False))
+    return "\n".join(linhas) + "\n\n"
+
+
+@app.route("/notificacoes_stream")
+def notificacoes_stream():
+    """
+    Canal SSE com o contador de não lidas e cada notificação nova, assim
+    que é criada. /notificacoes_count e /notificacoes_lista continuam
+    disponíveis para navegadores sem EventSource.
+
+    Eventos: "contador" {"count": n} e "notificacao" {id, texto, data}.
+    Ao reconectar, o navegador manda Last-Event-ID e recebe o que perdeu.
+    """
+    cpf = session.get("cpf")
+    if not cpf:
+        return ("", 204)
+
+    try:
+        ultimo_visto = int(request.headers.get("Last-Event-ID") or 0)
+    except ValueError:
+        ultimo_visto = 0
+
+    heartbeat = app.config["SSE_HEARTBEAT"]
+    duracao_maxima = app.config["SSE_DURACAO_MAXIMA"]
+
+    def gerar():
+        fila = canal_notificacoes.assinar(cpf)
+        fim = time.monotonic() + duracao_maxima
+        try:
+            yield "retry: 5000\n\n"
+
+            db = conexoes.obter(app.config)
+            if ultimo_visto:
+                perdidas = db.execute(
+                    """
+                    SELECT id, texto, data FROM notificacoes
+                     WHERE cpf = ? AND id > ?
+                     ORDER BY id
+                    """,
+                    (cpf, ultimo_visto),
+                ).fetchall()
+                for n in perdidas:
+                    yield evento_sse("notificacao", dict(n), n["id"])
+            yield evento_sse("contador", {"count": estado_notificacoes(db, cpf)[0]})
+
+            while time.monotonic() < fim:
+                try:
+                    n = fila.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+
+                yield evento_sse(
+                    "notificacao",
+                    {"id": n["id"], "texto": n["texto"], "data": n["data"]},
+                    n["id"],
+                )
+                db = conexoes.obter(app.config)
+                yield evento_sse("contador", {"count": estado_notificacoes(db, cpf)[0]})
+        finally:
+            canal_notificacoes.cancelar(cpf, fila)
+
+    if not canal_notificacoes.ocupar_conexao(app.config["SSE_CONEXOES_MAXIMAS"]):
+        # todas as vagas de stream deste worker ocupadas: com o 503 o
+        # EventSource fecha de vez e a página passa para o polling
+        return Response(
+            "Canal de notificações lotado; use /notificacoes_count.",
+            503,
+            mimetype="text/plain",
+            headers={"Retry-After": "60"},
+        )
+
+    resposta = Response(
+        gerar(),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # evita que proxies (nginx) segurem o stream em buffer
+            "X-Accel-Buffering": "no",
+        },
+    )
+    # a vaga é devolvida quando o servidor fecha a resposta, mesmo que o
+    # gerador nunca tenha começado (cliente que desconectou antes)
+    resposta.call_on_close(canal_notificacoes.liberar_conexao)
+    return resposta
+
+
+# ---------------------------------------------------------------------
+# Compressão das respostas (middleware WSGI)
+# ---------------------------------------------------------------------
+
+class CompressaoGzip:
+    """
+    Middleware WSGI que comprime com gzip as respostas dos tipos em
+    COMPRESSAO_TIPOS, quando o cliente aceita gzip.
+
+    A decisão é tomada no start_response, só pelos cabeçalhos (status,
+    Content-Type, Content-Encoding, Cache-Control e Content-Length):
+
+    - Não comprimível (text/event-stream e outros tipos fora da lista,
+      estáticos .gz/.br, 204/206/304, no-transform, HEAD, ou menor que
+      COMPRESSAO_MINIMO): o corpo original passa direto, sem buffer nem
+      cópia - o SSE continua entregando cada evento na hora.
+    - Com Content-Length (o normal no Flask): o corpo já está todo em
+      memória; comprime de uma vez e informa o ganho em Server-Timing.
+    - Sem Content-Length (streaming): comprime pedaço a pedaço, desde o
+      primeiro, com Z_SYNC_FLUSH - cada pedaço chega ao navegador assim
+      que é gerado.
+
+    A ETag vira fraca (W/), pois o corpo comprimido não é byte a byte o
+    original. Métricas por tipo (bytes, razão, tempo de CPU) em /saude.
+    """
+
+    def __init__(self, app_wsgi):
+        self.app_wsgi = app_wsgi
+        self._lock = threading.Lock()
+        self._metricas = {}
+
+    def __call__(self, environ, start_response):
+        config = app.config
+        if (
+            not config["COMPRESSAO_ATIVA"]
+            or environ.get("REQUEST_METHOD") == "HEAD"
+            or "gzip" not in environ.get("HTTP_ACCEPT_ENCODING", "").lower()
+        ):
+            return self.app_wsgi(environ, start_response)
+
+        estado = {}
+
+        def iniciar(status, headers, exc_info=None):
+            modo, tipo = self._modo(status, headers, config)
+            estado["modo"] = modo
+            if modo is None:
+                return start_response(status, headers, exc_info)
+            estado["inicio"] = (status, headers, exc_info, tipo)
+            return estado.setdefault("escrito", []).append
+
+        corpo = self.app_wsgi(environ, iniciar)
+        if "modo" in estado and estado["modo"] is None:
+            # passa direto: nem o iterável é trocado (sendfile continua valendo)
+            return corpo
+        return self._comprimir(corpo, estado, start_response, config)
+
+    @staticmethod
+    def _modo(status, headers, config):
+        """(None | "inteiro" | "streaming", tipo) a partir dos cabeçalhos."""
+        cabecalhos = {k.lower(): v for k, v in headers}
+        tipo = cabecalhos.get("content-type", "").split(";")[0].strip().lower()
+        if (
+            status[:3] in ("204", "206", "304")
+            or "content-encoding" in cabecalhos
+            or "no-transform" in cabecalhos.get("cache-control", "")
+            or tipo not in config["COMPRESSAO_TIPOS"]
+        ):
+            return None, tipo
+        tamanho = cabecalhos.get("content-length")
+        if tamanho is None:
+            return "streaming", tipo
+        if not tamanho.isdigit() or int(tamanho) < config["COMPRESSAO_MINIMO"]:
+            return None, tipo
+        return "inteiro", tipo
+
+    @staticmethod
+    def _cabecalhos_comprimidos(headers):
+        cabecalhos = {k.lower(): v for k, v in headers}
+        novos = [
+            (k, v)
+            for k, v in headers
+            if k.lower() not in ("content-length", "etag", "vary")
+        ]
+        novos.append(("Content-Encoding", "gzip"))
+        vary = [v.strip() for v in cabecalhos.get("vary", "").split(",") if v.strip()]
+        novos.append(("Vary", ", ".join(vary + ["Accept-Encoding"])))
+        etag = cabecalhos.get("etag")
+        if etag:
+            novos.append(("ETag", etag if etag.startswith("W/") else "W/" + etag))
+        return novos
+
+    def _comprimir(self, corpo, estado, start_response, config):
+        try:
+            pedacos = iter(corpo)
+            primeiros = []
+            if "modo" not in estado:
+                # app que só chama start_response ao gerar o primeiro pedaço
+                pedaco = next(pedacos, None)
+                if pedaco is not None:
+                    primeiros.append(pedaco)
+                if estado.get("modo") is None:
+                    yield from primeiros
+                    yield from pedacos
+                    return
+            primeiros = estado.pop("escrito", []) + primeiros
+
+            status, headers, exc_info, tipo = estado["inicio"]
+            novos = self._cabecalhos_comprimidos(headers)
+            nivel = config["COMPRESSAO_NIVEL"]
+
+            if estado["modo"] == "inteiro":
+                original = b"".join(itertools.chain(primeiros, pedacos))
+                inicio = time.thread_time()
+                dados = gzip.compress(original, nivel)
+                cpu = time.thread_time() - inicio
+                novos.append(("Content-Length", str(len(dados))))
+                novos.append(
+                    (
+                        "Server-Timing",
+                        f'gzip;dur={cpu * 1000:.2f};desc="{len(original)} -> {len(dados)} bytes"',
+                    )
+                )
+                start_response(status, novos, exc_info)
+                self._registrar(tipo, len(original), len(dados), cpu)
+                yield dados
+                return
+
+            compressor = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+            entrada = saida = 0
+            cpu = 0.0
+            start_response(status, novos, exc_info)
+            for pedaco in itertools.chain(primeiros, pedacos):
+                if not pedaco:
+                    continue
+                inicio = time.thread_time()
+                dados = compressor.compress(pedaco) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                cpu += time.thread_time() - inicio
+                entrada += len(pedaco)
+                saida += len(dados)
+                yield dados
+            dados = compressor.flush()
+            saida += len(dados)
+            self._registrar(tipo, entrada, saida, cpu)
+            yield dados
+        finally:
+            if hasattr(corpo, "close"):
+                corpo.close()
+
+    def _registrar(self, tipo, entrada, saida, cpu):
+        with self._lock:
+            m = self._metricas.setdefault(
+                tipo, {"respostas": 0, "bytes_entrada": 0, "bytes_saida": 0, "cpu_s": 0.0}
+            )
+            m["respostas"] += 1
+            m["bytes_entrada"] += entrada
+            m["bytes_saida"] += saida
+            m["cpu_s"] += cpu
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {
+                tipo: {
+                    "respostas": m["respostas"],
+                    "bytes_entrada": m["bytes_entrada"],
+                    "bytes_saida": m["bytes_saida"],
+                    "razao": round(m["bytes_saida"] / max(m["bytes_entrada"], 1), 3),
+                    "cpu_ms": round(m["cpu_s"] * 1000, 1),
+                    "cpu_us_por_kb": round(
+                        m["cpu_s"] * 1e6 / max(m["bytes_entrada"] / 1024, 1), 1
+                    ),
+                }
+                for tipo, m in self._metricas.items()
+            }
+
+
+compressao = CompressaoGzip(app.wsgi_app)
+app.wsgi_app = compressao
+
+
+# ---------------------------------------------------------------------
+# Inicialização (create_app) e aquecimento dos workers
+# ---------------------------------------------------------------------
+
+# tempos de partida deste processo (ms), mostrados em /saude
+partida = {}
+
+
+def esquema_atualizado(db) -> bool:
+    """True se o banco já tem todas as migrações de MIGRACOES."""
+    try:
+        return versao_esquema(db) >= MIGRACOES[-1][0]
+    except sqlite3.OperationalError:  # schema_version ainda não existe
+        return False
+
+
+def inicializar_banco() -> bool:
+    """
+    Cria o esquema e os usuários fixos uma única vez, mesmo com vários
+    workers (ou --preload) subindo ao mesmo tempo. Se o banco já está na
+    última versão não faz nada; senão uma trava de arquivo ao lado do
+    banco deixa só um processo por vez rodar init_db, e quem esperou
+    relê a versão antes. Retorna True se este processo inicializou.
+    """
+    with app.app_context():
+        db = get_db()
+        if esquema_atualizado(db):
+            return False
+
+        # trava num arquivo próprio: fechar um descritor do próprio banco
+        # soltaria as travas POSIX que o SQLite mantém nele
+        with open(app.config["DATABASE"] + ".init.lock", "w") as trava:
+            if fcntl is not None:
+                fcntl.flock(trava, fcntl.LOCK_EX)
+            try:
+                if esquema_atualizado(db):
+                    return False
+                init_db()
+                inicializar_usuarios_fixos()
+                return True
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(trava, fcntl.LOCK_UN)
+
+
+def create_app(config: dict = None):
+    """
+    Prepara e devolve a aplicação (Procfile: gunicorn "app:create_app()").
+
+    Aplica `config` sobre app.config e garante o esquema do banco
+    (inicializar_banco). Pode ser chamada mais de uma vez; o trabalho de
+    inicialização só acontece na primeira de cada processo. O aquecimento
+    fica para depois do fork, em cada worker: ver aquecer().
+    """
+    if config:
+        app.config.update(config)
+    configurar_cache_bytecode()
+
+    if "create_app_ms" not in partida:
+        inicio = time.perf_counter()
+        partida["modulo_ms"] = round((inicio - _INICIO_MODULO) * 1000, 1)
+        partida["inicializou_banco"] = inicializar_banco()
+        partida["create_app_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    return app
+
+
+def aquecer() -> dict:
+    """
+    Deixa o worker atual pronto antes da primeira requisição real: abre a
+    conexão SQLite deste processo, passa pelas consultas quentes
+    (CONSULTAS_INDEXADAS) para trazer os índices ao cache de páginas,
+    carrega o cache de dados de referência e compila todos os templates.
+
+    Chamada pelo gunicorn em cada worker (gunicorn.conf.py) e pelo
+    `python app.py`. Retorna os tempos, também guardados em `partida`.
+    """
+    inicio = time.perf_counter()
+
+    with app.test_request_context():
+        db = get_db()
+        for _, sql, params in CONSULTAS_INDEXADAS:
+            db.execute(sql, params).fetchall()
+        dados_referencia()
+    banco_ms = (time.perf_counter() - inicio) * 1000
+
+    for nome in app.jinja_env.list_templates():
+        app.jinja_env.get_template(nome)
+
+    partida.update(
+        pid=os.getpid(),
+        aquecimento_banco_ms=round(banco_ms, 1),
+        aquecimento_ms=round((time.perf_counter() - inicio) * 1000, 1),
+    )
+    return dict(partida)
+
+
+_SCRIPT_PARTIDA = """
+import json, sys, time
+t0 = time.perf_counter()
+import app as modulo
+t1 = time.perf_counter()
+aplicacao = modulo.create_app()
+t2 = time.perf_counter()
+if sys.argv[1] == "1":
+    modulo.aquecer()
+t3 = time.perf_counter()
+cliente = aplicacao.test_client()
+with cliente.session_transaction() as sessao:
+    sessao["cpf"], sessao["tipo"] = sys.argv[3], sys.argv[4]
+tempos = []
+for _ in range(2):
+    inicio = time.perf_counter()
+    cliente.get(sys.argv[2]).get_data()
+    tempos.append(time.perf_counter() - inicio)
+ms = lambda x: round(x * 1000, 1)
+print(json.dumps({
+    "import": ms(t1 - t0), "create_app": ms(t2 - t1), "aquecer": ms(t3 - t2),
+    "primeira": ms(tempos[0]), "segunda": ms(tempos[1]),
+}))
+"""
+
+
+@app.cli.command("medir-partida")
+@click.option("--rota", default="/agendaadmin", show_default=True)
+@click.option("--cpf", default="00000000001", show_default=True, help="Usuário da sessão.")
+@click.option("--tipo", default=TIPO_ADMIN, show_default=True)
+@click.option("--repeticoes", default=3, show_default=True)
+def medir_partida_command(rota, cpf, tipo, repeticoes):
+    """
+    Mede a partida a frio em processos novos, com e sem aquecer():
+    import do módulo, create_app, aquecimento e as duas primeiras
+    requisições à `rota` (mediana das repetições, em ms).
+    """
+    import subprocess
+
+    init_db()
+    ambiente = dict(os.environ)
+    ambiente["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [app.root_path, ambiente.get("PYTHONPATH")])
+    )
+
+    print(f"{'':10} {'import':>8} {'create_app':>10} {'aquecer':>8} {'1ª req':>8} {'2ª req':>8}")
+    for aquecido in ("0", "1"):
+        medidas = []
+        for _ in range(repeticoes):
+            saida = subprocess.run(
+                [sys.executable, "-c", _SCRIPT_PARTIDA, aquecido, rota, cpf, tipo],
+                env=ambiente,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            medidas.append(json.loads(saida.stdout.strip().splitlines()[-1]))
+
+        def mediana(chave):
+            return sorted(m[chave] for m in medidas)[len(medidas) // 2]
+
+        print(
+            f"{'aquecido' if aquecido == '1' else 'frio':10} {mediana('import'):8.1f} "
+            f"{mediana('create_app'):10.1f} {mediana('aquecer'):8.1f} "
+            f"{mediana('primeira'):8.1f} {mediana('segunda'):8.1f}"
+        )
+
+
+# ---------------------------------------------------------------------
+# Saúde do serviço
+# ---------------------------------------------------------------------
+
+@app.route("/saude")
+def saude():
+    """Health check para o balanceador: confere a conexão com o banco."""
+    db = get_db()
+    if not conexoes.saudavel(db):
+        return jsonify({"status": "erro"}), 503
+
+    return jsonify(
+        {
+            "status": "ok",
+            "pid": os.getpid(),
+            "journal_mode": db.execute("PRAGMA journal_mode").fetchone()[0],
+            "versao_esquema": versao_esquema(db),
+            "fila_notificacoes": fila_notificacoes.metricas(),
+            "partida": partida,
+            "fragmentos": cache_fragmentos.metricas(),
+            "compressao": compressao.metricas(),
+            "sse": canal_notificacoes.metricas(),
+        }
+    )
+
+
 # ---------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------
 
 if __name__ == "__main__":
-    with app.app_context():
-        init_db()
-        inicializar_usuarios_fixos()
+    create_app()
+    aquecer()
     app.run(debug=True)
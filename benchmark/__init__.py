@@ -0,0 +1,13 @@
+"""
+Benchmark da aplicação com uma clínica sintética.
+
+Gera um banco SQLite descartável com pacientes, médicos por cargo, anos de
+consultas e notificações (benchmark.dados) e mede cada rota pelo test
+client do Flask (benchmark.rotas): latência p50/p95/p99, comandos SQL por
+requisição e pico de memória.
+
+Uso, a partir da raiz do projeto:
+
+    python -m benchmark --pacientes 5000 --anos 2 --saida base.json
+    python -m benchmark --pacientes 5000 --anos 2 --comparar base.json
+"""
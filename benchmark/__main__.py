@@ -0,0 +1,120 @@
+"""python -m benchmark: gera a clínica sintética, mede e compara."""
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+from . import dados, rotas
+
+
+def _argumentos():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmark",
+        description="Benchmark das rotas com uma clínica sintética.",
+    )
+    parser.add_argument("--pacientes", type=int, default=2000)
+    parser.add_argument("--medicos-por-cargo", type=int, default=4)
+    parser.add_argument("--cargos", type=int, default=4, help=f"até {len(dados.CARGOS)}")
+    parser.add_argument("--anos", type=float, default=1.0, help="anos de consultas passadas")
+    parser.add_argument("--ocupacao", type=float, default=0.6, help="fração dos horários ocupados")
+    parser.add_argument("--notificacoes", type=int, default=20, help="por paciente")
+    parser.add_argument("--repeticoes", type=int, default=50, help="requisições por rota")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--banco", help="arquivo SQLite descartável (padrão: temporário)")
+    parser.add_argument("--saida", help="grava o resultado (baseline) neste JSON")
+    parser.add_argument("--comparar", help="baseline JSON de uma execução anterior")
+    return parser.parse_args()
+
+
+def _remover_banco(caminho: str):
+    for sufixo in ("", "-wal", "-shm"):
+        if os.path.exists(caminho + sufixo):
+            os.remove(caminho + sufixo)
+
+
+def _imprimir(resultados: dict, anterior: dict = None):
+    cabecalho = f"{'rota':32} {'p50':>8} {'p95':>8} {'p99':>8} {'sql':>6} {'sql int':>8} {'mem kB':>8}"
+    if anterior:
+        cabecalho += f" {'Δp95':>8} {'Δsql':>6}"
+    print(cabecalho)
+    for nome, r in resultados.items():
+        linha = (
+            f"{nome:32} {r['p50_ms']:8.2f} {r['p95_ms']:8.2f} {r['p99_ms']:8.2f} "
+            f"{r['sql_por_requisicao']:6.1f} {r['sql_internos_por_requisicao']:8.1f} "
+            f"{r['pico_memoria_kb']:8.0f}"
+        )
+        antes = (anterior or {}).get(nome)
+        if antes:
+            delta = (r["p95_ms"] / antes["p95_ms"] - 1) * 100 if antes["p95_ms"] else 0
+            linha += (
+                f" {delta:+7.0f}% {r['sql_por_requisicao'] - antes['sql_por_requisicao']:+6.1f}"
+            )
+        print(linha)
+
+
+def main():
+    args = _argumentos()
+    caminho = args.banco or os.path.join(tempfile.gettempdir(), "benchmark_clinica.db")
+    _remover_banco(caminho)
+
+    inicio = time.perf_counter()
+    clinica = dados.gerar_clinica(
+        caminho,
+        pacientes=args.pacientes,
+        medicos_por_cargo=args.medicos_por_cargo,
+        cargos=args.cargos,
+        anos=args.anos,
+        ocupacao=args.ocupacao,
+        notificacoes_por_paciente=args.notificacoes,
+        semente=args.semente,
+    )
+    geracao = time.perf_counter() - inicio
+    print(
+        f"Clínica gerada em {geracao:.1f}s: "
+        + ", ".join(f"{v} {k}" for k, v in clinica["contagens"].items()),
+        file=sys.stderr,
+    )
+
+    resultados = rotas.medir(clinica, repeticoes=args.repeticoes)
+
+    anterior = None
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            anterior = json.load(f)["rotas"]
+    _imprimir(resultados, anterior)
+
+    pico_processo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"Pico de memória do processo: {pico_processo / 1024:.0f} MB", file=sys.stderr)
+
+    if args.saida:
+        baseline = {
+            "gerado_em": datetime.now().isoformat(timespec="seconds"),
+            "ambiente": {
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "plataforma": platform.platform(),
+            },
+            "parametros": {
+                k: v for k, v in vars(args).items() if k not in ("banco", "saida", "comparar")
+            },
+            "contagens": clinica["contagens"],
+            "pico_memoria_processo_kb": pico_processo,
+            "rotas": resultados,
+        }
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"Baseline gravado em {args.saida}", file=sys.stderr)
+
+    if not args.banco:
+        _remover_banco(caminho)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""Geração da clínica sintética num banco SQLite descartável."""
+
+from datetime import date, datetime, timedelta
+import random
+
+import app as aplicacao
+
+
+CARGOS = (
+    "Clínico Geral",
+    "Pediatra",
+    "Nutricionista",
+    "Cardiologista",
+    "Dermatologista",
+    "Ortopedista",
+    "Ginecologista",
+    "Psiquiatra",
+)
+
+NOMES = ("Ana", "Bruno", "Carla", "Diego", "Elaine", "Fábio", "Gabriela",
+         "Heitor", "Isabela", "João", "Larissa", "Marcos", "Natália", "Otávio")
+SOBRENOMES = ("Silva", "Souza", "Oliveira", "Santos", "Pereira", "Lima",
+              "Costa", "Ferreira", "Almeida", "Ribeiro", "Gomes", "Martins")
+
+ADMIN_CPF = "00000000001"
+DIAS_FUTUROS = 60
+LOTE = 20000
+
+
+def cpf_medico(i: int) -> str:
+    return f"{20000000000 + i}"
+
+
+def cpf_paciente(i: int) -> str:
+    return f"{30000000000 + i}"
+
+
+def _nome(rnd) -> str:
+    return f"{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)} {rnd.choice(SOBRENOMES)}"
+
+
+def _em_lotes(db, sql: str, linhas):
+    lote = []
+    for linha in linhas:
+        lote.append(linha)
+        if len(lote) >= LOTE:
+            db.executemany(sql, lote)
+            lote.clear()
+    if lote:
+        db.executemany(sql, lote)
+
+
+def gerar_clinica(
+    caminho: str,
+    pacientes: int = 2000,
+    medicos_por_cargo: int = 4,
+    cargos: int = 4,
+    anos: float = 1.0,
+    ocupacao: float = 0.6,
+    notificacoes_por_paciente: int = 20,
+    semente: int = 42,
+) -> dict:
+    """
+    Cria em `caminho` o esquema da aplicação e preenche com dados
+    sintéticos. Devolve um resumo com os CPFs, cargos e contagens, usado
+    para montar as requisições do benchmark.
+
+    Cada médico atende em `ocupacao` dos horários do expediente padrão em
+    dias úteis, de `anos` atrás até DIAS_FUTUROS dias à frente: o passado
+    fica concluído (ou cancelado), o futuro agendado ou solicitado.
+    """
+    rnd = random.Random(semente)
+    aplicacao.app.config["DATABASE"] = caminho
+    aplicacao.conexoes.fechar()
+
+    with aplicacao.app.app_context():
+        aplicacao.init_db()
+        aplicacao.inicializar_usuarios_fixos()
+        db = aplicacao.get_db()
+
+        nomes_cargos = list(CARGOS[:cargos])
+        medicos = {
+            cargo: [
+                cpf_medico(c * medicos_por_cargo + i)
+                for i in range(medicos_por_cargo)
+            ]
+            for c, cargo in enumerate(nomes_cargos)
+        }
+        cpfs_pacientes = [cpf_paciente(i) for i in range(pacientes)]
+
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany(
+            "INSERT INTO usuarios (CPF, nome, senha, tipo, cargo) VALUES (?, ?, ?, ?, ?)",
+            [
+                (cpf, f"Dr(a). {_nome(rnd)}", "medico123", aplicacao.TIPO_MEDICO, cargo)
+                for cargo, cpfs in medicos.items()
+                for cpf in cpfs
+            ],
+        )
+        db.executemany(
+            "INSERT INTO usuarios (CPF, nome, senha, tipo) VALUES (?, ?, ?, ?)",
+            [(cpf, _nome(rnd), "1234", aplicacao.TIPO_PACIENTE) for cpf in cpfs_pacientes],
+        )
+        db.commit()
+
+        horas = aplicacao.horas_da_mascara(aplicacao.mascara_expediente())
+        hoje = date.today()
+        inicio = hoje - timedelta(days=int(anos * 365))
+        fim = hoje + timedelta(days=DIAS_FUTUROS)
+
+        def consultas():
+            dia = inicio
+            while dia <= fim:
+                if dia.weekday() < 5:
+                    passado = dia < hoje
+                    data = dia.isoformat()
+                    for cargo, cpfs in medicos.items():
+                        for medico in cpfs:
+                            for hora in horas:
+                                if rnd.random() >= ocupacao:
+                                    continue
+                                if passado:
+                                    status = (
+                                        aplicacao.STATUS_CANCELADA
+                                        if rnd.random() < 0.1
+                                        else aplicacao.STATUS_CONCLUIDA
+                                    )
+                                else:
+                                    status = (
+                                        aplicacao.STATUS_SOLICITADA
+                                        if rnd.random() < 0.3
+                                        else aplicacao.STATUS_AGENDADA
+                                    )
+                                concluida = status == aplicacao.STATUS_CONCLUIDA
+                                yield (
+                                    rnd.choice(cpfs_pacientes),
+                                    medico,
+                                    data,
+                                    hora,
+                                    "Consulta" if rnd.random() < 0.8 else "Retorno",
+                                    status,
+                                    "Dor de cabeça e febre" if rnd.random() < 0.2 else "",
+                                    "Paciente relatou melhora." if concluida else None,
+                                    "Retorno em 30 dias." if concluida else None,
+                                    cargo,
+                                )
+                dia += timedelta(days=1)
+
+        objetos = aplicacao.adiar_indices(db, "consultas")
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            _em_lotes(
+                db,
+                """
+                INSERT INTO consultas (paciente_cpf, medico_cpf, data, hora, tipo,
+                                       status, observacoes, resumo, conclusao, cargo)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                consultas(),
+            )
+            db.commit()
+        finally:
+            aplicacao.restaurar_indices(db, "consultas", objetos)
+
+        segundos = int((fim - inicio).total_seconds())
+
+        def notificacoes():
+            for cpf in cpfs_pacientes:
+                for _ in range(notificacoes_por_paciente):
+                    quando = datetime.combine(inicio, datetime.min.time())
+                    quando += timedelta(seconds=rnd.randrange(segundos))
+                    yield (
+                        cpf,
+                        "Sua consulta foi aprovada!",
+                        1 if rnd.random() < 0.8 else 0,
+                        quando.strftime("%Y-%m-%d %H:%M"),
+                    )
+
+        db.execute("BEGIN IMMEDIATE")
+        _em_lotes(
+            db,
+            "INSERT INTO notificacoes (cpf, texto, lida, data) VALUES (?, ?, ?, ?)",
+            notificacoes(),
+        )
+        db.commit()
+        db.execute("ANALYZE")
+        db.commit()
+
+        contagens = {
+            tabela: db.execute(f"SELECT COUNT(*) FROM {tabela}").fetchone()[0]
+            for tabela in ("usuarios", "consultas", "notificacoes")
+        }
+
+    return {
+        "admin": ADMIN_CPF,
+        "medicos": medicos,
+        "pacientes": cpfs_pacientes,
+        "hoje": hoje.isoformat(),
+        "contagens": contagens,
+    }
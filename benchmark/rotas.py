@@ -0,0 +1,389 @@
+"""Cenários por rota e medição (latência, SQL por requisição, memória)."""
+
+from datetime import date, timedelta
+import gc
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import app as aplicacao
+
+
+def percentil(valores, p: float) -> float:
+    """Percentil pelo método nearest-rank (valores já ordenados)."""
+    if not valores:
+        return 0.0
+    indice = max(0, min(len(valores) - 1, round(p / 100 * len(valores) + 0.5) - 1))
+    return valores[indice]
+
+
+class ContadorSQL:
+    """
+    Conta os comandos executados na conexão da thread atual. Os comandos
+    internos (corpo de gatilhos e o que o FTS5 roda nas tabelas-sombra)
+    também passam pelo trace: ficam num contador à parte.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.internos = 0
+
+    def zerar(self):
+        self.total = self.internos = 0
+
+    def _contar(self, sql):
+        if sql.startswith("--") or "'main'." in sql:
+            self.internos += 1
+        else:
+            self.total += 1
+
+    def instalar(self):
+        # a conexão pode ser reaberta pelo health check: reinstala sempre
+        aplicacao.conexoes.obter(aplicacao.app.config).set_trace_callback(self._contar)
+
+    def remover(self):
+        aplicacao.conexoes.obter(aplicacao.app.config).set_trace_callback(None)
+
+
+def _ids(status: str, limite: int, medico: bool = False):
+    """Consultas existentes num status (futuras), para as rotas que alteram."""
+    with aplicacao.app.app_context():
+        db = aplicacao.get_db()
+        cur = db.execute(
+            """
+            SELECT id, medico_cpf FROM consultas
+             WHERE status = ? AND data >= ?
+             ORDER BY data, hora
+             LIMIT ?
+            """,
+            (status, date.today().isoformat(), limite),
+        )
+        linhas = cur.fetchall()
+    return [(r["id"], r["medico_cpf"]) if medico else r["id"] for r in linhas]
+
+
+def _estatico_versionado(nome: str = "style.css") -> str:
+    """
+    Caminho versionado (/estaticos/...) de um arquivo de static/. Sem build
+    prévio, roda o gerar-estaticos numa pasta temporária.
+    """
+    if nome not in aplicacao.manifesto_estaticos():
+        aplicacao.app.config["ESTATICOS_PASTA"] = os.path.join(
+            tempfile.gettempdir(), "benchmark_estaticos"
+        )
+        aplicacao.app.test_cli_runner().invoke(aplicacao.gerar_estaticos_command)
+    return f"/estaticos/{aplicacao.manifesto_estaticos()[nome]}"
+
+
+def _condicional(usuario, caminho: str):
+    """
+    Gerador de GET condicional: If-None-Match com a ETag atual da página
+    (obtida uma vez, no aquecimento), para medir a resposta 304.
+    """
+    etag = []
+
+    def gerador(i):
+        if not etag:
+            cliente = aplicacao.app.test_client()
+            with cliente.session_transaction() as sessao:
+                sessao["cpf"], sessao["tipo"] = usuario
+            resp = cliente.get(caminho)
+            resp.get_data()
+            resp.close()
+            etag.append(resp.headers["ETag"])
+        return caminho, None, {"headers": {"If-None-Match": etag[0]}}
+
+    return gerador
+
+
+def cenarios(clinica: dict, repeticoes: int, semente: int = 42) -> list:
+    """
+    Lista de cenários (nome, usuário, método, gerador de requisição).
+
+    O gerador recebe o número da repetição e devolve (caminho, dados do
+    formulário ou None) e, opcionalmente, um dict com outros argumentos
+    para client.open (json, headers); as rotas que alteram dados usam um
+    alvo diferente a cada repetição. /notificacoes_stream fica de fora: é
+    uma conexão longa, não uma requisição.
+    """
+    rnd = random.Random(semente)
+    admin = (clinica["admin"], aplicacao.TIPO_ADMIN)
+    cargos = list(clinica["medicos"])
+    todos_medicos = [cpf for cpfs in clinica["medicos"].values() for cpf in cpfs]
+    pacientes = clinica["pacientes"]
+    hoje = date.fromisoformat(clinica["hoje"])
+
+    def medico():
+        return (rnd.choice(todos_medicos), aplicacao.TIPO_MEDICO)
+
+    def paciente():
+        return (rnd.choice(pacientes), aplicacao.TIPO_PACIENTE)
+
+    def dia_util(inicio: date, deslocamento: int) -> str:
+        dia = inicio + timedelta(days=deslocamento)
+        while dia.weekday() >= 5:
+            dia += timedelta(days=1)
+        return dia.isoformat()
+
+    def dia_passado():
+        return dia_util(hoje - timedelta(days=180), rnd.randrange(150))
+
+    def dia_futuro():
+        return dia_util(hoje, rnd.randrange(1, 30))
+
+    horas = aplicacao.horas_da_mascara(aplicacao.mascara_expediente())
+    # pedidos novos vão para depois dos dados gerados: nunca colidem
+    livres = [
+        (dia_util(hoje + timedelta(days=90), i // len(horas)), horas[i % len(horas)])
+        for i in range(repeticoes)
+    ]
+
+    lote = 20
+    solicitadas = _ids(aplicacao.STATUS_SOLICITADA, (2 + lote) * repeticoes)
+    # ids separados para o /consultas_lote, sem repetir os das outras rotas
+    para_lote = solicitadas[2 * repeticoes:] or [0]
+    solicitadas = solicitadas[:2 * repeticoes]
+    agendadas = _ids(aplicacao.STATUS_AGENDADA, 2 * repeticoes, medico=True)
+    rnd.shuffle(agendadas)
+    para_concluir = agendadas[:repeticoes]
+    para_cancelar = [i for i, _ in agendadas[repeticoes:]] + solicitadas[repeticoes:]
+
+    def ids_lote(i):
+        inicio = i * lote % len(para_lote)
+        return (para_lote[inicio:] + para_lote[:inicio])[:lote]
+
+    periodo = (
+        f"data_inicio={(hoje - timedelta(days=30)).isoformat()}"
+        f"&data_fim={hoje.isoformat()}"
+    )
+    gzip = {"headers": {"Accept-Encoding": "gzip"}}
+    estatico = _estatico_versionado()
+
+    def get(caminho, extras=None):
+        return lambda i: (caminho() if callable(caminho) else caminho, None, extras or {})
+
+    return [
+        ("index", None, "GET", get("/")),
+        (
+            "login",
+            None,
+            "POST",
+            lambda i: ("/login", {"cpf": rnd.choice(pacientes), "senha": "1234"}),
+        ),
+        ("dashboardadmin", admin, "GET", get("/dashboardadmin")),
+        ("clientesadmin", admin, "GET", get("/clientesadmin")),
+        ("clientesadmin busca", admin, "GET", get("/clientesadmin?busca=Silva")),
+        ("clientesadmin pagina 20", admin, "GET", get("/clientesadmin?pagina=20")),
+        ("clientesadmin busca cpf", admin, "GET", get("/clientesadmin?busca=0001")),
+        ("clientesadmin gzip", admin, "GET", get("/clientesadmin", gzip)),
+        ("clientesadmin 304", admin, "GET", _condicional(admin, "/clientesadmin")),
+        ("medicosadmin", admin, "GET", get("/medicosadmin")),
+        ("agendaadmin", admin, "GET", get("/agendaadmin")),
+        (
+            "agendaadmin status",
+            admin,
+            "GET",
+            get("/agendaadmin?status=agendada"),
+        ),
+        (
+            "agendaadmin data",
+            admin,
+            "GET",
+            get(lambda: f"/agendaadmin?data={dia_passado()}"),
+        ),
+        (
+            "agendaadmin busca",
+            admin,
+            "GET",
+            get("/agendaadmin?busca_paciente=Ana&busca_medico=Silva&status=concluida"),
+        ),
+        ("agendaadmin gzip", admin, "GET", get("/agendaadmin", gzip)),
+        ("agendaadmin 304", admin, "GET", _condicional(admin, "/agendaadmin")),
+        ("agenda.ics admin 30 dias", admin, "GET", get(f"/agenda.ics?{periodo}")),
+        ("agenda.csv admin 30 dias", admin, "GET", get(f"/agenda.csv?{periodo}")),
+        (
+            "agenda.csv admin 30 dias gzip",
+            admin,
+            "GET",
+            get(f"/agenda.csv?{periodo}", gzip),
+        ),
+        (
+            "agendaadmin POST",
+            admin,
+            "POST",
+            lambda i: (
+                "/agendaadmin",
+                {
+                    "paciente_cpf": rnd.choice(pacientes),
+                    "medico_cpf": clinica["medicos"][cargos[0]][0],
+                    "cargo": cargos[0],
+                    "data": livres[i][0],
+                    "hora": livres[i][1],
+                },
+            ),
+        ),
+        ("buscar_consultas", admin, "GET", get("/buscar_consultas?q=cabeça")),
+        (
+            "aprovar_consulta",
+            admin,
+            "POST",
+            lambda i: ("/aprovar_consulta", {"id": solicitadas[i % len(solicitadas)]}),
+        ),
+        (
+            "cancelar_consulta",
+            admin,
+            "POST",
+            lambda i: ("/cancelar_consulta", {"id": para_cancelar[i % len(para_cancelar)]}),
+        ),
+        (
+            f"consultas_lote aprovar {lote}",
+            admin,
+            "POST",
+            lambda i: (
+                "/consultas_lote",
+                None,
+                {"json": {"acao": "aprovar", "ids": ids_lote(i)}},
+            ),
+        ),
+        (
+            "novo_cliente",
+            admin,
+            "POST",
+            lambda i: (
+                "/novo_cliente",
+                {"nome": f"Paciente Novo {i}", "CPF": f"{40000000000 + i}", "senha": "1"},
+            ),
+        ),
+        ("agendamedico", medico, "GET", get("/agendamedico")),
+        ("agenda.ics medico", medico, "GET", get("/agenda.ics")),
+        ("buscar_consultas medico", medico, "GET", get("/buscar_consultas?q=cabeça")),
+        (
+            "concluir_consulta",
+            lambda i: (para_concluir[i % len(para_concluir)][1], aplicacao.TIPO_MEDICO),
+            "POST",
+            lambda i: (
+                "/concluir_consulta",
+                {
+                    "id": para_concluir[i % len(para_concluir)][0],
+                    "resumo": "Sem queixas.",
+                    "conclusao": "Alta.",
+                },
+            ),
+        ),
+        ("agendapaciente", paciente, "GET", get("/agendapaciente")),
+        ("agenda.csv paciente", paciente, "GET", get("/agenda.csv")),
+        (
+            "horarios_disponiveis cargo",
+            paciente,
+            "GET",
+            get(lambda: f"/horarios_disponiveis?data={dia_futuro()}&cargo={rnd.choice(cargos)}"),
+        ),
+        (
+            "horarios_disponiveis medico",
+            paciente,
+            "GET",
+            get(
+                lambda: f"/horarios_disponiveis?data={dia_futuro()}"
+                f"&medico_cpf={rnd.choice(todos_medicos)}"
+            ),
+        ),
+        (
+            "proximos_horarios",
+            paciente,
+            "GET",
+            get(lambda: f"/proximos_horarios?cargo={rnd.choice(cargos)}"),
+        ),
+        (
+            "solicitar_consulta",
+            paciente,
+            "POST",
+            lambda i: (
+                "/solicitar_consulta",
+                {"cargo": cargos[-1], "data": livres[i][0], "hora": livres[i][1]},
+            ),
+        ),
+        ("notificacoes_count", paciente, "GET", get("/notificacoes_count")),
+        ("notificacoes_lista", paciente, "GET", get("/notificacoes_lista")),
+        (
+            "notificacoes_lista antigas",
+            paciente,
+            "GET",
+            get("/notificacoes_lista?before_id=1000000&limit=200"),
+        ),
+        ("notificacoes_marcar_lidas", paciente, "POST", lambda i: ("/notificacoes_marcar_lidas", {})),
+        ("saude", None, "GET", get("/saude")),
+        ("estatico versionado", None, "GET", get(estatico)),
+        ("estatico versionado gzip", None, "GET", get(estatico, gzip)),
+        ("logout", paciente, "GET", get("/logout")),
+    ]
+
+
+def _requisicao(cliente, usuario, metodo, gerador, i):
+    if callable(usuario):
+        usuario = usuario(i) if usuario.__code__.co_argcount else usuario()
+    with cliente.session_transaction() as sessao:
+        sessao.clear()
+        if usuario:
+            sessao["cpf"], sessao["tipo"] = usuario
+    caminho, dados, *extras = gerador(i)
+    return cliente.open(caminho, method=metodo, data=dados, **(extras[0] if extras else {}))
+
+
+def medir(clinica: dict, repeticoes: int = 50, aquecimento: int = 3) -> dict:
+    """
+    Roda cada cenário `repeticoes` vezes e devolve, por rota, latência
+    (ms) p50/p95/p99/média, comandos SQL por requisição (e os internos,
+    de gatilhos e FTS) e o pico de
+    memória alocada (tracemalloc, numa execução à parte para não
+    distorcer a latência).
+    """
+    cliente = aplicacao.app.test_client()
+    contador = ContadorSQL()
+    resultados = {}
+
+    lista = cenarios(clinica, repeticoes + aquecimento + 1)
+    for nome, usuario, metodo, gerador in lista:
+        for i in range(aquecimento):
+            # lê o corpo: as agendas são geradas em streaming
+            _requisicao(cliente, usuario, metodo, gerador, i).get_data()
+
+        tempos = []
+        sqls = []
+        internos = []
+        status = {}
+        gc.collect()
+        for i in range(aquecimento, aquecimento + repeticoes):
+            contador.zerar()
+            contador.instalar()
+            inicio = time.perf_counter()
+            resp = _requisicao(cliente, usuario, metodo, gerador, i)
+            resp.get_data()
+            tempos.append((time.perf_counter() - inicio) * 1000)
+            contador.remover()
+            sqls.append(contador.total)
+            internos.append(contador.internos)
+            status[resp.status_code] = status.get(resp.status_code, 0) + 1
+
+        tracemalloc.start()
+        _requisicao(
+            cliente, usuario, metodo, gerador, aquecimento + repeticoes
+        ).get_data()
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        tempos.sort()
+        resultados[nome] = {
+            "metodo": metodo,
+            "p50_ms": round(percentil(tempos, 50), 3),
+            "p95_ms": round(percentil(tempos, 95), 3),
+            "p99_ms": round(percentil(tempos, 99), 3),
+            "media_ms": round(sum(tempos) / len(tempos), 3),
+            "sql_por_requisicao": round(sum(sqls) / len(sqls), 1),
+            "sql_maximo": max(sqls),
+            "sql_internos_por_requisicao": round(sum(internos) / len(internos), 1),
+            "pico_memoria_kb": round(pico / 1024, 1),
+            "status": {str(k): v for k, v in sorted(status.items())},
+        }
+    return resultados
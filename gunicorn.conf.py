@@ -0,0 +1,42 @@
+"""
+Configuração do gunicorn (usada pelo Procfile).
+
+create_app() garante o esquema do banco uma vez só; aqui cada worker é
+aquecido depois do fork, antes de receber a primeira requisição.
+
+Capacidade: cada stream SSE (/notificacoes_stream) prende uma thread até
+SSE_DURACAO_MAXIMA. Metade das threads de cada worker fica reservada às
+páginas; a outra metade atende streams. Com os valores padrão (4 workers
+x 16 threads) cabem 4 x 8 = 32 abas com o canal aberto ao mesmo tempo;
+a partir daí o stream responde 503 e a página usa o polling de 30 s.
+"""
+
+import os
+import subprocess
+import sys
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+
+
+def on_starting(server):
+    # arquivos estáticos versionados: gerados uma vez, no processo mestre,
+    # sem importar a aplicação nele
+    subprocess.run(
+        [sys.executable, "-m", "flask", "--app", "app", "gerar-estaticos"],
+        check=True,
+    )
+
+
+def post_worker_init(worker):
+    from app import app, aquecer
+
+    app.config["SSE_CONEXOES_MAXIMAS"] = max(1, worker.cfg.threads // 2)
+    tempos = aquecer()
+    worker.log.info(
+        "Worker %s aquecido: %s (até %s streams SSE)",
+        worker.pid,
+        tempos,
+        app.config["SSE_CONEXOES_MAXIMAS"],
+    )
@@ -0,0 +1,42 @@
+"""Fixtures comuns: a aplicação apontando para um banco novo por teste."""
+
+import pytest
+
+import app as aplicacao
+
+
+@pytest.fixture
+def app(tmp_path):
+    """app.app com um banco SQLite novo (esquema e usuários fixos)."""
+    config_original = dict(aplicacao.app.config)
+    aplicacao.app.config.update(
+        TESTING=True,
+        DATABASE=str(tmp_path / "clinica.db"),
+    )
+    aplicacao.cache_referencia.invalidar()
+    aplicacao.inicializar_banco()
+    yield aplicacao.app
+    aplicacao.conexoes.fechar()
+    aplicacao.cache_referencia.invalidar()
+    aplicacao.app.config.clear()
+    aplicacao.app.config.update(config_original)
+
+
+@pytest.fixture
+def cliente(app):
+    return app.test_client()
+
+
+def entrar(cliente, cpf: str, tipo: str):
+    """Coloca o usuário na sessão do cliente de teste, sem passar pelo login."""
+    with cliente.session_transaction() as sessao:
+        sessao.clear()
+        sessao["cpf"] = cpf
+        sessao["tipo"] = tipo
+
+
+def ler(resposta):
+    """Lê o corpo inteiro (as agendas vêm em streaming) e fecha a resposta."""
+    corpo = resposta.get_data(as_text=True)
+    resposta.close()
+    return corpo
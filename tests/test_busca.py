@@ -0,0 +1,28 @@
+"""Busca de usuários por nome (FTS5) e por CPF (prefixo no índice)."""
+
+import app as aplicacao
+
+
+def test_busca_por_cpf_e_por_prefixo(app):
+    tipos = (aplicacao.TIPO_MEDICO,)
+    with app.app_context():
+        db = aplicacao.get_db()
+        # médicos fixos: 00000000002 ... 00000000004
+        assert [u["CPF"] for u in aplicacao.buscar_usuarios(db, "000.000.000", tipos, 10)] == [
+            "00000000002", "00000000003", "00000000004",
+        ]
+        assert [u["CPF"] for u in aplicacao.buscar_usuarios(db, "000000000-03", tipos, 10)] == [
+            "00000000003",
+        ]
+        # dígitos do meio do CPF não casam
+        assert aplicacao.buscar_usuarios(db, "0003", tipos, 10) == []
+
+
+def test_busca_por_nome(app):
+    with app.app_context():
+        db = aplicacao.get_db()
+        nomes = [
+            u["nome"]
+            for u in aplicacao.buscar_usuarios(db, "cris", (aplicacao.TIPO_PACIENTE,), 10)
+        ]
+        assert nomes == ["Cristiano"]
@@ -0,0 +1,47 @@
+"""GET condicional (ETag) das páginas de listagem."""
+
+import pytest
+
+import app as aplicacao
+from conftest import entrar, ler
+
+ADMIN = ("00000000000", aplicacao.TIPO_ADMIN)
+MEDICO = ("00000000003", aplicacao.TIPO_MEDICO)
+
+
+def _recarregar(cliente, rota):
+    """GET normal seguido do GET condicional com a ETag recebida."""
+    resposta = cliente.get(rota)
+    corpo = ler(resposta)
+    assert resposta.status_code == 200
+    condicional = cliente.get(rota, headers={"If-None-Match": resposta.headers["ETag"]})
+    ler(condicional)
+    return corpo, condicional.status_code
+
+
+@pytest.mark.parametrize(
+    "usuario, rota",
+    [
+        (ADMIN, "/agendaadmin"),
+        (ADMIN, "/clientesadmin"),
+        (ADMIN, "/medicosadmin"),
+        (MEDICO, "/agendamedico"),
+    ],
+)
+def test_304_continua_depois_de_um_post(cliente, usuario, rota):
+    entrar(cliente, *usuario)
+    assert _recarregar(cliente, rota)[1] == 304
+
+    # ação que termina em flash + redirect (consulta inexistente)
+    if usuario == MEDICO:
+        ler(cliente.post("/concluir_consulta", data={"id": "999"}))
+    else:
+        ler(cliente.post("/cancelar_consulta", data={"id": "999"}))
+
+    # a página com a mensagem é gerada e tira o flash da sessão...
+    corpo, status = _recarregar(cliente, rota)
+    assert 'class="msg erro"' in corpo
+    with cliente.session_transaction() as sessao:
+        assert "_flashes" not in sessao
+    # ...e as recargas seguintes voltam a ser 304
+    assert status == 304
@@ -0,0 +1,18 @@
+"""Horários livres a partir do expediente dos médicos."""
+
+from conftest import entrar, ler
+
+import app as aplicacao
+
+
+def test_expediente_padrao_tem_intervalo_de_almoco(cliente):
+    entrar(cliente, "11111111111", aplicacao.TIPO_PACIENTE)
+    resposta = cliente.get(
+        "/horarios_disponiveis?data=2099-03-02&medico_cpf=00000000003"
+    )
+    ler(resposta)
+    horarios = resposta.get_json()["horarios"]
+
+    assert horarios[0] == "08:00" and horarios[-1] == "17:30"
+    assert "11:30" in horarios and "14:00" in horarios
+    assert not {"12:00", "12:30", "13:00", "13:30"} & set(horarios)
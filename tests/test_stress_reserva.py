@@ -0,0 +1,30 @@
+"""Vários processos disputando os mesmos horários: um vencedor por horário."""
+
+import multiprocessing
+
+import pytest
+
+import app as aplicacao
+
+pytestmark = pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(),
+    reason="stress-reserva usa processos com fork",
+)
+
+
+def test_cada_horario_tem_exatamente_uma_reserva(app, tmp_path):
+    horarios = 30
+    r = aplicacao._rodada_stress(6, horarios, str(tmp_path), "disputa")
+
+    assert r["ganhas"] == horarios  # somando os processos, uma vitória por horário
+    assert r["total"] == horarios  # e nenhuma reserva a mais gravada
+    assert r["duplicados"] == 0
+    assert r["erros"] == 0
+
+
+def test_comando_stress_reserva(app):
+    resultado = app.test_cli_runner().invoke(
+        aplicacao.stress_reserva_command, ["--processos", "4", "--horarios", "20"]
+    )
+    assert resultado.exit_code == 0, resultado.output
+    assert "OK: exatamente uma reserva por horário." in resultado.output